@@ -1,10 +1,14 @@
 from datetime import datetime, timezone
+import hashlib
+import hmac
 import logging
 import shlex
+import time
 
 import requests
 
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.core.cache import cache
 
 from allauth.socialaccount.models import SocialAccount
@@ -24,8 +28,53 @@ INTROSPECT_TOKEN_URL = (
 )
 
 
+# Seconds a request may introspect a token while others wait for the result
+INTROSPECT_LOCK_TIMEOUT = 5
+# Seconds between checks for the result of another request's introspection
+INTROSPECT_WAIT_INTERVAL = 0.05
+
+
 def get_cache_key(token):
-    return hash(token)
+    """
+    Get the cache key of a token's introspection.
+
+    The key is the same in every process, and does not reveal the token.
+    """
+    digest = hmac.new(
+        settings.SECRET_KEY.encode(), token.encode(), hashlib.sha256
+    ).hexdigest()
+    return f"fxa_token:{digest}"
+
+
+def get_user_cache_key(fxa_uid):
+    return f"fxa_user:{fxa_uid}"
+
+
+def clear_cached_user(fxa_uid):
+    """Remove the cached user id of a Mozilla account, after it changed."""
+    cache.delete(get_user_cache_key(fxa_uid))
+
+
+def get_lock_key(cache_key):
+    return f"{cache_key}:lock"
+
+
+def _wait_for_introspection(token, cache_key):
+    """
+    Wait for the result of another request introspecting a token.
+
+    The request that added the lock caches the result, then removes the lock.
+    If the lock is removed or expires without a result, introspect the token.
+    """
+    lock_key = get_lock_key(cache_key)
+    deadline = time.monotonic() + INTROSPECT_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(INTROSPECT_WAIT_INTERVAL)
+        if cached_fxa_resp_data := cache.get(cache_key):
+            return cached_fxa_resp_data
+        if cache.get(lock_key) is None:
+            break
+    return introspect_token(token)
 
 
 def introspect_token(token):
@@ -63,20 +112,28 @@ def get_fxa_uid_from_oauth_token(token, use_cache=True):
         # will still cache for at least cache_timeout to prevent an outage
         # from causing useless run-away repetitive introspection requests
         fxa_resp_data = {"status_code": None, "json": {}}
+        lock_key = get_lock_key(cache_key)
+        lock_acquired = False
         try:
             cached_fxa_resp_data = cache.get(cache_key)
 
             if cached_fxa_resp_data:
                 fxa_resp_data = cached_fxa_resp_data
             else:
-                # no cached data, get new
-                fxa_resp_data = introspect_token(token)
+                # no cached data, get new unless another request is getting it
+                lock_acquired = cache.add(lock_key, True, INTROSPECT_LOCK_TIMEOUT)
+                if lock_acquired:
+                    fxa_resp_data = introspect_token(token)
+                else:
+                    fxa_resp_data = _wait_for_introspection(token, cache_key)
         except AuthenticationFailed:
             raise
         finally:
             # Store potential valid response, errors, inactive users, etc. from FxA
             # for at least 60 seconds. Valid access_token cache extended after checking.
             cache.set(cache_key, fxa_resp_data, cache_timeout)
+            if lock_acquired:
+                cache.delete(lock_key)
 
     if fxa_resp_data["status_code"] is None:
         raise APIException("Previous FXA call failed, wait to retry.")
@@ -133,16 +190,38 @@ class FxaTokenAuthentication(BaseAuthentication):
             if method == "POST" and request.path == "/api/v1/relayaddresses/":
                 use_cache = True
         fxa_uid = get_fxa_uid_from_oauth_token(token, use_cache)
-        try:
-            # MPP-3021: select_related user object to save DB query
-            sa = SocialAccount.objects.filter(
-                uid=fxa_uid, provider="fxa"
-            ).select_related("user")[0]
-        except IndexError:
-            raise PermissionDenied(
-                "Authenticated user does not have a Relay account. Have they accepted the terms?"
+
+        # The user id is cached, and the User is loaded fresh, in case it changed
+        # or was deleted since
+        user = None
+        user_id = (
+            cache.get(get_user_cache_key(fxa_uid))
+            if settings.FXA_USER_CACHE_TIMEOUT
+            else None
+        )
+        if user_id is not None:
+            user = (
+                User.objects.filter(id=user_id)
+                .select_related("profile__fxa_snapshot")
+                .first()
             )
-        user = sa.user
+        if user is None:
+            try:
+                # MPP-3021: select_related user object to save DB query
+                sa = SocialAccount.objects.filter(
+                    uid=fxa_uid, provider="fxa"
+                ).select_related("user__profile__fxa_snapshot")[0]
+            except IndexError:
+                raise PermissionDenied(
+                    "Authenticated user does not have a Relay account. Have they accepted the terms?"
+                )
+            user = sa.user
+            if settings.FXA_USER_CACHE_TIMEOUT and user:
+                cache.set(
+                    get_user_cache_key(fxa_uid),
+                    user.id,
+                    settings.FXA_USER_CACHE_TIMEOUT,
+                )
 
         if user:
             return (user, token)
@@ -1,9 +1,14 @@
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import prefetch_related_objects
+from django.db.models import Manager, prefetch_related_objects
 
 from rest_framework import serializers, exceptions
 from waffle import get_waffle_flag_model
 
+from emails.counters import (
+    add_pending_mask_counters,
+    get_pending_mask_totals,
+)
 from emails.models import DomainAddress, Profile, RelayAddress
 
 
@@ -13,7 +18,7 @@ class PremiumValidatorsMixin:
         if not value:
             return value
         user = self.context["request"].user
-        prefetch_related_objects([user], "socialaccount_set", "profile")
+        prefetch_related_objects([user], "profile__fxa_snapshot")
         if not user.profile.has_premium:
             raise exceptions.AuthenticationFailed(
                 "Must be premium to set block_list_emails."
@@ -21,11 +26,29 @@ class PremiumValidatorsMixin:
         return value
 
 
-class RelayAddressSerializer(PremiumValidatorsMixin, serializers.ModelSerializer):
+class PendingMaskCountersListSerializer(serializers.ListSerializer):
+    # Get the pending counters of all the masks at once
+    def to_representation(self, data):
+        masks = list(data.all() if isinstance(data, Manager) else data)
+        add_pending_mask_counters(masks)
+        return super().to_representation(masks)
+
+
+class PendingMaskCountersMixin:
+    # Add the counters that are not yet flushed to the database
+    def to_representation(self, instance):
+        add_pending_mask_counters([instance])
+        return super().to_representation(instance)
+
+
+class RelayAddressSerializer(
+    PendingMaskCountersMixin, PremiumValidatorsMixin, serializers.ModelSerializer
+):
     mask_type = serializers.CharField(default="random", read_only=True, required=False)
 
     class Meta:
         model = RelayAddress
+        list_serializer_class = PendingMaskCountersListSerializer
         fields = [
             "mask_type",
             "enabled",
@@ -64,11 +87,14 @@ class RelayAddressSerializer(PremiumValidatorsMixin, serializers.ModelSerializer
         ]
 
 
-class DomainAddressSerializer(PremiumValidatorsMixin, serializers.ModelSerializer):
+class DomainAddressSerializer(
+    PendingMaskCountersMixin, PremiumValidatorsMixin, serializers.ModelSerializer
+):
     mask_type = serializers.CharField(default="custom", read_only=True, required=False)
 
     class Meta:
         model = DomainAddress
+        list_serializer_class = PendingMaskCountersListSerializer
         fields = [
             "mask_type",
             "enabled",
@@ -147,6 +173,22 @@ class StrictReadOnlyFieldsMixin:
 
 
 class ProfileSerializer(StrictReadOnlyFieldsMixin, serializers.ModelSerializer):
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if settings.MASK_COUNTERS_WRITE_BEHIND:
+            # Add the counters that are not yet flushed to the database
+            pending = get_pending_mask_totals(
+                instance.relay_addresses.values_list("id", flat=True),
+                instance.domain_addresses.values_list("id", flat=True),
+            )
+            data["emails_blocked"] += pending["num_blocked"]
+            data["emails_forwarded"] += pending["num_forwarded"]
+            data["emails_replied"] += pending["num_replied"]
+            data["level_one_trackers_blocked"] += pending[
+                "num_level_one_trackers_blocked"
+            ]
+        return data
+
     class Meta:
         model = Profile
         fields = [
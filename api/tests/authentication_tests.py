@@ -1,8 +1,10 @@
 from datetime import datetime
+from unittest.mock import patch
 
 from model_bakery import baker
 import responses
 
+from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.test import RequestFactory, TestCase
 
@@ -11,13 +13,16 @@ from rest_framework.exceptions import (
     APIException,
     AuthenticationFailed,
     NotFound,
+    PermissionDenied,
 )
 from rest_framework.test import APIClient
 
 from ..authentication import (
     FxaTokenAuthentication,
+    clear_cached_user,
     get_cache_key,
     get_fxa_uid_from_oauth_token,
+    get_user_cache_key,
     introspect_token,
     INTROSPECT_TOKEN_URL,
 )
@@ -232,6 +237,78 @@ class AuthenticationMiscellaneous(TestCase):
             return
         self.fail("Should have raised AuthenticationFailed")
 
+    def test_get_cache_key_is_stable_and_hides_token(self):
+        cache_key = get_cache_key("user-123")
+        assert cache_key == get_cache_key("user-123")
+        assert cache_key != get_cache_key("user-456")
+        assert cache_key.startswith("fxa_token:")
+        assert "user-123" not in cache_key
+
+    @responses.activate()
+    def test_get_fxa_uid_from_oauth_token_waits_for_concurrent_introspection(self):
+        user_token = "user-123"
+        cache_key = get_cache_key(user_token)
+        fxa_response = {"status_code": 200, "json": {"active": True, "sub": self.uid}}
+        # Another request is introspecting the token
+        cache.add(f"{cache_key}:lock", True)
+
+        def other_request_done(seconds):
+            cache.set(cache_key, fxa_response)
+
+        with patch(f"{MOCK_BASE}.time.sleep", side_effect=other_request_done):
+            assert get_fxa_uid_from_oauth_token(user_token) == self.uid
+        assert responses.assert_call_count(self.fxa_verify_path, 0) is True
+        # The other request releases its own lock
+        assert cache.get(f"{cache_key}:lock") is True
+
+    @responses.activate()
+    def test_get_fxa_uid_from_oauth_token_releases_lock_after_introspection(self):
+        user_token = "user-123"
+        cache_key = get_cache_key(user_token)
+        _setup_fxa_response(200, {"active": True, "sub": self.uid})
+
+        assert get_fxa_uid_from_oauth_token(user_token) == self.uid
+        assert responses.assert_call_count(self.fxa_verify_path, 1) is True
+        assert cache.get(f"{cache_key}:lock") is None
+
+    @responses.activate()
+    def test_get_fxa_uid_from_oauth_token_releases_lock_after_error(self):
+        user_token = "user-123"
+        cache_key = get_cache_key(user_token)
+        _setup_fxa_response_no_json(200)
+
+        with self.assertRaises(AuthenticationFailed):
+            get_fxa_uid_from_oauth_token(user_token)
+        assert cache.get(f"{cache_key}:lock") is None
+
+    def test_get_fxa_uid_from_oauth_token_cache_hit_skips_lock(self):
+        user_token = "user-123"
+        cache_key = get_cache_key(user_token)
+        fxa_response = {"status_code": 200, "json": {"active": True, "sub": self.uid}}
+        cache.set(cache_key, fxa_response)
+
+        with (
+            patch(f"{MOCK_BASE}.cache.add") as mock_add,
+            patch(f"{MOCK_BASE}.cache.delete") as mock_delete,
+        ):
+            assert get_fxa_uid_from_oauth_token(user_token) == self.uid
+        mock_add.assert_not_called()
+        mock_delete.assert_not_called()
+
+    @responses.activate()
+    def test_get_fxa_uid_from_oauth_token_introspects_if_lock_released(self):
+        user_token = "user-123"
+        cache_key = get_cache_key(user_token)
+        _setup_fxa_response(200, {"active": True, "sub": self.uid})
+        cache.add(f"{cache_key}:lock", True)
+
+        def other_request_failed(seconds):
+            cache.delete(f"{cache_key}:lock")
+
+        with patch(f"{MOCK_BASE}.time.sleep", side_effect=other_request_failed):
+            assert get_fxa_uid_from_oauth_token(user_token) == self.uid
+        assert responses.assert_call_count(self.fxa_verify_path, 1) is True
+
 
 class FxaTokenAuthenticationTest(TestCase):
     def setUp(self):
@@ -372,6 +449,54 @@ class FxaTokenAuthenticationTest(TestCase):
         assert responses.assert_call_count(self.fxa_verify_path, 1) is True
         assert cache.get(get_cache_key(user_token)) == fxa_response
 
+    @responses.activate()
+    def test_requests_use_cached_user_id(self):
+        self.sa = baker.make(SocialAccount, uid=self.uid, provider="fxa")
+        user_token = "user-123"
+        _setup_fxa_response(200, {"active": True, "sub": self.uid})
+        headers = {"HTTP_AUTHORIZATION": f"Bearer {user_token}"}
+        get_addresses_req = self.factory.get(self.path, **headers)
+
+        auth_return = self.auth.authenticate(self.auth, get_addresses_req)
+        assert auth_return == (self.sa.user, user_token)
+        assert cache.get(get_user_cache_key(self.uid)) == self.sa.user.id
+
+        # One query for the User, with the Profile and Mozilla account snapshot
+        with self.assertNumQueries(1):
+            auth_return = self.auth.authenticate(self.auth, get_addresses_req)
+            assert auth_return[0].profile.has_premium is False
+        assert auth_return == (self.sa.user, user_token)
+
+        clear_cached_user(self.uid)
+        assert cache.get(get_user_cache_key(self.uid)) is None
+
+    @responses.activate()
+    def test_cached_user_id_loads_current_user(self):
+        self.sa = baker.make(SocialAccount, uid=self.uid, provider="fxa")
+        user_token = "user-123"
+        _setup_fxa_response(200, {"active": True, "sub": self.uid})
+        cache.set(get_user_cache_key(self.uid), self.sa.user.id)
+        User.objects.filter(id=self.sa.user.id).update(email="new@example.com")
+        headers = {"HTTP_AUTHORIZATION": f"Bearer {user_token}"}
+        post_addresses_req = self.factory.post(self.path, **headers)
+
+        user, _ = self.auth.authenticate(self.auth, post_addresses_req)
+        assert user.email == "new@example.com"
+
+    @responses.activate()
+    def test_cached_user_id_of_deleted_user(self):
+        self.sa = baker.make(SocialAccount, uid=self.uid, provider="fxa")
+        user_token = "user-123"
+        _setup_fxa_response(200, {"active": True, "sub": self.uid})
+        # Cached by a request that read the User before the deletion committed
+        cache.set(get_user_cache_key(self.uid), self.sa.user.id)
+        self.sa.user.delete()
+        headers = {"HTTP_AUTHORIZATION": f"Bearer {user_token}"}
+        get_addresses_req = self.factory.get(self.path, **headers)
+
+        with self.assertRaises(PermissionDenied):
+            self.auth.authenticate(self.auth, get_addresses_req)
+
     @responses.activate()
     def test_write_requests_make_calls_to_fxa(self):
         self.sa = baker.make(SocialAccount, uid=self.uid, provider="fxa")
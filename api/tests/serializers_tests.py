@@ -1,3 +1,6 @@
+from unittest.mock import patch
+
+from django.test import override_settings
 from django.urls import reverse
 
 from model_bakery import baker
@@ -6,10 +9,16 @@ from rest_framework.test import APITestCase
 from waffle.models import Flag
 import pytest
 
+from emails.counters import increment_mask_counters
 from emails.models import RelayAddress
+from emails.tests.counters_tests import FakeRedis
 from emails.tests.models_tests import make_free_test_user, make_premium_test_user
 
-from api.serializers import FlagSerializer
+from api.serializers import (
+    FlagSerializer,
+    ProfileSerializer,
+    RelayAddressSerializer,
+)
 
 
 class PremiumValidatorsTest(APITestCase):
@@ -94,3 +103,27 @@ def test_flag_serializer_cannot_change_name_to_manage_flags(test_flag):
     assert not serializer.is_valid()
     expected = "Changing the `manage_flags` flag is not allowed."
     assert str(serializer.errors["non_field_errors"][0]) == expected
+
+
+@pytest.mark.django_db
+@override_settings(MASK_COUNTERS_WRITE_BEHIND=True)
+def test_serializers_add_pending_mask_counters() -> None:
+    user = make_free_test_user()
+    relay_addresses = baker.make(RelayAddress, user=user, _quantity=2)
+    with patch("emails.counters.get_redis_connection", return_value=FakeRedis()):
+        increment_mask_counters(relay_addresses[0], num_forwarded=2, used=True)
+        increment_mask_counters(relay_addresses[1], num_blocked=1)
+
+        masks = RelayAddressSerializer(
+            RelayAddress.objects.filter(user=user).order_by("id"), many=True
+        ).data
+        mask = RelayAddressSerializer(
+            RelayAddress.objects.get(id=relay_addresses[1].id)
+        ).data
+        profile = ProfileSerializer(user.profile).data
+
+    assert [(m["num_forwarded"], m["num_blocked"]) for m in masks] == [(2, 0), (0, 1)]
+    assert masks[0]["last_used_at"] is not None
+    assert mask["num_blocked"] == 1
+    assert profile["emails_forwarded"] == 2
+    assert profile["emails_blocked"] == 1
@@ -0,0 +1,210 @@
+"""
+Bloom filters of RelayAddresses, to reject email to unknown masks.
+
+The rebuild_address_filter command builds a filter of the live RelayAddresses
+and a filter of the DeletedAddress hashes, and stores them in the default
+cache. Each worker loads the filters into memory, and reloads them every
+ADDRESS_FILTER_RELOAD_INTERVAL seconds. Filters built more than
+ADDRESS_FILTER_MAX_AGE seconds ago are not used.
+
+A Bloom filter has no false negatives, so an address that is not in the live
+filter was not a RelayAddress when the filter was built. RelayAddresses created
+since then are cached in the address cache for ADDRESS_FILTER_MAX_AGE seconds,
+see emails.signals. Since a cached address can be evicted, each worker also
+reads the RelayAddresses created since the filter was built from the database,
+at most every RECENT_ADDRESSES_POLL_INTERVAL seconds, see
+is_recent_relay_address().
+"""
+
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from hashlib import sha256
+from math import ceil, log
+from time import monotonic
+from typing import Iterable, Iterator
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import DeletedAddress, RelayAddress
+
+ADDRESS_FILTER_CACHE_KEY = "emails.address_filter"
+# Seconds between reads of the RelayAddresses created since the filter was built
+RECENT_ADDRESSES_POLL_INTERVAL = 1.0
+# Overlap of the reads, for RelayAddresses committed after their created_at
+_RECENT_ADDRESSES_OVERLAP = timedelta(minutes=1)
+
+
+class BloomFilter:
+    """A set of strings with false positives, but no false negatives."""
+
+    def __init__(self, size: int, num_hashes: int) -> None:
+        self.size = size
+        self.num_hashes = num_hashes
+        self.bits = bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity: int, error_rate: float) -> BloomFilter:
+        """Create a filter with the error_rate when it holds capacity items."""
+        capacity = max(capacity, 1)
+        size = ceil(-capacity * log(error_rate) / log(2) ** 2)
+        num_hashes = max(round(size / capacity * log(2)), 1)
+        return cls(size, num_hashes)
+
+    def _indexes(self, key: str) -> Iterator[int]:
+        # Double hashing, see Kirsch and Mitzenmacher, "Less Hashing, Same
+        # Performance: Building a Better Bloom Filter"
+        digest = sha256(key.encode()).digest()
+        hash1 = int.from_bytes(digest[:8], "little")
+        hash2 = int.from_bytes(digest[8:16], "little") | 1
+        for i in range(self.num_hashes):
+            yield (hash1 + i * hash2) % self.size
+
+    def add(self, key: str) -> None:
+        for index in self._indexes(key):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def update(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(key)
+        )
+
+
+def relay_address_key(address: str, domain_numerical: int) -> str:
+    return f"{address}@{domain_numerical}"
+
+
+class AddressFilter:
+    """Bloom filters of the live RelayAddresses and the DeletedAddress hashes."""
+
+    def __init__(
+        self,
+        built_at: datetime,
+        relay_addresses: BloomFilter,
+        deleted_addresses: BloomFilter,
+    ) -> None:
+        self.built_at = built_at
+        self.relay_addresses = relay_addresses
+        self.deleted_addresses = deleted_addresses
+
+    def may_be_relay_address(self, address: str, domain_numerical: int) -> bool:
+        return relay_address_key(address, domain_numerical) in self.relay_addresses
+
+    def may_be_deleted_address(self, address_hash: str) -> bool:
+        return address_hash in self.deleted_addresses
+
+
+def build_address_filter(error_rate: float) -> AddressFilter:
+    """Build the AddressFilter from the database."""
+    # Set before reading, so RelayAddresses created during the build are cached
+    built_at = datetime.now(timezone.utc)
+
+    relay_addresses = BloomFilter.for_capacity(RelayAddress.objects.count(), error_rate)
+    relay_addresses.update(
+        relay_address_key(address, domain)
+        for address, domain in RelayAddress.objects.values_list(
+            "address", "domain"
+        ).iterator(chunk_size=10_000)
+    )
+
+    deleted_addresses = BloomFilter.for_capacity(
+        DeletedAddress.objects.count(), error_rate
+    )
+    deleted_addresses.update(
+        DeletedAddress.objects.values_list("address_hash", flat=True).iterator(
+            chunk_size=10_000
+        )
+    )
+    return AddressFilter(built_at, relay_addresses, deleted_addresses)
+
+
+def store_address_filter(address_filter: AddressFilter) -> None:
+    cache.set(ADDRESS_FILTER_CACHE_KEY, address_filter, settings.ADDRESS_FILTER_MAX_AGE)
+
+
+_loaded_filter: AddressFilter | None = None
+_loaded_at: float | None = None
+
+
+def get_address_filter() -> AddressFilter | None:
+    """
+    Get the AddressFilter loaded by this process, or None if disabled or stale.
+
+    The filter is reloaded from the cache every ADDRESS_FILTER_RELOAD_INTERVAL
+    seconds.
+    """
+    global _loaded_filter, _loaded_at
+    max_age = settings.ADDRESS_FILTER_MAX_AGE
+    if not max_age:
+        return None
+
+    now = monotonic()
+    if (
+        _loaded_at is None
+        or now - _loaded_at >= settings.ADDRESS_FILTER_RELOAD_INTERVAL
+    ):
+        _loaded_filter = cache.get(ADDRESS_FILTER_CACHE_KEY)
+        _loaded_at = now
+
+    if _loaded_filter is None:
+        return None
+    if datetime.now(timezone.utc) - _loaded_filter.built_at > timedelta(
+        seconds=max_age
+    ):
+        return None
+    return _loaded_filter
+
+
+def clear_loaded_address_filter() -> None:
+    """Forget the loaded AddressFilter, so it is reloaded on next use."""
+    global _loaded_filter, _loaded_at, _recent_built_at
+    _loaded_filter = None
+    _loaded_at = None
+    _recent_built_at = None
+
+
+# The RelayAddresses created since the filter built at _recent_built_at
+_recent_built_at: datetime | None = None
+_recent_keys: set[str] = set()
+_recent_read_at: datetime | None = None
+_recent_polled_at: float | None = None
+
+
+def is_recent_relay_address(
+    address_filter: AddressFilter, address: str, domain_numerical: int
+) -> bool:
+    """
+    Return True if the RelayAddress was created since the filter was built.
+
+    The RelayAddresses created since then are read from the database, at most
+    every RECENT_ADDRESSES_POLL_INTERVAL seconds.
+    """
+    global _recent_built_at, _recent_keys, _recent_read_at, _recent_polled_at
+    if _recent_built_at != address_filter.built_at:
+        _recent_built_at = address_filter.built_at
+        _recent_keys = set()
+        _recent_read_at = None
+        _recent_polled_at = None
+
+    key = relay_address_key(address, domain_numerical)
+    now = monotonic()
+    if key not in _recent_keys and (
+        _recent_polled_at is None
+        or now - _recent_polled_at >= RECENT_ADDRESSES_POLL_INTERVAL
+    ):
+        read_at = datetime.now(timezone.utc)
+        since = (_recent_read_at or address_filter.built_at) - _RECENT_ADDRESSES_OVERLAP
+        _recent_keys.update(
+            relay_address_key(address, domain)
+            for address, domain in RelayAddress.objects.filter(
+                created_at__gte=since
+            ).values_list("address", "domain")
+        )
+        _recent_read_at = read_at
+        _recent_polled_at = now
+    return key in _recent_keys
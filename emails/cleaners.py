@@ -7,9 +7,20 @@ from django.db.models import Count, Q
 
 from privaterelay.cleaners import CleanerTask, CleanupData, Counts
 
-from .models import DomainAddress, Profile, RelayAddress
+from .models import (
+    DomainAddress,
+    FxaSnapshot,
+    Profile,
+    RelayAddress,
+    get_fxa_snapshot,
+    iter_profile_batches,
+    store_fxa_snapshots,
+)
 from .signals import create_user_profile
 
+# Profiles read or updated per query
+_BATCH_SIZE = 1000
+
 
 class ServerStorageCleaner(CleanerTask):
     slug = "server-storage"
@@ -215,3 +226,85 @@ class MissingProfileCleaner(CleanerTask):
             )
 
         return "\n".join(lines)
+
+
+class FxaSnapshotCleaner(CleanerTask):
+    slug = "fxa-snapshot"
+    title = "Ensure the Mozilla account snapshot matches the account"
+    check_description = (
+        "The entitlements, language, and uid stored in FxaSnapshot should match the"
+        " data of the user's Mozilla account."
+    )
+
+    def _get_counts_and_data(self) -> tuple[Counts, CleanupData]:
+        """
+        Compare the Profile snapshots to the Mozilla accounts.
+
+        Returns:
+        * counts: two-level dict of summary and profile counts
+        * cleanup_data: dict of the profiles to update
+        """
+        all_count = 0
+        not_snapshot: list[Profile] = []
+        stale: list[Profile] = []
+        for batch in iter_profile_batches(Profile.objects.all(), _BATCH_SIZE):
+            all_count += len(batch)
+            for profile in batch:
+                try:
+                    fxa_snapshot = profile.fxa_snapshot
+                except FxaSnapshot.DoesNotExist:
+                    not_snapshot.append(profile)
+                    continue
+                if any(
+                    getattr(fxa_snapshot, field) != value
+                    for field, value in get_fxa_snapshot(profile.fxa).items()
+                ):
+                    stale.append(profile)
+
+        counts: Counts = {
+            "summary": {
+                "ok": all_count - len(not_snapshot) - len(stale),
+                "needs_cleaning": len(not_snapshot) + len(stale),
+            },
+            "profiles": {
+                "all": all_count,
+                "not_snapshot": len(not_snapshot),
+                "stale_snapshot": len(stale),
+            },
+        }
+        cleanup_data: CleanupData = {"profiles": not_snapshot + stale}
+        return counts, cleanup_data
+
+    def _clean(self) -> int:
+        """Store the current snapshot of the Mozilla accounts."""
+        profiles = self.cleanup_data["profiles"]
+        for start in range(0, len(profiles), _BATCH_SIZE):
+            store_fxa_snapshots(profiles[start : start + _BATCH_SIZE])
+        self.counts["profiles"]["cleaned"] = len(profiles)
+        return len(profiles)
+
+    def markdown_report(self) -> str:
+        """Report on profiles without a current snapshot."""
+        profile_counts = self.counts["profiles"]
+        all_profiles = profile_counts["all"]
+        lines = [
+            "Profiles:",
+            f"  All: {all_profiles}",
+        ]
+        if all_profiles > 0:
+            not_snapshot = profile_counts["not_snapshot"]
+            stale = profile_counts["stale_snapshot"]
+            lines.extend(
+                [
+                    "    No Snapshot   : "
+                    f"{self._as_percent(not_snapshot, all_profiles)}",
+                    f"    Stale Snapshot: {self._as_percent(stale, all_profiles)}",
+                ]
+            )
+            cleaned = profile_counts.get("cleaned")
+            if cleaned is not None and (not_snapshot or stale):
+                lines.append(
+                    "      Now Current: "
+                    f"{self._as_percent(cleaned, not_snapshot + stale)}"
+                )
+        return "\n".join(lines)
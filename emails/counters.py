@@ -0,0 +1,379 @@
+"""
+Counters of the emails forwarded, blocked, and replied to by masks and users.
+
+By default, the mask counters are incremented in the database with F()
+expressions, so concurrent emails to the same mask are all counted.
+
+With MASK_COUNTERS_WRITE_BEHIND, the increments and the time of last use are
+added to a Redis hash instead, and the flush_mask_counters command adds them to
+the database in bulk. The API adds the pending increments to the masks and
+totals it returns.
+
+With ABUSE_METRICS_WRITE_BEHIND, the daily abuse metrics of a user are counted
+in a Redis hash per UTC day, and the persist_abuse_metrics command saves them
+to AbuseMetrics for auditing.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from typing import Iterable
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Coalesce
+
+from django_redis import get_redis_connection
+from redis import Redis
+from redis.exceptions import ResponseError
+
+from .models import AbuseMetrics, DomainAddress, RelayAddress
+
+MASK_COUNTERS_KEY = "emails.mask_counters"
+MASK_COUNTERS = (
+    "num_forwarded",
+    "num_blocked",
+    "num_replied",
+    "num_level_one_trackers_blocked",
+)
+_MASK_MODELS: dict[str, type[RelayAddress] | type[DomainAddress]] = {
+    "relayaddress": RelayAddress,
+    "domainaddress": DomainAddress,
+}
+# Masks updated by one UPDATE statement when flushing
+_FLUSH_BATCH_SIZE = 1000
+# Only one flush runs at a time, for at most this many seconds
+_FLUSH_LOCK_KEY = f"{MASK_COUNTERS_KEY}.flush_lock"
+_FLUSH_LOCK_TIMEOUT = 10 * 60
+
+# Pending counters by (model name, id), then field
+PendingCounters = dict[tuple[str, int], dict[str, float]]
+
+
+def _field_key(model_name: str, mask_id: int, field: str) -> str:
+    return f"{model_name}:{mask_id}:{field}"
+
+
+def _mask_field_key(mask: RelayAddress | DomainAddress, field: str) -> str:
+    return _field_key(type(mask).__name__.lower(), mask.id, field)
+
+
+def increment_mask_counters(
+    mask: RelayAddress | DomainAddress,
+    *,
+    num_forwarded: int = 0,
+    num_blocked: int = 0,
+    num_replied: int = 0,
+    num_level_one_trackers_blocked: int = 0,
+    used: bool = False,
+) -> None:
+    """
+    Increment the counters of a mask, and set last_used_at if used.
+
+    The mask instance is updated as well, but without the increments from other
+    requests.
+    """
+    increments = {
+        field: delta
+        for field, delta in (
+            ("num_forwarded", num_forwarded),
+            ("num_blocked", num_blocked),
+            ("num_replied", num_replied),
+            ("num_level_one_trackers_blocked", num_level_one_trackers_blocked),
+        )
+        if delta
+    }
+    last_used_at = datetime.now(timezone.utc) if used else None
+    for field, delta in increments.items():
+        setattr(mask, field, (getattr(mask, field) or 0) + delta)
+    if last_used_at:
+        mask.last_used_at = last_used_at
+    if not (increments or last_used_at):
+        return
+
+    if settings.MASK_COUNTERS_WRITE_BEHIND:
+        with get_redis_connection("default").pipeline() as pipe:
+            for field, delta in increments.items():
+                pipe.hincrby(MASK_COUNTERS_KEY, _mask_field_key(mask, field), delta)
+            if last_used_at:
+                pipe.hset(
+                    MASK_COUNTERS_KEY,
+                    _mask_field_key(mask, "last_used_at"),
+                    last_used_at.timestamp(),
+                )
+            pipe.execute()
+        return
+
+    updates: dict[str, object] = {
+        field: Coalesce(F(field), 0) + delta for field, delta in increments.items()
+    }
+    if last_used_at:
+        updates["last_used_at"] = last_used_at
+    type(mask).objects.filter(id=mask.id).update(**updates)
+
+
+def add_pending_mask_counters(
+    masks: Iterable[RelayAddress | DomainAddress],
+) -> None:
+    """Add the increments that are not yet flushed to the mask instances."""
+    if not settings.MASK_COUNTERS_WRITE_BEHIND:
+        return
+    masks = [mask for mask in masks if not getattr(mask, "_pending_added", False)]
+    fields = [
+        _mask_field_key(mask, field)
+        for mask in masks
+        for field in MASK_COUNTERS + ("last_used_at",)
+    ]
+    if not fields:
+        return
+    values = iter(get_redis_connection("default").hmget(MASK_COUNTERS_KEY, fields))
+    for mask in masks:
+        for field in MASK_COUNTERS:
+            delta = next(values)
+            if delta is not None:
+                setattr(mask, field, (getattr(mask, field) or 0) + int(delta))
+        last_used = next(values)
+        if last_used is not None:
+            mask.last_used_at = datetime.fromtimestamp(float(last_used), timezone.utc)
+        setattr(mask, "_pending_added", True)
+
+
+def get_pending_mask_totals(
+    relay_address_ids: Iterable[int], domain_address_ids: Iterable[int]
+) -> dict[str, int]:
+    """Get the sums of the increments that are not yet flushed for the masks."""
+    totals = dict.fromkeys(MASK_COUNTERS, 0)
+    if not settings.MASK_COUNTERS_WRITE_BEHIND:
+        return totals
+    keys = [
+        (field, _field_key(model_name, mask_id, field))
+        for model_name, mask_ids in (
+            ("relayaddress", relay_address_ids),
+            ("domainaddress", domain_address_ids),
+        )
+        for mask_id in mask_ids
+        for field in MASK_COUNTERS
+    ]
+    if not keys:
+        return totals
+    values = get_redis_connection("default").hmget(
+        MASK_COUNTERS_KEY, [key for _, key in keys]
+    )
+    for (field, _), delta in zip(keys, values):
+        if delta is not None:
+            totals[field] += int(delta)
+    return totals
+
+
+def flush_mask_counters() -> int:
+    """
+    Add the pending counters to the database.
+
+    The pending counters are renamed to a unique key, so that new increments go
+    to a new hash. Only one flush runs at a time, so a renamed hash left by a
+    flush that stopped before it finished is flushed first. If the database
+    update fails, the counters are restored to the pending hash.
+
+    Returns the number of masks with pending counters, or 0 if another flush
+    is running.
+    """
+    redis = get_redis_connection("default")
+    lock = redis.lock(_FLUSH_LOCK_KEY, timeout=_FLUSH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        # Left by a flush that stopped before it finished
+        left_keys = list(redis.scan_iter(f"{MASK_COUNTERS_KEY}.flushing.*"))
+        num_masks = sum(_flush_counters_hash(redis, key.decode()) for key in left_keys)
+        flushing_key = f"{MASK_COUNTERS_KEY}.flushing.{uuid4().hex}"
+        try:
+            redis.rename(MASK_COUNTERS_KEY, flushing_key)
+        except ResponseError:
+            # There are no new pending counters
+            return num_masks
+        return num_masks + _flush_counters_hash(redis, flushing_key)
+    finally:
+        lock.release()
+
+
+def _flush_counters_hash(redis, flushing_key: str) -> int:
+    """Add the counters in a renamed hash to the database, then delete it."""
+    pending: PendingCounters = defaultdict(dict)
+    for key, value in redis.hgetall(flushing_key).items():
+        model_name, mask_id, field = key.decode().split(":")
+        pending[(model_name, int(mask_id))][field] = float(value)
+
+    try:
+        _update_mask_counters(pending)
+    except Exception:
+        with redis.pipeline() as pipe:
+            for (model_name, mask_id), values in pending.items():
+                for field, value in values.items():
+                    key = _field_key(model_name, mask_id, field)
+                    if field == "last_used_at":
+                        pipe.hsetnx(MASK_COUNTERS_KEY, key, value)
+                    else:
+                        pipe.hincrby(MASK_COUNTERS_KEY, key, int(value))
+            pipe.delete(flushing_key)
+            pipe.execute()
+        raise
+    redis.delete(flushing_key)
+    return len(pending)
+
+
+def _update_mask_counters(pending: PendingCounters) -> None:
+    """Update masks with the same increments with one UPDATE per batch."""
+    groups: dict[tuple[str, tuple[tuple[str, int], ...]], dict[int, float | None]]
+    groups = defaultdict(dict)
+    for (model_name, mask_id), values in pending.items():
+        increments = tuple(
+            sorted(
+                (field, int(value))
+                for field, value in values.items()
+                if field in MASK_COUNTERS
+            )
+        )
+        groups[(model_name, increments)][mask_id] = values.get("last_used_at")
+
+    with transaction.atomic():
+        for (model_name, increments), last_used_by_id in groups.items():
+            mask_ids = list(last_used_by_id)
+            for start in range(0, len(mask_ids), _FLUSH_BATCH_SIZE):
+                batch = mask_ids[start : start + _FLUSH_BATCH_SIZE]
+                updates: dict[str, object] = {
+                    field: Coalesce(F(field), 0) + delta for field, delta in increments
+                }
+                last_used_whens = [
+                    When(
+                        id=mask_id,
+                        then=Value(datetime.fromtimestamp(timestamp, timezone.utc)),
+                    )
+                    for mask_id in batch
+                    if (timestamp := last_used_by_id[mask_id]) is not None
+                ]
+                if last_used_whens:
+                    updates["last_used_at"] = Case(
+                        *last_used_whens, default=F("last_used_at")
+                    )
+                _MASK_MODELS[model_name].objects.filter(id__in=batch).update(**updates)
+
+
+ABUSE_METRICS_KEY = "emails.abuse_metrics"
+ABUSE_METRICS = (
+    "num_address_created_per_day",
+    "num_replies_per_day",
+    "num_email_forwarded_per_day",
+    "forwarded_email_size_per_day",
+)
+# Keep the counters of a day until the day after, for persist_abuse_metrics
+_ABUSE_METRICS_TIMEOUT = int(timedelta(days=2).total_seconds())
+
+
+def _abuse_metrics_key(day: date, user_id: int | None = None) -> str:
+    """Get the key of a user's abuse metrics, or of the users with metrics."""
+    suffix = "users" if user_id is None else str(user_id)
+    return f"{ABUSE_METRICS_KEY}:{day.isoformat()}:{suffix}"
+
+
+def increment_abuse_metrics(
+    user_id: int,
+    *,
+    address_created: bool = False,
+    replied: bool = False,
+    email_forwarded: bool = False,
+    forwarded_email_size: int = 0,
+) -> AbuseMetrics:
+    """
+    Increment the abuse metrics of a user for the current UTC day.
+
+    Returns an unsaved AbuseMetrics with the totals for the day.
+    """
+    day = datetime.now(timezone.utc).date()
+    key = _abuse_metrics_key(day, user_id)
+    users_key = _abuse_metrics_key(day)
+    increments = (
+        int(address_created),
+        int(replied),
+        int(email_forwarded),
+        max(forwarded_email_size, 0),
+    )
+    with get_redis_connection("default").pipeline() as pipe:
+        for field, delta in zip(ABUSE_METRICS, increments):
+            pipe.hincrby(key, field, delta)
+        pipe.expire(key, _ABUSE_METRICS_TIMEOUT)
+        pipe.sadd(users_key, user_id)
+        pipe.expire(users_key, _ABUSE_METRICS_TIMEOUT)
+        totals = pipe.execute()[: len(ABUSE_METRICS)]
+    return AbuseMetrics(user_id=user_id, **dict(zip(ABUSE_METRICS, totals)))
+
+
+def persist_abuse_metrics() -> int:
+    """
+    Save the abuse metrics of the current and previous UTC days to AbuseMetrics.
+
+    The Redis totals replace the saved values, so this can run any number of
+    times a day. The previous day is saved again, so that the counts after the
+    last run of that day are saved. AbuseMetrics from before the previous day
+    are deleted.
+
+    Returns the number of users with abuse metrics today.
+    """
+    now = datetime.now(timezone.utc)
+    yesterday = now.date() - timedelta(days=1)
+    redis = get_redis_connection("default")
+    with transaction.atomic():
+        _persist_day_abuse_metrics(redis, yesterday, now)
+        user_ids = _persist_day_abuse_metrics(redis, now.date(), now)
+        AbuseMetrics.objects.filter(
+            first_recorded__lt=_start_of_day(yesterday)
+        ).delete()
+    return len(user_ids)
+
+
+def _start_of_day(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time(), timezone.utc)
+
+
+def _persist_day_abuse_metrics(redis: Redis, day: date, now: datetime) -> list[int]:
+    """Save the abuse metrics of a UTC day, returning the ids of the users."""
+    day_start = _start_of_day(day)
+    user_ids = sorted(
+        int(user_id) for user_id in redis.smembers(_abuse_metrics_key(day))
+    )
+    user_ids = list(User.objects.filter(id__in=user_ids).values_list("id", flat=True))
+    with redis.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            pipe.hgetall(_abuse_metrics_key(day, user_id))
+        all_totals = pipe.execute()
+
+    saved = {
+        abuse_metric.user_id: abuse_metric
+        for abuse_metric in AbuseMetrics.objects.filter(
+            user_id__in=user_ids,
+            first_recorded__gte=day_start,
+            first_recorded__lt=day_start + timedelta(days=1),
+        )
+    }
+    new_metrics = []
+    for user_id, totals in zip(user_ids, all_totals):
+        abuse_metric = saved.get(user_id)
+        if abuse_metric is None:
+            abuse_metric = AbuseMetrics(user_id=user_id)
+            new_metrics.append(abuse_metric)
+        for field in ABUSE_METRICS:
+            setattr(abuse_metric, field, int(totals.get(field.encode(), 0)))
+        abuse_metric.last_recorded = now
+
+    AbuseMetrics.objects.bulk_create(new_metrics)
+    if new_metrics and day != now.date():
+        # first_recorded is set to the current time on create
+        AbuseMetrics.objects.filter(
+            user_id__in=[abuse_metric.user_id for abuse_metric in new_metrics],
+            first_recorded__gte=now,
+        ).update(first_recorded=day_start)
+    AbuseMetrics.objects.bulk_update(saved.values(), [*ABUSE_METRICS, "last_recorded"])
+    return user_ids
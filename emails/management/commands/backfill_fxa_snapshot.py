@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from emails.models import Profile, iter_profile_batches, store_fxa_snapshots
+
+
+class Command(BaseCommand):
+    help = (
+        "Store the snapshot of the Mozilla account entitlements, language, and uid"
+        " for profiles without one."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help=(
+                "Update every profile, for example after changing the"
+                " subscriptions or languages in the settings"
+            ),
+        )
+        parser.add_argument(
+            "--batch-size",
+            default=1000,
+            type=int,
+            help="Profiles updated per query",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("The batch size must be positive.")
+
+        profiles = Profile.objects.all()
+        if not options["all"]:
+            profiles = profiles.filter(fxa_snapshot__isnull=True)
+        num_updated = 0
+        for batch in iter_profile_batches(profiles, batch_size):
+            store_fxa_snapshots(batch)
+            num_updated += len(batch)
+        print(f"Stored the Mozilla account snapshot of {num_updated} profiles")
@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from emails.models import Profile
+
+
+class Command(BaseCommand):
+    help = "Clears the bounces of profiles that are no longer paused."
+
+    def handle(self, *args, **options):
+        now = datetime.now(timezone.utc)
+        hard_bounces_cleared = Profile.objects.filter(
+            last_hard_bounce__lte=now
+            - timedelta(days=settings.HARD_BOUNCE_ALLOWED_DAYS)
+        ).update(last_hard_bounce=None)
+        soft_bounces_cleared = Profile.objects.filter(
+            last_soft_bounce__lte=now
+            - timedelta(days=settings.SOFT_BOUNCE_ALLOWED_DAYS)
+        ).update(last_soft_bounce=None)
+        print(
+            f"Cleared {hard_bounces_cleared} hard bounces and "
+            f"{soft_bounces_cleared} soft bounces"
+        )
@@ -1,7 +1,7 @@
 from datetime import datetime, timedelta, timezone
+import time
 
-from django.db import transaction
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from ...models import Reply
 
@@ -11,13 +11,36 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("days_old", nargs=1, type=int)
+        parser.add_argument(
+            "--chunk-size",
+            default=10_000,
+            type=int,
+            help="Reply records deleted per query",
+        )
+        parser.add_argument(
+            "--sleep",
+            default=0.1,
+            type=float,
+            help="Seconds to wait between chunks, to limit the database load",
+        )
 
     def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        if chunk_size < 1:
+            raise CommandError("The chunk size must be positive.")
         delete_date = datetime.now(timezone.utc) - timedelta(options["days_old"][0])
-        replies_to_delete = Reply.objects.filter(created_at__lt=delete_date).only("id")
-        print(
-            f"Deleting {len(replies_to_delete)} reply records "
-            f"older than {delete_date}"
-        )
-        with transaction.atomic():
-            replies_to_delete.delete()
+        replies_to_delete = Reply.objects.filter(created_at__lt=delete_date)
+        total = replies_to_delete.count()
+        print(f"Deleting {total} reply records older than {delete_date}")
+
+        # Delete in short transactions, oldest first, using the created_at index
+        deleted = 0
+        while chunk := list(
+            replies_to_delete.order_by("created_at").values_list("id", flat=True)[
+                :chunk_size
+            ]
+        ):
+            deleted += Reply.objects.filter(id__in=chunk).delete()[0]
+            print(f"Deleted {deleted} of {total} reply records")
+            if options["sleep"]:
+                time.sleep(options["sleep"])
@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from emails.counters import flush_mask_counters
+
+
+class Command(BaseCommand):
+    help = "Add the pending mask counters in Redis to the database."
+
+    def handle(self, *args, **options):
+        if not settings.MASK_COUNTERS_WRITE_BEHIND:
+            raise CommandError("Mask counters are written to the database directly.")
+        num_masks = flush_mask_counters()
+        print(f"Flushed pending counters for {num_masks} masks")
@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from emails.counters import persist_abuse_metrics
+
+
+class Command(BaseCommand):
+    help = "Save today's abuse metrics in Redis to AbuseMetrics, for auditing."
+
+    def handle(self, *args, **options):
+        if not settings.ABUSE_METRICS_WRITE_BEHIND:
+            raise CommandError("Abuse metrics are written to the database directly.")
+        num_users = persist_abuse_metrics()
+        print(f"Saved abuse metrics for {num_users} users")
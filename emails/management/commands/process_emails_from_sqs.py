@@ -25,9 +25,10 @@ import OpenSSL
 
 from django.core.management.base import CommandError
 
+from emails.reply_buffer import buffer_reply_records, flush_reply_records
 from emails.sns import verify_from_sns
 from emails.views import _sns_inbound_logic, validate_sns_arn_and_type
-from emails.utils import incr_if_enabled, gauge_if_enabled
+from emails.utils import incr_if_enabled, gauge_if_enabled, record_stage_timings
 from emails.management.command_from_django_settings import (
     CommandFromDjangoSettings,
     SettingToLocal,
@@ -123,7 +124,8 @@ class Command(CommandFromDjangoSettings):
         except ClientError as e:
             raise CommandError("Unable to connect to SQS") from e
 
-        process_data = self.process_queue()
+        with buffer_reply_records():
+            process_data = self.process_queue()
         logger.info("Exiting process_emails_from_sqs", extra=process_data)
 
     def init_locals(self):
@@ -186,6 +188,8 @@ class Command(CommandFromDjangoSettings):
                 with Timer(logger=None) as cycle_timer:
                     message_batch, cycle_data = self.poll_queue_for_messages()
                     cycle_data.update(self.process_message_batch(message_batch))
+                    if reply_records := flush_reply_records():
+                        cycle_data["reply_records"] = reply_records
 
                 # Collect data and log progress
                 self.total_messages += len(message_batch)
@@ -313,7 +317,7 @@ class Command(CommandFromDjangoSettings):
         process_time = 0.0
         for message in message_batch:
             self.write_healthcheck()
-            with Timer(logger=None) as message_timer:
+            with Timer(logger=None) as message_timer, record_stage_timings() as timings:
                 message_data = self.process_message(message)
                 if not message_data["success"]:
                     failed_count += 1
@@ -323,6 +327,9 @@ class Command(CommandFromDjangoSettings):
                 pause_count += message_data.get("pause_count", 0)
 
             message_data["message_process_time_s"] = round(message_timer.last, 3)
+            if timings.seconds:
+                # Time spent in each stage of processing the email
+                message_data["stage_s"] = timings.log_data()
             process_time += message_timer.last
             logger.log(logging.INFO, "Message processed", extra=message_data)
 
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from emails.address_filter import build_address_filter, store_address_filter
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the filter of RelayAddresses used to reject email to unknown masks."
+        " Schedule more often than settings.ADDRESS_FILTER_MAX_AGE."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--error-rate",
+            default=0.001,
+            type=float,
+            help="Rate of unknown addresses that pass the filter",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.ADDRESS_FILTER_MAX_AGE:
+            raise CommandError("The address filter is disabled.")
+        error_rate = options["error_rate"]
+        if not 0.0 < error_rate < 1.0:
+            raise CommandError("The error rate must be between 0 and 1.")
+
+        address_filter = build_address_filter(error_rate)
+        store_address_filter(address_filter)
+        relay_size = len(address_filter.relay_addresses.bits)
+        deleted_size = len(address_filter.deleted_addresses.bits)
+        print(
+            f"Stored address filter built at {address_filter.built_at}, "
+            f"{relay_size + deleted_size} bytes"
+        )
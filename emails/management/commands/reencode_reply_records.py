@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from emails.models import Reply
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the lookup keys of Reply records to the binary format. The metadata"
+        " is encrypted again when a reply is sent, since the key is not stored."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            default=1000,
+            type=int,
+            help="Reply records updated per query",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.REPLY_RECORD_BINARY_FORMAT:
+            raise CommandError("The binary format for Reply records is disabled.")
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("The batch size must be positive.")
+
+        num_reencoded = 0
+        while batch := list(
+            Reply.objects.filter(lookup__isnull=False).only("id", "lookup")[:batch_size]
+        ):
+            for reply in batch:
+                reply.lookup_key = reply.raw_lookup_key
+                reply.lookup = None
+            Reply.objects.bulk_update(batch, ["lookup_key", "lookup"])
+            num_reencoded += len(batch)
+        print(f"Moved the lookup keys of {num_reencoded} reply records")
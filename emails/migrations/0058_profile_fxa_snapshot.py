@@ -0,0 +1,42 @@
+# Generated by Django 3.2.20 on 2026-10-19 10:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("emails", "0057_profile_sent_welcome_email"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FxaSnapshot",
+            fields=[
+                (
+                    "profile",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="fxa_snapshot",
+                        serialize=False,
+                        to="emails.profile",
+                    ),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "fxa_uid",
+                    models.CharField(
+                        blank=True, db_index=True, default="", max_length=191
+                    ),
+                ),
+                (
+                    "has_premium_subscription",
+                    models.BooleanField(db_index=True, default=False),
+                ),
+                ("has_phone_subscription", models.BooleanField(default=False)),
+                ("has_vpn_subscription", models.BooleanField(default=False)),
+                ("fxa_language", models.CharField(default="en", max_length=15)),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.20 on 2026-10-19 10:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("emails", "0058_profile_fxa_snapshot"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="reply",
+            name="lookup_key",
+            field=models.BinaryField(db_index=True, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name="reply",
+            name="metadata",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="reply",
+            name="encrypted_metadata",
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="reply",
+            name="lookup",
+            field=models.CharField(
+                blank=True, db_index=True, max_length=255, null=True
+            ),
+        ),
+    ]
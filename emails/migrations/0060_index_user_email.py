@@ -0,0 +1,52 @@
+from django.db import migrations
+
+
+def create_index_forward_func(apps, schema_editor):
+    """
+    Add an index on auth_user.email, used by SES bounce and complaint
+    notifications to find users by email address.
+
+    The auth_user table belongs to django.contrib.auth, so the index is added
+    here with SQL. In PostgreSQL, it is built CONCURRENTLY, so that writes to
+    the users table are not locked while the index builds.
+    """
+    if schema_editor.connection.vendor.startswith("postgres"):
+        schema_editor.execute(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS "emails_auth_user_email_idx"'
+            ' ON "auth_user" ("email");'
+        )
+    elif schema_editor.connection.vendor.startswith("sqlite"):
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS "emails_auth_user_email_idx"'
+            ' ON "auth_user" ("email");'
+        )
+    else:
+        raise Exception(f'Unknown database vendor "{schema_editor.connection.vendor}"')
+
+
+def drop_index_reverse_func(apps, schema_editor):
+    if schema_editor.connection.vendor.startswith("postgres"):
+        schema_editor.execute(
+            'DROP INDEX CONCURRENTLY IF EXISTS "emails_auth_user_email_idx";'
+        )
+    elif schema_editor.connection.vendor.startswith("sqlite"):
+        schema_editor.execute('DROP INDEX IF EXISTS "emails_auth_user_email_idx";')
+    else:
+        raise Exception(f'Unknown database vendor "{schema_editor.connection.vendor}"')
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can not run in a transaction
+    atomic = False
+
+    dependencies = [
+        ("emails", "0059_reply_binary_format"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            code=create_index_forward_func,
+            reverse_code=drop_index_reverse_func,
+            elidable=True,
+        ),
+    ]
@@ -1,7 +1,8 @@
 from collections import namedtuple
 from datetime import datetime, timedelta, timezone
 from hashlib import sha256
-from typing import Optional
+from typing import Any, Iterable, Iterator, Optional, TYPE_CHECKING
+import base64
 import logging
 import random
 import re
@@ -29,6 +30,9 @@ from privaterelay.utils import (
     guess_country_from_accept_lang,
 )
 
+if TYPE_CHECKING:
+    from allauth.socialaccount.models import SocialAccount
+
 
 emails_config = apps.get_app_config("emails")
 logger = logging.getLogger("events")
@@ -49,6 +53,92 @@ def get_domains_from_settings():
 
 DOMAIN_CHOICES = [(1, "RELAY_FIREFOX_DOMAIN"), (2, "MOZMAIL_DOMAIN")]
 PREMIUM_DOMAINS = ["mozilla.com", "getpocket.com", "mozillafoundation.org"]
+# FxaSnapshot fields with the data of the Mozilla account, see get_fxa_snapshot()
+FXA_SNAPSHOT_FIELDS = (
+    "fxa_uid",
+    "has_premium_subscription",
+    "has_phone_subscription",
+    "has_vpn_subscription",
+    "fxa_language",
+)
+
+
+def get_fxa_language(locale: Optional[str]) -> str:
+    if locale:
+        for accept_lang, _ in parse_accept_lang_header(locale):
+            try:
+                return get_supported_language_variant(accept_lang)
+            except LookupError:
+                continue
+    return "en"
+
+
+def get_fxa_snapshot(fxa: Optional["SocialAccount"]) -> dict[str, Any]:
+    """
+    Get the FxaSnapshot fields with the entitlements, language, and uid of a
+    Mozilla account, so they are not computed from extra_data on every access.
+    """
+    if fxa is None:
+        return {
+            "fxa_uid": "",
+            "has_premium_subscription": False,
+            "has_phone_subscription": False,
+            "has_vpn_subscription": False,
+            "fxa_language": "en",
+        }
+    subscriptions = fxa.extra_data.get("subscriptions", [])
+    return {
+        "fxa_uid": fxa.uid,
+        "has_premium_subscription": any(
+            sub in subscriptions for sub in settings.SUBSCRIPTIONS_WITH_UNLIMITED
+        ),
+        "has_phone_subscription": any(
+            sub in subscriptions for sub in settings.SUBSCRIPTIONS_WITH_PHONE
+        ),
+        "has_vpn_subscription": any(
+            sub in subscriptions for sub in settings.SUBSCRIPTIONS_WITH_VPN
+        ),
+        "fxa_language": get_fxa_language(fxa.extra_data.get("locale")),
+    }
+
+
+def iter_profile_batches(
+    profiles: "models.QuerySet[Profile]", batch_size: int
+) -> Iterator[list["Profile"]]:
+    """Get batches of the profiles, with the snapshots and SocialAccounts."""
+    last_id = 0
+    profiles = profiles.select_related("user", "fxa_snapshot").prefetch_related(
+        "user__socialaccount_set"
+    )
+    while batch := list(profiles.filter(id__gt=last_id).order_by("id")[:batch_size]):
+        yield batch
+        last_id = batch[-1].id
+
+
+def store_fxa_snapshots(profiles: list["Profile"]) -> None:
+    """
+    Store the current snapshot of the Mozilla account of each profile, loaded
+    with iter_profile_batches().
+    """
+    now = datetime.now(timezone.utc)
+    new_snapshots = []
+    changed_snapshots = []
+    for profile in profiles:
+        snapshot = get_fxa_snapshot(profile.fxa)
+        try:
+            fxa_snapshot = profile.fxa_snapshot
+        except FxaSnapshot.DoesNotExist:
+            new_snapshots.append(FxaSnapshot(profile=profile, **snapshot))
+            continue
+        for field, value in snapshot.items():
+            setattr(fxa_snapshot, field, value)
+        fxa_snapshot.updated_at = now
+        changed_snapshots.append(fxa_snapshot)
+    # A snapshot stored by the SocialAccount signal since loading is kept
+    FxaSnapshot.objects.bulk_create(new_snapshots, ignore_conflicts=True)
+    FxaSnapshot.objects.bulk_update(
+        changed_snapshots, FXA_SNAPSHOT_FIELDS + ("updated_at",)
+    )
 
 
 def valid_available_subdomain(subdomain, *args, **kwargs):
@@ -87,7 +177,63 @@ def default_domain_numerical():
     return get_domain_numerical(domain)
 
 
-class Profile(models.Model):
+class TrackedFieldsModel(models.Model):
+    """
+    A model that keeps the database values of its tracked_fields.
+
+    The values are kept when an instance is loaded, refreshed, or saved, so
+    that has_changed() detects a change without querying the database.
+    """
+
+    tracked_fields: tuple[str, ...] = ()
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._keep_tracked_values(field_names)
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._keep_tracked_values(fields)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._keep_tracked_values(kwargs.get("update_fields"))
+
+    def _keep_tracked_values(self, field_names: Iterable[str] | None) -> None:
+        tracked_values = self.__dict__.setdefault("_tracked_values", {})
+        for field in self.tracked_fields:
+            # Deferred fields are not in __dict__, and are not loaded here
+            if (field_names is None or field in field_names) and field in self.__dict__:
+                tracked_values[field] = self.__dict__[field]
+
+    def has_changed(self, field: str) -> bool:
+        """Return True if a tracked field changed since loaded or saved."""
+        if field not in self.tracked_fields:
+            raise ValueError(f"{field} is not a tracked field")
+        if self._state.adding:
+            return True
+        tracked_values = self.__dict__.get("_tracked_values", {})
+        if field in tracked_values:
+            saved_value = tracked_values[field]
+        else:
+            # The field was deferred, or the instance was not loaded
+            saved_values = (
+                type(self)
+                ._default_manager.filter(pk=self.pk)
+                .values_list(field, flat=True)
+            )
+            if not saved_values:
+                return True
+            saved_value = saved_values[0]
+        return bool(getattr(self, field) != saved_value)
+
+
+class Profile(TrackedFieldsModel):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     api_token = models.UUIDField(default=uuid.uuid4)
     num_address_deleted = models.PositiveIntegerField(default=0)
@@ -131,6 +277,12 @@ class Profile(models.Model):
     created_by = models.CharField(blank=True, null=True, max_length=63)
     sent_welcome_email = models.BooleanField(default=False)
 
+    tracked_fields = (
+        "remove_level_one_email_trackers",
+        "server_storage",
+        "store_phone_log",
+    )
+
     def __str__(self):
         return "%s Profile" % self.user
 
@@ -140,36 +292,51 @@ class Profile(models.Model):
         # CharField to validate constraints on the field update too
         if self.subdomain and not self.subdomain.islower():
             self.subdomain = self.subdomain.lower()
+        # Checked before saving, when the saved values are still tracked
+        clear_server_storage = self._is_turned_off("server_storage", kwargs)
+        clear_phone_log = settings.PHONES_ENABLED and self._is_turned_off(
+            "store_phone_log", kwargs
+        )
         ret = super().save(*args, **kwargs)
-        # any time a profile is saved with server_storage False, delete the
-        # appropriate server-stored Relay address data.
-        if not self.server_storage:
+        # when server_storage is turned off, delete the appropriate
+        # server-stored Relay address data.
+        if clear_server_storage:
             relay_addresses = RelayAddress.objects.filter(user=self.user)
             relay_addresses.update(description="", generated_for="", used_on="")
-        if settings.PHONES_ENABLED:
-            # any time a profile is saved with store_phone_log False, delete the
-            # appropriate server-stored InboundContact records
-            from phones.models import InboundContact, RelayNumber
-
-            if not self.store_phone_log:
-                try:
-                    relay_number = RelayNumber.objects.get(user=self.user)
-                    InboundContact.objects.filter(relay_number=relay_number).delete()
-                except RelayNumber.DoesNotExist:
-                    pass
+        if clear_phone_log:
+            # when store_phone_log is turned off, delete the appropriate
+            # server-stored InboundContact records
+            from phones.models import InboundContact
+
+            InboundContact.objects.filter(relay_number__user=self.user).delete()
         return ret
 
+    def _is_turned_off(self, field: str, save_kwargs: dict[str, Any]) -> bool:
+        """Return True if save() turns off a setting of an existing profile."""
+        update_fields = save_kwargs.get("update_fields")
+        return (
+            not self._state.adding
+            and not getattr(self, field)
+            and (update_fields is None or field in update_fields)
+            and self.has_changed(field)
+        )
+
+    def update_fxa_snapshot(self, fxa: Optional["SocialAccount"]) -> None:
+        """Store the snapshot of the Mozilla account, or of no account if None."""
+        self.fxa_snapshot, _ = FxaSnapshot.objects.update_or_create(
+            profile=self, defaults=get_fxa_snapshot(fxa)
+        )
+
+    def _get_fxa_snapshot(self) -> "FxaSnapshot":
+        try:
+            return self.fxa_snapshot
+        except FxaSnapshot.DoesNotExist:
+            # Until backfilled, compute the snapshot from the SocialAccount
+            return FxaSnapshot(profile=self, **get_fxa_snapshot(self.fxa))
+
     @property
     def language(self):
-        if self.fxa and self.fxa.extra_data.get("locale"):
-            for accept_lang, _ in parse_accept_lang_header(
-                self.fxa.extra_data.get("locale")
-            ):
-                try:
-                    return get_supported_language_variant(accept_lang)
-                except LookupError:
-                    continue
-        return "en"
+        return self._get_fxa_snapshot().fxa_language
 
     # This method returns whether the locale associated with the user's Mozilla account
     # includes a country code from a Premium country. This is less accurate than using
@@ -214,22 +381,17 @@ class Profile(models.Model):
         return ra_count >= settings.MAX_NUM_FREE_ALIASES
 
     def check_bounce_pause(self):
-        if self.last_hard_bounce:
-            last_hard_bounce_allowed = datetime.now(timezone.utc) - timedelta(
-                days=settings.HARD_BOUNCE_ALLOWED_DAYS
-            )
-            if self.last_hard_bounce > last_hard_bounce_allowed:
-                return BounceStatus(True, "hard")
-            self.last_hard_bounce = None
-            self.save()
-        if self.last_soft_bounce:
-            last_soft_bounce_allowed = datetime.now(timezone.utc) - timedelta(
-                days=settings.SOFT_BOUNCE_ALLOWED_DAYS
-            )
-            if self.last_soft_bounce > last_soft_bounce_allowed:
-                return BounceStatus(True, "soft")
-            self.last_soft_bounce = None
-            self.save()
+        # Expired bounces are cleared by the clear_expired_bounces command, so
+        # that checking for a pause does not write to the database
+        now = datetime.now(timezone.utc)
+        if self.last_hard_bounce and self.last_hard_bounce > now - timedelta(
+            days=settings.HARD_BOUNCE_ALLOWED_DAYS
+        ):
+            return BounceStatus(True, "hard")
+        if self.last_soft_bounce and self.last_soft_bounce > now - timedelta(
+            days=settings.SOFT_BOUNCE_ALLOWED_DAYS
+        ):
+            return BounceStatus(True, "soft")
         return BounceStatus(False, "")
 
     @property
@@ -285,43 +447,34 @@ class Profile(models.Model):
 
     @property
     def has_premium(self):
+        fxa_snapshot = self._get_fxa_snapshot()
+        if not fxa_snapshot.fxa_uid:
+            return False
+        if fxa_snapshot.has_premium_subscription:
+            return True
         # FIXME: as we don't have all the tiers defined we are over-defining
         # this to mark the user as a premium user as well
-        if not self.fxa:
-            return False
         for premium_domain in PREMIUM_DOMAINS:
             if self.user.email.endswith(f"@{premium_domain}"):
                 return True
-        user_subscriptions = self.fxa.extra_data.get("subscriptions", [])
-        for sub in settings.SUBSCRIPTIONS_WITH_UNLIMITED:
-            if sub in user_subscriptions:
-                return True
         return False
 
     @property
     def has_phone(self):
-        if not self.fxa:
+        fxa_snapshot = self._get_fxa_snapshot()
+        if not fxa_snapshot.fxa_uid:
             return False
         if settings.RELAY_CHANNEL != "prod" and not settings.IN_PYTEST:
             if not flag_is_active_in_task("phones", self.user):
                 return False
         if flag_is_active_in_task("free_phones", self.user):
             return True
-        user_subscriptions = self.fxa.extra_data.get("subscriptions", [])
-        for sub in settings.SUBSCRIPTIONS_WITH_PHONE:
-            if sub in user_subscriptions:
-                return True
-        return False
+        return fxa_snapshot.has_phone_subscription
 
     @property
     def has_vpn(self):
-        if not self.fxa:
-            return False
-        user_subscriptions = self.fxa.extra_data.get("subscriptions", [])
-        for sub in settings.SUBSCRIPTIONS_WITH_VPN:
-            if sub in user_subscriptions:
-                return True
-        return False
+        fxa_snapshot = self._get_fxa_snapshot()
+        return bool(fxa_snapshot.fxa_uid) and fxa_snapshot.has_vpn_subscription
 
     @property
     def emails_forwarded(self):
@@ -399,31 +552,21 @@ class Profile(models.Model):
         email_forwarded=False,
         forwarded_email_size=0,
     ):
-        #  TODO: this should be wrapped in atomic to ensure race conditions are properly handled
-        # look for abuse metrics created on the same UTC date, regardless of time.
-        midnight_utc_today = datetime.combine(
-            datetime.now(timezone.utc).date(), datetime.min.time()
-        ).astimezone(timezone.utc)
-        midnight_utc_tomorow = midnight_utc_today + timedelta(days=1)
-        abuse_metric = self.user.abusemetrics_set.filter(
-            first_recorded__gte=midnight_utc_today,
-            first_recorded__lt=midnight_utc_tomorow,
-        ).first()
-        if not abuse_metric:
-            abuse_metric = AbuseMetrics.objects.create(user=self.user)
-            AbuseMetrics.objects.filter(first_recorded__lt=midnight_utc_today).delete()
-
-        # increment the abuse metric
-        if address_created:
-            abuse_metric.num_address_created_per_day += 1
-        if replied:
-            abuse_metric.num_replies_per_day += 1
-        if email_forwarded:
-            abuse_metric.num_email_forwarded_per_day += 1
-        if forwarded_email_size > 0:
-            abuse_metric.forwarded_email_size_per_day += forwarded_email_size
-        abuse_metric.last_recorded = datetime.now(timezone.utc)
-        abuse_metric.save()
+        if settings.ABUSE_METRICS_WRITE_BEHIND:
+            from .counters import increment_abuse_metrics
+
+            # count atomically in Redis, and only write when flagging
+            abuse_metric = increment_abuse_metrics(
+                self.user_id,
+                address_created=address_created,
+                replied=replied,
+                email_forwarded=email_forwarded,
+                forwarded_email_size=forwarded_email_size,
+            )
+        else:
+            abuse_metric = self._update_abuse_metric_in_db(
+                address_created, replied, email_forwarded, forwarded_email_size
+            )
 
         # check user should be flagged for abuse
         hit_max_create = False
@@ -454,7 +597,7 @@ class Profile(models.Model):
             self.last_account_flagged = datetime.now(timezone.utc)
             self.save()
             data = {
-                "uid": self.fxa.uid,
+                "uid": self._get_fxa_snapshot().fxa_uid,
                 "flagged": self.last_account_flagged.timestamp(),
                 "replies": abuse_metric.num_replies_per_day,
                 "addresses": abuse_metric.num_address_created_per_day,
@@ -465,6 +608,36 @@ class Profile(models.Model):
             abuse_logger.info("Abuse flagged", extra=data)
         return self.last_account_flagged
 
+    def _update_abuse_metric_in_db(
+        self, address_created, replied, email_forwarded, forwarded_email_size
+    ):
+        #  TODO: this should be wrapped in atomic to ensure race conditions are properly handled
+        # look for abuse metrics created on the same UTC date, regardless of time.
+        midnight_utc_today = datetime.combine(
+            datetime.now(timezone.utc).date(), datetime.min.time()
+        ).astimezone(timezone.utc)
+        midnight_utc_tomorow = midnight_utc_today + timedelta(days=1)
+        abuse_metric = self.user.abusemetrics_set.filter(
+            first_recorded__gte=midnight_utc_today,
+            first_recorded__lt=midnight_utc_tomorow,
+        ).first()
+        if not abuse_metric:
+            abuse_metric = AbuseMetrics.objects.create(user=self.user)
+            AbuseMetrics.objects.filter(first_recorded__lt=midnight_utc_today).delete()
+
+        # increment the abuse metric
+        if address_created:
+            abuse_metric.num_address_created_per_day += 1
+        if replied:
+            abuse_metric.num_replies_per_day += 1
+        if email_forwarded:
+            abuse_metric.num_email_forwarded_per_day += 1
+        if forwarded_email_size > 0:
+            abuse_metric.forwarded_email_size_per_day += forwarded_email_size
+        abuse_metric.last_recorded = datetime.now(timezone.utc)
+        abuse_metric.save()
+        return abuse_metric
+
     @property
     def is_flagged(self):
         if not self.last_account_flagged:
@@ -491,6 +664,33 @@ def copy_auth_token(sender, instance=None, created=False, **kwargs):
             Token.objects.create(user=instance.user, key=instance.api_token)
 
 
+class FxaSnapshot(models.Model):
+    """
+    Snapshot of the Mozilla account of a Profile, updated when the fxa
+    SocialAccount is saved or deleted.
+
+    It is stored apart from Profile, so that saving a Profile loaded before the
+    account changed does not undo the update. A Profile without a snapshot uses
+    the SocialAccount until backfilled with backfill_fxa_snapshot.
+    """
+
+    profile = models.OneToOneField(
+        Profile,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="fxa_snapshot",
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+    fxa_uid = models.CharField(blank=True, default="", max_length=191, db_index=True)
+    has_premium_subscription = models.BooleanField(default=False, db_index=True)
+    has_phone_subscription = models.BooleanField(default=False)
+    has_vpn_subscription = models.BooleanField(default=False)
+    fxa_language = models.CharField(default="en", max_length=15)
+
+    def __str__(self):
+        return f"{self.profile} FxaSnapshot"
+
+
 def address_hash(address, subdomain=None, domain=None):
     if not domain:
         domain = get_domains_from_settings()["MOZMAIL_DOMAIN"]
@@ -769,18 +969,22 @@ class DomainAddress(models.Model):
 
     def save(self, *args, **kwargs) -> None:
         user_profile = self.user.profile
-        if self._state.adding:
+        adding = self._state.adding
+        if adding:
             check_user_can_make_domain_address(user_profile)
             pattern_valid = valid_address_pattern(self.address)
             address_contains_badword = has_bad_words(self.address)
             if not pattern_valid or address_contains_badword:
                 raise DomainAddrUnavailableException(unavailable_address=self.address)
-            user_profile.update_abuse_metric(address_created=True)
         if not user_profile.has_premium:
             self.block_list_emails = False
         if not user_profile.server_storage:
             self.description = ""
-        return super().save(*args, **kwargs)
+        super().save(*args, **kwargs)
+        if adding:
+            # Only count the address once it exists, not when a concurrent
+            # request created it first
+            user_profile.update_abuse_metric(address_created=True)
 
     @property
     def user_profile(self):
@@ -856,10 +1060,29 @@ class Reply(models.Model):
     domain_address = models.ForeignKey(
         DomainAddress, on_delete=models.CASCADE, blank=True, null=True
     )
-    lookup = models.CharField(max_length=255, blank=False, db_index=True)
-    encrypted_metadata = models.TextField(blank=False)
+    # Base64 lookup key and JWE metadata, replaced by the binary format
+    lookup = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    encrypted_metadata = models.TextField(blank=True, null=True)
+    # Binary lookup key, and metadata encrypted with AES-GCM after a version byte
+    lookup_key = models.BinaryField(max_length=16, null=True, db_index=True)
+    metadata = models.BinaryField(null=True)
     created_at = models.DateField(auto_now_add=True, null=False, db_index=True)
 
+    @property
+    def raw_lookup_key(self) -> bytes:
+        if self.lookup_key is not None:
+            return bytes(self.lookup_key)
+        assert self.lookup is not None
+        return base64.urlsafe_b64decode(self.lookup)
+
+    @property
+    def stored_metadata(self) -> bytes | str:
+        """The encrypted metadata, binary or a JWE, see decrypt_reply_metadata."""
+        if self.metadata is not None:
+            return bytes(self.metadata)
+        assert self.encrypted_metadata is not None
+        return self.encrypted_metadata
+
     @property
     def address(self):
         return self.relay_address or self.domain_address
@@ -873,10 +1096,10 @@ class Reply(models.Model):
         return self.profile.has_premium
 
     def increment_num_replied(self):
+        from .counters import increment_mask_counters
+
         address = self.relay_address or self.domain_address
-        address.num_replied += 1
-        address.last_used_at = datetime.now(timezone.utc)
-        address.save(update_fields=["num_replied", "last_used_at"])
+        increment_mask_counters(address, num_replied=1, used=True)
         return address.num_replied
 
 
@@ -0,0 +1,130 @@
+"""
+Buffered inserts of Reply records in the process_emails_from_sqs worker.
+
+By default, a Reply record is inserted when an email is forwarded. With
+REPLY_RECORD_BUFFER_SIZE, the worker adds the records to a buffer instead, and
+inserts them with bulk_create when the buffer is full, at the end of each cycle,
+and when exiting. A record that is not yet inserted is in the default cache for
+REPLY_RECORD_BUFFER_TIMEOUT seconds, so a reply processed by any process finds
+it.
+
+The buffer never holds more than REPLY_RECORD_BUFFER_SIZE records, since a
+flush always empties it. A worker that is killed before flushing loses the
+records in its buffer, while the cache holds them.
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+import logging
+from typing import Any, Iterable, Iterator
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Reply
+
+logger = logging.getLogger("events")
+
+REPLY_BUFFER_CACHE_KEY = "emails.pending_reply"
+_REPLY_FIELDS = (
+    "lookup",
+    "encrypted_metadata",
+    "lookup_key",
+    "metadata",
+    "relay_address_id",
+    "domain_address_id",
+)
+
+_buffer: list[Reply] = []
+_enabled = False
+
+
+def _pending_key(lookup_key: bytes) -> str:
+    return f"{REPLY_BUFFER_CACHE_KEY}:{lookup_key.hex()}"
+
+
+@contextmanager
+def buffer_reply_records() -> Iterator[None]:
+    """Buffer the Reply records stored in the block, and flush them on exit."""
+    global _enabled
+    _enabled = bool(settings.REPLY_RECORD_BUFFER_SIZE)
+    try:
+        yield
+    finally:
+        _enabled = False
+        flush_reply_records()
+
+
+def add_reply_record(reply_record: Reply) -> None:
+    """Insert a Reply record, or add it to the buffer if buffering."""
+    if not _enabled:
+        reply_record.save()
+        return
+    fields: dict[str, Any] = {
+        field: getattr(reply_record, field) for field in _REPLY_FIELDS
+    }
+    cache.set(
+        _pending_key(reply_record.raw_lookup_key),
+        fields,
+        settings.REPLY_RECORD_BUFFER_TIMEOUT,
+    )
+    _buffer.append(reply_record)
+    if len(_buffer) >= settings.REPLY_RECORD_BUFFER_SIZE:
+        flush_reply_records()
+
+
+def flush_reply_records() -> int:
+    """
+    Insert the buffered Reply records.
+
+    If the bulk insert fails, the records are inserted one at a time, so that a
+    bad record, such as one for a mask deleted since it was buffered, does not
+    block the others. The records that still fail are logged and dropped, and
+    are found in the cache until they expire.
+
+    Returns the number of inserted records.
+    """
+    if not _buffer:
+        return 0
+    reply_records = _buffer[:]
+    _buffer.clear()
+    try:
+        with transaction.atomic():
+            Reply.objects.bulk_create(reply_records)
+    except Exception:
+        logger.exception(
+            "reply_buffer_flush_error", extra={"count": len(reply_records)}
+        )
+    else:
+        # The cached records expire, rather than being deleted, so that a reply
+        # that missed the database before the insert still finds them.
+        return len(reply_records)
+
+    inserted = 0
+    for reply_record in reply_records:
+        try:
+            with transaction.atomic():
+                reply_record.save()
+        except Exception:
+            logger.exception(
+                "reply_buffer_record_dropped",
+                extra={
+                    "relay_address_id": reply_record.relay_address_id,
+                    "domain_address_id": reply_record.domain_address_id,
+                },
+            )
+        else:
+            inserted += 1
+    return inserted
+
+
+def get_pending_reply_records(lookup_keys: Iterable[bytes]) -> dict[bytes, Reply]:
+    """Get the Reply records that are not yet inserted, by lookup key."""
+    if not settings.REPLY_RECORD_BUFFER_SIZE:
+        return {}
+    keys = {_pending_key(lookup_key): lookup_key for lookup_key in lookup_keys}
+    if not keys:
+        return {}
+    return {keys[key]: Reply(**fields) for key, fields in cache.get_many(keys).items()}
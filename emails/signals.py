@@ -1,13 +1,30 @@
+from datetime import datetime, timezone
+from functools import partial
 from hashlib import sha256
 import logging
 
+from django.conf import settings
 from django.contrib.auth.models import User
-
-from django.db.models.signals import post_save, pre_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
-from emails.models import Profile
-from emails.utils import incr_if_enabled, set_user_group
+from allauth.socialaccount.models import SocialAccount
+
+from emails.models import (
+    FxaSnapshot,
+    Profile,
+    RelayAddress,
+    get_domains_from_settings,
+    get_fxa_snapshot,
+)
+from emails.utils import (
+    AddressCacheRecord,
+    delete_cached_address,
+    incr_if_enabled,
+    set_cached_address,
+    set_user_group,
+)
 
 
 info_logger = logging.getLogger("eventsinfo")
@@ -25,14 +42,8 @@ def measure_feature_usage(sender, instance, **kwargs):
     if instance._state.adding:
         # if newly created Profile ignore the signal
         return
-    curr_profile = Profile.objects.get(id=instance.id)
-
     # measure tracker removal usage
-    changed_tracker_removal_setting = (
-        instance.remove_level_one_email_trackers
-        != curr_profile.remove_level_one_email_trackers
-    )
-    if changed_tracker_removal_setting:
+    if instance.has_changed("remove_level_one_email_trackers"):
         if instance.remove_level_one_email_trackers:
             incr_if_enabled("tracker_removal_enabled")
         if not instance.remove_level_one_email_trackers:
@@ -45,3 +56,53 @@ def measure_feature_usage(sender, instance, **kwargs):
                 "hashed_uid": sha256(instance.fxa.uid.encode("utf-8")).hexdigest(),
             },
         )
+
+
+@receiver(post_save, sender=RelayAddress)
+def invalidate_relay_address_cache(sender, instance, created, **kwargs):
+    if not created:
+        return
+    address, domain = instance.address, instance.domain_value
+    if settings.ADDRESS_FILTER_MAX_AGE:
+        # Replace a cached "unknown" resolution, and allow the new address until
+        # it is in the address filter of every process
+        record: AddressCacheRecord = {"state": "relay", "id": instance.id}
+        timeout = settings.ADDRESS_FILTER_MAX_AGE
+        on_commit = partial(set_cached_address, address, domain, record, timeout)
+    else:
+        # Clear a cached "unknown" resolution for the new address
+        on_commit = partial(delete_cached_address, address, domain)
+    # After commit, so that a concurrent lookup does not cache "unknown" again
+    transaction.on_commit(on_commit)
+
+
+@receiver(post_save, sender=Profile)
+def invalidate_subdomain_cache(sender, instance, update_fields=None, **kwargs):
+    # Clear a cached "no_subdomain" resolution for a newly claimed subdomain
+    if instance.subdomain and (update_fields is None or "subdomain" in update_fields):
+        mozmail_domain = get_domains_from_settings()["MOZMAIL_DOMAIN"]
+        transaction.on_commit(
+            partial(delete_cached_address, "", f"{instance.subdomain}.{mozmail_domain}")
+        )
+
+
+@receiver(post_save, sender=SocialAccount)
+def update_fxa_snapshot(sender, instance, **kwargs):
+    if instance.provider != "fxa":
+        return
+    try:
+        profile = instance.user.profile
+    except Profile.DoesNotExist:
+        return
+    profile.update_fxa_snapshot(instance)
+
+
+@receiver(post_delete, sender=SocialAccount)
+def clear_fxa_snapshot(sender, instance, **kwargs):
+    if instance.provider != "fxa":
+        return
+    # Only update, so no snapshot is created for a profile deleted with the user.
+    # A profile without a snapshot also finds no account.
+    FxaSnapshot.objects.filter(profile__user_id=instance.user_id).update(
+        updated_at=datetime.now(timezone.utc), **get_fxa_snapshot(None)
+    )
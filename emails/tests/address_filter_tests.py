@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from django.core.cache import cache
+
+from model_bakery import baker
+import pytest
+
+from emails.address_filter import (
+    AddressFilter,
+    BloomFilter,
+    build_address_filter,
+    clear_loaded_address_filter,
+    get_address_filter,
+    is_recent_relay_address,
+    store_address_filter,
+)
+from emails.models import DeletedAddress, RelayAddress, address_hash
+
+from .models_tests import make_free_test_user
+
+
+@pytest.fixture(autouse=True)
+def address_filter_settings(settings):
+    settings.ADDRESS_FILTER_MAX_AGE = 60 * 60
+    settings.ADDRESS_FILTER_RELOAD_INTERVAL = 60
+    cache.clear()
+    clear_loaded_address_filter()
+    yield settings
+    cache.clear()
+    clear_loaded_address_filter()
+
+
+def test_bloom_filter_has_no_false_negatives() -> None:
+    bloom_filter = BloomFilter.for_capacity(1000, 0.01)
+    keys = [f"address{i}@2" for i in range(1000)]
+    bloom_filter.update(keys)
+    assert all(key in bloom_filter for key in keys)
+
+
+def test_bloom_filter_error_rate() -> None:
+    bloom_filter = BloomFilter.for_capacity(1000, 0.01)
+    bloom_filter.update(f"address{i}@2" for i in range(1000))
+    false_positives = sum(f"unknown{i}@2" in bloom_filter for i in range(10_000))
+    assert false_positives < 200
+
+
+def test_bloom_filter_empty() -> None:
+    bloom_filter = BloomFilter.for_capacity(0, 0.01)
+    assert "address@2" not in bloom_filter
+
+
+@pytest.mark.django_db
+def test_build_address_filter() -> None:
+    user = make_free_test_user()
+    relay_address = baker.make(RelayAddress, user=user, address="relay123")
+    baker.make(
+        DeletedAddress, address_hash=address_hash("deleted456", domain="test.com")
+    )
+
+    address_filter = build_address_filter(0.001)
+    assert address_filter.may_be_relay_address("relay123", relay_address.domain)
+    assert not address_filter.may_be_relay_address("unknown", relay_address.domain)
+    assert address_filter.may_be_deleted_address(
+        address_hash("deleted456", domain="test.com")
+    )
+    assert not address_filter.may_be_deleted_address(
+        address_hash("unknown", domain="test.com")
+    )
+
+
+def make_address_filter(age: int = 0) -> AddressFilter:
+    built_at = datetime.now(timezone.utc) - timedelta(seconds=age)
+    return AddressFilter(
+        built_at, BloomFilter.for_capacity(1, 0.01), BloomFilter.for_capacity(1, 0.01)
+    )
+
+
+def test_get_address_filter_loads_stored_filter() -> None:
+    store_address_filter(make_address_filter())
+    address_filter = get_address_filter()
+    assert address_filter is not None
+    assert not address_filter.may_be_relay_address("unknown", 2)
+
+
+def test_get_address_filter_disabled(address_filter_settings) -> None:
+    store_address_filter(make_address_filter())
+    address_filter_settings.ADDRESS_FILTER_MAX_AGE = 0
+    assert get_address_filter() is None
+
+
+def test_get_address_filter_missing() -> None:
+    assert get_address_filter() is None
+
+
+def test_get_address_filter_too_old() -> None:
+    store_address_filter(make_address_filter(age=60 * 60 + 1))
+    assert get_address_filter() is None
+
+
+def test_get_address_filter_reloads_after_interval() -> None:
+    with patch("emails.address_filter.monotonic", return_value=100.0):
+        assert get_address_filter() is None
+    store_address_filter(make_address_filter())
+    with patch("emails.address_filter.monotonic", return_value=159.0):
+        assert get_address_filter() is None
+    with patch("emails.address_filter.monotonic", return_value=160.0):
+        assert get_address_filter() is not None
+
+
+@pytest.mark.django_db
+def test_is_recent_relay_address_polls_after_interval(
+    django_assert_num_queries,
+) -> None:
+    address_filter = build_address_filter(0.001)
+    with (
+        django_assert_num_queries(1),
+        patch("emails.address_filter.monotonic", return_value=100.0),
+    ):
+        assert not is_recent_relay_address(address_filter, "new123", 2)
+    relay_address = baker.make(
+        RelayAddress, user=make_free_test_user(), address="new123", domain=2
+    )
+    with (
+        django_assert_num_queries(0),
+        patch("emails.address_filter.monotonic", return_value=100.9),
+    ):
+        assert not is_recent_relay_address(address_filter, "new123", 2)
+    with patch("emails.address_filter.monotonic", return_value=101.0):
+        assert is_recent_relay_address(address_filter, "new123", 2)
+    with django_assert_num_queries(0):
+        assert is_recent_relay_address(address_filter, "new123", 2)
+    assert not address_filter.may_be_relay_address("new123", relay_address.domain)
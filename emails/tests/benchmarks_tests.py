@@ -0,0 +1,447 @@
+"""
+Benchmarks for the email processing code.
+
+These are skipped by default. To run them, set RUN_BENCHMARKS=True in the
+environment or .env file, and pass -s to see the reports:
+
+    RUN_BENCHMARKS=True pytest -s emails/tests/benchmarks_tests.py
+
+The email stage benchmarks are compared to the stored baseline in
+fixtures/benchmark_baseline.json, and fail if a time or peak memory is more than
+BENCHMARK_THRESHOLD times the baseline (default 1.5), or if the baseline has no
+entry for it. Times are divided by the time of a fixed calibration workload, so
+that the baseline can be shared between machines. To update the baseline after
+an intended change, check out the translations, which the convert and wrap
+stages need, and run:
+
+    git submodule update --init
+    RUN_BENCHMARKS=True BENCHMARK_UPDATE_BASELINE=True \\
+        pytest emails/tests/benchmarks_tests.py
+"""
+
+from datetime import datetime, timezone
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+from pathlib import Path
+from time import perf_counter
+from functools import partial
+from typing import Any, Callable, Iterator, NamedTuple, cast
+from unittest.mock import patch
+import json
+import tracemalloc
+
+from decouple import config
+import pytest
+
+from emails.types import OutgoingHeaders
+from emails.utils import (
+    email_message_as_bytes,
+    linkify_and_linebreaks,
+    remove_trackers,
+    urlize_and_linebreaks,
+)
+from emails.views import (
+    _convert_to_forwarded_email,
+    _replace_headers,
+    wrap_html_email,
+)
+
+from .views_tests import EMAIL_INCOMING
+
+RUN_BENCHMARKS = config("RUN_BENCHMARKS", False, cast=bool)
+BENCHMARK_THRESHOLD = config("BENCHMARK_THRESHOLD", 1.5, cast=float)
+BENCHMARK_UPDATE_BASELINE = config("BENCHMARK_UPDATE_BASELINE", False, cast=bool)
+BASELINE_PATH = Path(__file__).parent / "fixtures" / "benchmark_baseline.json"
+pytestmark = pytest.mark.skipif(not RUN_BENCHMARKS, reason="RUN_BENCHMARKS is False")
+
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    seconds: float
+    peak_bytes: int
+
+
+def run_benchmark(
+    name: str, func: Callable[[], object], rounds: int = 5
+) -> BenchmarkResult:
+    """
+    Run func several times, returning the best time and the peak memory allocated.
+
+    The peak memory is measured in a separate run, because tracemalloc slows down
+    the function being timed.
+    """
+    times = []
+    for _ in range(rounds):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return BenchmarkResult(name, min(times), peak_bytes)
+
+
+def report(title: str, results: list[BenchmarkResult]) -> None:
+    print(f"\n{title}")
+    for result in results:
+        print(
+            f"  {result.name:<24} {result.seconds * 1000:10.2f} ms"
+            f" {result.peak_bytes / 1024 / 1024:10.2f} MiB peak"
+        )
+
+
+def make_large_multipart_email(
+    text_size: int = 1_000_000,
+    attachment_count: int = 5,
+    attachment_size: int = 1_000_000,
+) -> EmailMessage:
+    """Create a multipart email with large text and HTML bodies and attachments."""
+    line = "The quick brown fox jumps over the lazy dog. Ça va? Ünïcödé ✓\n"
+    text = line * (text_size // len(line.encode()))
+    html = "<html><body>" + text.replace("\n", "<br>\n") + "</body></html>"
+
+    email = EmailMessage()
+    email["Subject"] = "A large email"
+    email["From"] = "sender@example.com"
+    email["To"] = "mask@relay.example.com"
+    email.set_content(text)
+    email.add_alternative(html, subtype="html")
+    for num in range(attachment_count):
+        email.add_attachment(
+            bytes(range(256)) * (attachment_size // 256),
+            maintype="application",
+            subtype="octet-stream",
+            filename=f"attachment{num}.bin",
+        )
+    return email
+
+
+@pytest.mark.parametrize("parsed", (True, False), ids=("parsed", "created"))
+def test_email_message_as_bytes(parsed: bool) -> None:
+    """
+    Compare email_message_as_bytes() to as_string() then encoding.
+
+    ses_send_raw_email used to pass as_string() to SES, and botocore encoded the str
+    to bytes before base64-encoding the request.
+
+    A forwarded email is parsed from the incoming bytes, and most parts are written
+    as they were received. A created email has 8bit parts that both methods convert
+    to base64 first.
+    """
+    email = make_large_multipart_email()
+    if parsed:
+        # Like most incoming emails, the parsed parts are 7bit-safe
+        email_bytes = email.as_string().encode("utf-8")
+        parsed_email = message_from_bytes(email_bytes, policy=policy.default)
+        assert isinstance(parsed_email, EmailMessage)
+        email = parsed_email
+    assert email_message_as_bytes(email) == email.as_string().encode("utf-8")
+
+    as_string = run_benchmark(
+        "as_string + encode", lambda: email.as_string().encode("utf-8")
+    )
+    as_bytes = run_benchmark(
+        "email_message_as_bytes", lambda: email_message_as_bytes(email)
+    )
+    report(
+        f"Serialize large multipart email ({'parsed' if parsed else 'created'})",
+        [as_string, as_bytes],
+    )
+
+    # Both keep about two copies of the email in memory, one in the generator
+    # buffers and one for the output.
+    assert as_bytes.peak_bytes < as_string.peak_bytes * 1.05
+    assert as_bytes.seconds < as_string.seconds
+
+
+def make_large_text(size: int = 1_000_000) -> str:
+    """Create newsletter-like plain text, with a link in each paragraph."""
+    paragraph = (
+        "The quick brown fox jumps over the lazy dog. It was the best of times, it\n"
+        'was the worst of times. Ünïcödé text, <angle brackets> & "quotes". The\n'
+        "rain in Spain stays mainly in the plain (or so they say). Lorem ipsum dolor\n"
+        "sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt.\n"
+        "Read more at https://example.com/news?id={num}&utm_source=newsletter.\n\n"
+    )
+    footer = "Questions? Email editor@example.com or visit www.example.org/help.\n"
+    paragraphs = []
+    length = len(footer)
+    num = 0
+    while length < size:
+        paragraphs.append(paragraph.format(num=num))
+        length += len(paragraphs[-1])
+        num += 1
+    return "".join(paragraphs) + footer
+
+
+def test_linkify_and_linebreaks() -> None:
+    """Compare linkify_and_linebreaks() to urlize_and_linebreaks() for a large text."""
+    text = make_large_text()
+    assert linkify_and_linebreaks(text) == urlize_and_linebreaks(text)
+
+    urlize = run_benchmark(
+        "urlize_and_linebreaks", lambda: urlize_and_linebreaks(text), rounds=2
+    )
+    linkify = run_benchmark(
+        "linkify_and_linebreaks", lambda: linkify_and_linebreaks(text)
+    )
+    report("Convert 1 MB of plain text to HTML", [urlize, linkify])
+
+    assert linkify.seconds < urlize.seconds / 3
+
+
+# Tracker domains for the email stage benchmarks, instead of the downloaded lists
+BENCHMARK_TRACKERS = [f"tracker{num}.example.com" for num in range(100)]
+
+
+def make_plain_text_email() -> bytes:
+    email = EmailMessage()
+    email["Subject"] = "A plain text email"
+    email["From"] = "sender@example.com"
+    email["To"] = "mask@relay.example.com"
+    email.set_content(make_large_text(200_000))
+    return email.as_bytes()
+
+
+def make_html_newsletter_email() -> bytes:
+    text = make_large_text(200_000)
+    html = "".join(
+        f"<p>{paragraph}</p>\n"
+        for paragraph in urlize_and_linebreaks(text).split("<br><br>")
+    )
+    email = EmailMessage()
+    email["Subject"] = "A large HTML newsletter"
+    email["From"] = "Newsletter <news@example.com>"
+    email["To"] = "mask@relay.example.com"
+    email["List-Unsubscribe"] = "<https://example.com/unsubscribe>"
+    email.set_content(text)
+    email.add_alternative(f"<html><body>{html}</body></html>", subtype="html")
+    return email.as_bytes()
+
+
+def make_many_attachments_email() -> bytes:
+    email = make_large_multipart_email(
+        text_size=10_000, attachment_count=20, attachment_size=200_000
+    )
+    return email.as_bytes()
+
+
+def make_many_trackers_email() -> bytes:
+    links = []
+    for num in range(500):
+        domain = BENCHMARK_TRACKERS[num % len(BENCHMARK_TRACKERS)]
+        links.append(
+            f'<p><a href="https://click.{domain}/c?id={num}">Link {num}</a>'
+            f'<img src="https://{domain}/open.gif?id={num}" width="1" height="1">'
+            f'<a href="https://example.com/article/{num}">Article {num}</a></p>\n'
+        )
+    email = EmailMessage()
+    email["Subject"] = "An email with many trackers"
+    email["From"] = "sender@example.com"
+    email["To"] = "mask@relay.example.com"
+    email.set_content("See the HTML version.")
+    email.add_alternative(
+        "<html><body>" + "".join(links) + "</body></html>", subtype="html"
+    )
+    return email.as_bytes()
+
+
+def make_legacy_charset_part(
+    text: str, charset: str, subtype: str, **kwargs: Any
+) -> EmailMessage:
+    part = EmailMessage()
+    part.set_content(
+        text.encode(charset),
+        maintype="text",
+        subtype=subtype,
+        cte="8bit",
+        params={"charset": charset},
+        **kwargs,
+    )
+    return part
+
+
+def make_non_utf8_email() -> bytes:
+    """Create an email with 8-bit text and HTML parts in legacy charsets."""
+    alternative = EmailMessage()
+    alternative.make_alternative()
+    alternative.attach(
+        make_legacy_charset_part(
+            "Ça coûte 10 francs, très cher.\n" * 5_000, "iso-8859-1", "plain"
+        )
+    )
+    html = "<p>Привет, как дела? Всё хорошо.</p>\n" * 5_000
+    alternative.attach(
+        make_legacy_charset_part(f"<html><body>{html}</body></html>", "koi8-r", "html")
+    )
+
+    email = EmailMessage()
+    email["Subject"] = "An email in legacy charsets"
+    email["From"] = "sender@example.com"
+    email["To"] = "mask@relay.example.com"
+    email.make_mixed()
+    email.attach(alternative)
+    email.attach(
+        make_legacy_charset_part(
+            "日本語のテキストです。\n" * 5_000,
+            "shift_jis",
+            "plain",
+            disposition="attachment",
+            filename="japanese.txt",
+        )
+    )
+    return email.as_bytes()
+
+
+# The synthetic emails, and the raw incoming email fixtures
+EMAIL_CORPUS: dict[str, Callable[[], bytes]] = {
+    "plain_text": make_plain_text_email,
+    "html_newsletter": make_html_newsletter_email,
+    "many_attachments": make_many_attachments_email,
+    "many_trackers": make_many_trackers_email,
+    "non_utf8": make_non_utf8_email,
+}
+EMAIL_CORPUS.update(
+    {
+        f"fixture_{name}": partial(str.encode, content)
+        for name, content in EMAIL_INCOMING.items()
+    }
+)
+EMAIL_STAGES = ("convert", "remove_trackers", "wrap", "replace_headers")
+BENCHMARK_HEADERS: OutgoingHeaders = {
+    "Subject": "A forwarded email",
+    "From": '"sender@example.com [via Relay]" <mask@relay.example.com>',
+    "To": "user@example.com",
+    "Reply-To": "replies@relay.example.com",
+    "Resent-From": "sender@example.com",
+}
+
+
+def calibrate() -> float:
+    """Time a fixed pure-Python workload, to scale times between machines."""
+
+    def workload() -> None:
+        words = [f"word{num}" for num in range(100_000)]
+        text = " ".join(words)
+        sorted(text.split(), key=len)
+
+    return run_benchmark("calibration", workload).seconds
+
+
+@pytest.fixture(scope="module")
+def benchmark_baseline() -> Iterator[dict[str, Any]]:
+    """
+    Load the stored baseline, and store the new results if requested.
+
+    The baseline has the calibration time, and the time (divided by the
+    calibration time) and peak memory for each email and stage.
+    """
+    baseline = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    results: dict[str, Any] = {"calibration_s": calibrate(), "results": {}}
+    baseline["new"] = results
+    yield baseline
+    if BENCHMARK_UPDATE_BASELINE:
+        stored = {"results": baseline.get("results", {})}
+        stored["results"].update(results["results"])
+        BASELINE_PATH.write_text(json.dumps(stored, indent=2, sort_keys=True) + "\n")
+
+
+def get_html_content(email_bytes: bytes) -> str | None:
+    email = message_from_bytes(email_bytes, policy=policy.default)
+    assert isinstance(email, EmailMessage)
+    html_body = email.get_body("html")
+    if html_body is None:
+        return None
+    assert isinstance(html_body, EmailMessage)
+    content = html_body.get_content()
+    assert isinstance(content, str)
+    return content
+
+
+def make_stage_func(stage: str, email_bytes: bytes, rounds: int) -> Callable[[], Any]:
+    """Return a function that runs a stage on an email."""
+    now = datetime(2023, 10, 1, tzinfo=timezone.utc)
+    if stage == "convert":
+        return lambda: _convert_to_forwarded_email(
+            incoming_email_bytes=email_bytes,
+            headers=BENCHMARK_HEADERS,
+            to_address="mask@relay.example.com",
+            from_address="sender@example.com",
+            language="en",
+            has_premium=True,
+            sample_trackers=False,
+            remove_level_one_trackers=True,
+            now=now,
+        )
+    if stage == "replace_headers":
+        # Headers are only dropped the first time, so use a new email each round
+        emails = [
+            cast(EmailMessage, message_from_bytes(email_bytes, policy=policy.default))
+            for _ in range(rounds + 1)
+        ]
+        return lambda: _replace_headers(emails.pop(), BENCHMARK_HEADERS)
+
+    content = get_html_content(email_bytes)
+    if content is None:
+        pytest.skip("No HTML content")
+    html_content = content
+    if stage == "remove_trackers":
+        return lambda: remove_trackers(
+            html_content, "sender@example.com", int(now.timestamp() * 1000)
+        )
+    assert stage == "wrap"
+    return lambda: wrap_html_email(
+        original_html=html_content,
+        language="en",
+        has_premium=True,
+        display_email="mask<span>@</span>relay<span>.</span>example<span>.</span>com",
+        num_level_one_email_trackers_removed=1,
+        tracker_report_link="https://relay.example.com/tracker-report/#{}",
+    )
+
+
+@pytest.mark.parametrize("stage", EMAIL_STAGES)
+@pytest.mark.parametrize("email_name", EMAIL_CORPUS.keys())
+@patch("emails.utils.strict_trackers", return_value=BENCHMARK_TRACKERS[:10])
+@patch("emails.utils.general_trackers", return_value=BENCHMARK_TRACKERS)
+def test_email_stage(
+    mock_general_trackers: Any,
+    mock_strict_trackers: Any,
+    email_name: str,
+    stage: str,
+    benchmark_baseline: dict[str, Any],
+    settings: Any,
+) -> None:
+    """Compare the time and peak memory of an email stage to the baseline."""
+    settings.SITE_ORIGIN = "https://relay.example.com"
+    settings.STATSD_ENABLED = False
+    rounds = 5
+    func = make_stage_func(stage, EMAIL_CORPUS[email_name](), rounds)
+    result = run_benchmark(f"{email_name}.{stage}", func, rounds=rounds)
+
+    new = benchmark_baseline["new"]
+    relative_time = result.seconds / new["calibration_s"]
+    new["results"][result.name] = {
+        "relative_time": round(relative_time, 3),
+        "peak_bytes": result.peak_bytes,
+    }
+    baseline = benchmark_baseline.get("results", {}).get(result.name)
+    report(f"Email stage {result.name}", [result])
+    if BENCHMARK_UPDATE_BASELINE:
+        return
+    assert baseline is not None, f"No baseline for {result.name}, update the baseline"
+    print(
+        f"  relative time {relative_time:.3f} (baseline"
+        f" {baseline['relative_time']:.3f}), peak {result.peak_bytes} bytes"
+        f" (baseline {baseline['peak_bytes']})"
+    )
+    # Very short stages are mostly noise, so they are allowed to vary more
+    assert relative_time <= max(baseline["relative_time"] * BENCHMARK_THRESHOLD, 0.1)
+    # Small allocations vary between runs and Python versions
+    assert result.peak_bytes <= max(
+        baseline["peak_bytes"] * BENCHMARK_THRESHOLD, 100_000
+    )
@@ -6,10 +6,18 @@ from django.contrib.auth.models import User
 from model_bakery import baker
 import pytest
 
-from emails.cleaners import ServerStorageCleaner, MissingProfileCleaner
-from emails.models import DomainAddress, RelayAddress
+from emails.cleaners import (
+    FxaSnapshotCleaner,
+    MissingProfileCleaner,
+    ServerStorageCleaner,
+)
+from emails.models import DomainAddress, FxaSnapshot, Profile, RelayAddress
 
-from .models_tests import make_premium_test_user, make_storageless_test_user
+from .models_tests import (
+    make_free_test_user,
+    make_premium_test_user,
+    make_storageless_test_user,
+)
 
 
 def setup_server_storage_test_data(
@@ -368,3 +376,52 @@ Users:
     # Check that all users have profiles
     for user in User.objects.all():
         assert user.profile
+
+
+@pytest.mark.django_db
+def test_fxa_snapshot_cleaner_no_data() -> None:
+    """FxaSnapshotCleaner works on an empty database."""
+    task = FxaSnapshotCleaner()
+    assert task.issues() == 0
+    assert task.counts == {
+        "summary": {"ok": 0, "needs_cleaning": 0},
+        "profiles": {"all": 0, "not_snapshot": 0, "stale_snapshot": 0},
+    }
+    assert task.clean() == 0
+    report = task.markdown_report()
+    expected = """\
+Profiles:
+  All: 0"""
+    assert report == expected
+
+
+@pytest.mark.django_db
+def test_fxa_snapshot_cleaner_with_problems() -> None:
+    """FxaSnapshotCleaner detects missing and stale snapshots, and can update them."""
+    make_free_test_user()
+    not_snapshot = make_premium_test_user().profile
+    stale = make_premium_test_user().profile
+    FxaSnapshot.objects.filter(profile=not_snapshot).delete()
+    FxaSnapshot.objects.filter(profile=stale).update(has_premium_subscription=False)
+
+    task = FxaSnapshotCleaner()
+    assert task.issues() == 2
+    assert task.counts == {
+        "summary": {"ok": 1, "needs_cleaning": 2},
+        "profiles": {"all": 3, "not_snapshot": 1, "stale_snapshot": 1},
+    }
+    report = task.markdown_report()
+    expected = """\
+Profiles:
+  All: 3
+    No Snapshot   : 1 ( 33.3%)
+    Stale Snapshot: 1 ( 33.3%)"""
+    assert report == expected
+
+    # Clean the data, check updates
+    assert task.clean() == 2
+    assert task.counts["profiles"]["cleaned"] == 2
+    for profile_id in (not_snapshot.id, stale.id):
+        fxa_snapshot = FxaSnapshot.objects.get(profile_id=profile_id)
+        assert fxa_snapshot.has_premium_subscription is True
+    assert FxaSnapshotCleaner().issues() == 0
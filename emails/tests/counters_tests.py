@@ -0,0 +1,356 @@
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatch
+from unittest.mock import patch
+
+from django.core.management import call_command, CommandError
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+
+from model_bakery import baker
+from redis.exceptions import ResponseError
+import pytest
+
+from emails.counters import (
+    MASK_COUNTERS_KEY,
+    _abuse_metrics_key,
+    add_pending_mask_counters,
+    flush_mask_counters,
+    get_pending_mask_totals,
+    increment_mask_counters,
+    persist_abuse_metrics,
+)
+from emails.models import AbuseMetrics, DomainAddress, RelayAddress
+
+from .models_tests import make_premium_test_user
+
+
+class FakeRedis:
+    """The Redis hash commands used by the mask counters."""
+
+    def __init__(self):
+        self.hashes: dict[str, dict[bytes, bytes]] = {}
+        self.sets: dict[str, set[bytes]] = {}
+        self.expires: dict[str, int] = {}
+
+    def hincrby(self, key, field, amount):
+        fields = self.hashes.setdefault(key, {})
+        value = int(fields.get(field.encode(), b"0")) + amount
+        fields[field.encode()] = str(value).encode()
+        return value
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field.encode()] = str(value).encode()
+
+    def hsetnx(self, key, field, value):
+        self.hashes.setdefault(key, {}).setdefault(field.encode(), str(value).encode())
+
+    def hmget(self, key, fields):
+        return [self.hashes.get(key, {}).get(field.encode()) for field in fields]
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def rename(self, src, dst):
+        if src not in self.hashes:
+            raise ResponseError("no such key")
+        self.hashes[dst] = self.hashes.pop(src)
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+
+    def scan_iter(self, match):
+        return (key.encode() for key in self.hashes if fnmatch(key, match))
+
+    def lock(self, name, timeout):
+        return FakeLock(self, name)
+
+    def sadd(self, key, member):
+        self.sets.setdefault(key, set()).add(str(member).encode())
+
+    def smembers(self, key):
+        return set(self.sets.get(key, set()))
+
+    def expire(self, key, seconds):
+        self.expires[key] = seconds
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakeLock:
+    def __init__(self, redis, name):
+        self.redis = redis
+        self.name = name
+
+    def acquire(self, blocking=True):
+        if self.name in self.redis.sets:
+            return False
+        self.redis.sets[self.name] = set()
+        return True
+
+    def release(self):
+        del self.redis.sets[self.name]
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        def queue(*args):
+            self.commands.append((getattr(self.redis, name), args))
+
+        return queue
+
+    def execute(self):
+        results = [command(*args) for command, args in self.commands]
+        self.commands = []
+        return results
+
+
+class IncrementMaskCountersTest(TestCase):
+    def setUp(self):
+        self.user = make_premium_test_user()
+        self.relay_address = baker.make(RelayAddress, user=self.user)
+
+    def test_increment_is_atomic(self):
+        stale_copy = RelayAddress.objects.get(id=self.relay_address.id)
+        increment_mask_counters(self.relay_address, num_forwarded=1, used=True)
+        increment_mask_counters(stale_copy, num_forwarded=1)
+        assert self.relay_address.num_forwarded == 1
+        assert self.relay_address.last_used_at is not None
+
+        self.relay_address.refresh_from_db()
+        assert self.relay_address.num_forwarded == 2
+        assert self.relay_address.last_used_at is not None
+
+    def test_increment_null_counter(self):
+        RelayAddress.objects.filter(id=self.relay_address.id).update(
+            num_level_one_trackers_blocked=None
+        )
+        self.relay_address.refresh_from_db()
+        increment_mask_counters(self.relay_address, num_level_one_trackers_blocked=3)
+        self.relay_address.refresh_from_db()
+        assert self.relay_address.num_level_one_trackers_blocked == 3
+
+    def test_no_increments(self):
+        with self.assertNumQueries(0):
+            increment_mask_counters(
+                self.relay_address, num_level_one_trackers_blocked=0
+            )
+
+
+@override_settings(MASK_COUNTERS_WRITE_BEHIND=True)
+class WriteBehindMaskCountersTest(TestCase):
+    def setUp(self):
+        self.user = make_premium_test_user()
+        self.user.profile.subdomain = "subdomain"
+        self.user.profile.save()
+        self.relay_address = baker.make(RelayAddress, user=self.user)
+        self.domain_address = baker.make(
+            DomainAddress, user=self.user, address="domain"
+        )
+        self.redis = FakeRedis()
+        patcher = patch("emails.counters.get_redis_connection", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_increment_is_pending(self):
+        with self.assertNumQueries(0):
+            increment_mask_counters(self.relay_address, num_forwarded=1, used=True)
+        self.relay_address.refresh_from_db()
+        assert self.relay_address.num_forwarded == 0
+        assert self.relay_address.last_used_at is None
+
+        add_pending_mask_counters([self.relay_address, self.domain_address])
+        assert self.relay_address.num_forwarded == 1
+        assert self.relay_address.last_used_at is not None
+        assert self.domain_address.num_forwarded == 0
+
+    def test_pending_counters_added_once(self):
+        increment_mask_counters(self.relay_address, num_blocked=2)
+        self.relay_address.refresh_from_db()
+        add_pending_mask_counters([self.relay_address])
+        add_pending_mask_counters([self.relay_address])
+        assert self.relay_address.num_blocked == 2
+
+    def test_get_pending_mask_totals(self):
+        increment_mask_counters(self.relay_address, num_forwarded=1)
+        increment_mask_counters(self.relay_address, num_forwarded=1, num_replied=1)
+        increment_mask_counters(self.domain_address, num_forwarded=1)
+        totals = get_pending_mask_totals(
+            [self.relay_address.id], [self.domain_address.id]
+        )
+        assert totals == {
+            "num_forwarded": 3,
+            "num_blocked": 0,
+            "num_replied": 1,
+            "num_level_one_trackers_blocked": 0,
+        }
+
+    def test_flush_mask_counters(self):
+        other_address = baker.make(RelayAddress, user=self.user)
+        for address in (self.relay_address, self.domain_address, other_address):
+            increment_mask_counters(
+                address, num_forwarded=1, num_level_one_trackers_blocked=2, used=True
+            )
+        increment_mask_counters(self.relay_address, num_blocked=1)
+
+        assert flush_mask_counters() == 3
+        assert self.redis.hashes == {}
+        for address in (self.relay_address, self.domain_address, other_address):
+            address.refresh_from_db()
+            assert address.num_forwarded == 1
+            assert address.num_level_one_trackers_blocked == 2
+            assert address.last_used_at is not None
+            assert (datetime.now(timezone.utc) - address.last_used_at).seconds < 2
+        assert self.relay_address.num_blocked == 1
+        assert other_address.num_blocked == 0
+
+    def test_flush_mask_counters_none_pending(self):
+        assert flush_mask_counters() == 0
+
+    def test_flush_mask_counters_restores_on_error(self):
+        increment_mask_counters(self.relay_address, num_forwarded=1, used=True)
+        pending = dict(self.redis.hashes[MASK_COUNTERS_KEY])
+        with patch(
+            "emails.counters._update_mask_counters", side_effect=DatabaseError()
+        ), pytest.raises(DatabaseError):
+            flush_mask_counters()
+        assert self.redis.hashes == {MASK_COUNTERS_KEY: pending}
+
+    def test_flush_mask_counters_left_by_stopped_flush(self):
+        increment_mask_counters(self.relay_address, num_forwarded=1)
+        self.redis.rename(MASK_COUNTERS_KEY, f"{MASK_COUNTERS_KEY}.flushing.stopped")
+        increment_mask_counters(self.relay_address, num_forwarded=1)
+        increment_mask_counters(self.domain_address, num_blocked=1)
+
+        assert flush_mask_counters() == 3
+        assert self.redis.hashes == {}
+        self.relay_address.refresh_from_db()
+        assert self.relay_address.num_forwarded == 2
+        self.domain_address.refresh_from_db()
+        assert self.domain_address.num_blocked == 1
+
+    def test_flush_mask_counters_during_other_flush(self):
+        increment_mask_counters(self.relay_address, num_forwarded=1)
+        self.redis.rename(MASK_COUNTERS_KEY, f"{MASK_COUNTERS_KEY}.flushing.running")
+        lock = self.redis.lock(f"{MASK_COUNTERS_KEY}.flush_lock", timeout=60)
+        assert lock.acquire(blocking=False)
+
+        assert flush_mask_counters() == 0
+        assert f"{MASK_COUNTERS_KEY}.flushing.running" in self.redis.hashes
+        self.relay_address.refresh_from_db()
+        assert self.relay_address.num_forwarded == 0
+
+    def test_flush_mask_counters_command(self):
+        increment_mask_counters(self.relay_address, num_forwarded=1)
+        call_command("flush_mask_counters")
+        self.relay_address.refresh_from_db()
+        assert self.relay_address.num_forwarded == 1
+
+
+def test_flush_mask_counters_command_disabled(settings) -> None:
+    settings.MASK_COUNTERS_WRITE_BEHIND = False
+    with pytest.raises(CommandError):
+        call_command("flush_mask_counters")
+
+
+@override_settings(
+    ABUSE_METRICS_WRITE_BEHIND=True,
+    MAX_FORWARDED_PER_DAY=3,
+    MAX_FORWARDED_EMAIL_SIZE_PER_DAY=1000,
+)
+class WriteBehindAbuseMetricsTest(TestCase):
+    def setUp(self):
+        self.user = make_premium_test_user()
+        self.profile = self.user.profile
+        self.redis = FakeRedis()
+        patcher = patch("emails.counters.get_redis_connection", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_update_abuse_metric_does_not_write(self):
+        with self.assertNumQueries(0):
+            self.profile.update_abuse_metric(
+                email_forwarded=True, forwarded_email_size=100
+            )
+            self.profile.update_abuse_metric(replied=True)
+        assert not AbuseMetrics.objects.exists()
+        assert self.profile.last_account_flagged is None
+
+    def test_update_abuse_metric_flags_user(self):
+        for _ in range(2):
+            self.profile.update_abuse_metric(email_forwarded=True)
+        assert self.profile.last_account_flagged is None
+        self.profile.update_abuse_metric(email_forwarded=True)
+        assert self.profile.last_account_flagged is not None
+        self.profile.refresh_from_db()
+        assert self.profile.is_flagged
+
+    def test_update_abuse_metric_flags_user_for_size(self):
+        self.profile.update_abuse_metric(
+            email_forwarded=True, forwarded_email_size=1000
+        )
+        assert self.profile.last_account_flagged is not None
+
+    def test_persist_abuse_metrics(self):
+        other_user = make_premium_test_user()
+        two_days_ago = datetime.now(timezone.utc) - timedelta(days=2)
+        old_metric = baker.make(AbuseMetrics, user=other_user)
+        AbuseMetrics.objects.filter(id=old_metric.id).update(
+            first_recorded=two_days_ago
+        )
+        self.profile.update_abuse_metric(email_forwarded=True, forwarded_email_size=100)
+        other_user.profile.update_abuse_metric(address_created=True)
+
+        assert persist_abuse_metrics() == 2
+        self.profile.update_abuse_metric(replied=True)
+        assert persist_abuse_metrics() == 2
+
+        metric = AbuseMetrics.objects.get(user=self.user)
+        assert metric.num_email_forwarded_per_day == 1
+        assert metric.forwarded_email_size_per_day == 100
+        assert metric.num_replies_per_day == 1
+        other_metric = AbuseMetrics.objects.get(user=other_user)
+        assert other_metric.num_address_created_per_day == 1
+        assert other_metric.id != old_metric.id
+
+    def test_persist_abuse_metrics_saves_previous_day(self):
+        yesterday = datetime.now(timezone.utc).date() - timedelta(days=1)
+        self.redis.sadd(_abuse_metrics_key(yesterday), self.user.id)
+        yesterday_key = _abuse_metrics_key(yesterday, self.user.id)
+        self.redis.hincrby(yesterday_key, "num_replies_per_day", 2)
+
+        assert persist_abuse_metrics() == 0
+        metric = AbuseMetrics.objects.get(user=self.user)
+        assert metric.first_recorded == datetime.combine(
+            yesterday, datetime.min.time(), timezone.utc
+        )
+        assert metric.num_replies_per_day == 2
+
+        # Counted after the previous run, before midnight
+        self.redis.hincrby(yesterday_key, "num_replies_per_day", 1)
+        self.profile.update_abuse_metric(replied=True)
+        assert persist_abuse_metrics() == 1
+        metric.refresh_from_db()
+        assert metric.num_replies_per_day == 3
+        assert AbuseMetrics.objects.filter(user=self.user).count() == 2
+
+    def test_persist_abuse_metrics_command(self):
+        self.profile.update_abuse_metric(replied=True)
+        call_command("persist_abuse_metrics")
+        assert AbuseMetrics.objects.get(user=self.user).num_replies_per_day == 1
+
+
+def test_persist_abuse_metrics_command_disabled(settings) -> None:
+    settings.ABUSE_METRICS_WRITE_BEHIND = False
+    with pytest.raises(CommandError):
+        call_command("persist_abuse_metrics")
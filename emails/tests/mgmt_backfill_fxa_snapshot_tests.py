@@ -0,0 +1,38 @@
+from django.core.management import call_command, CommandError
+
+import pytest
+
+from emails.models import FxaSnapshot, Profile
+
+from .models_tests import make_free_test_user, make_premium_test_user
+
+
+@pytest.mark.django_db
+def test_backfill_fxa_snapshot(capsys) -> None:
+    make_free_test_user()
+    premium_profile = make_premium_test_user().profile
+    FxaSnapshot.objects.filter(profile=premium_profile).delete()
+
+    call_command("backfill_fxa_snapshot", "--batch-size=1")
+
+    profile = Profile.objects.get(id=premium_profile.id)
+    assert profile.fxa_snapshot.fxa_uid == profile.fxa.uid
+    assert profile.fxa_snapshot.has_premium_subscription is True
+    assert "snapshot of 1 profiles" in capsys.readouterr().out
+
+
+@pytest.mark.django_db
+def test_backfill_fxa_snapshot_all(capsys, settings) -> None:
+    premium_profile = make_premium_test_user().profile
+    settings.SUBSCRIPTIONS_WITH_UNLIMITED = []
+
+    call_command("backfill_fxa_snapshot", "--all")
+
+    profile = Profile.objects.get(id=premium_profile.id)
+    assert profile.fxa_snapshot.has_premium_subscription is False
+    assert "snapshot of 1 profiles" in capsys.readouterr().out
+
+
+def test_backfill_fxa_snapshot_invalid_batch_size() -> None:
+    with pytest.raises(CommandError, match="batch size"):
+        call_command("backfill_fxa_snapshot", "--batch-size=0")
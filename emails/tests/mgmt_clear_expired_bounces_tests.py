@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.core.management import call_command
+
+import pytest
+
+from emails.models import Profile
+
+from .models_tests import make_free_test_user
+
+
+@pytest.mark.django_db
+def test_clear_expired_bounces(capsys) -> None:
+    now = datetime.now(timezone.utc)
+    expired_hard_bounce = now - timedelta(days=settings.HARD_BOUNCE_ALLOWED_DAYS + 1)
+    expired_soft_bounce = now - timedelta(days=settings.SOFT_BOUNCE_ALLOWED_DAYS + 1)
+    pending_hard_bounce = now - timedelta(days=settings.HARD_BOUNCE_ALLOWED_DAYS - 1)
+    expired = make_free_test_user().profile
+    pending = make_free_test_user().profile
+    Profile.objects.filter(id=expired.id).update(
+        last_hard_bounce=expired_hard_bounce, last_soft_bounce=expired_soft_bounce
+    )
+    Profile.objects.filter(id=pending.id).update(
+        last_hard_bounce=pending_hard_bounce, last_soft_bounce=expired_soft_bounce
+    )
+
+    call_command("clear_expired_bounces")
+
+    expired.refresh_from_db()
+    assert expired.last_hard_bounce is None
+    assert expired.last_soft_bounce is None
+    pending.refresh_from_db()
+    assert pending.last_hard_bounce == pending_hard_bounce
+    assert pending.last_soft_bounce is None
+    assert "Cleared 1 hard bounces and 2 soft bounces" in capsys.readouterr().out
@@ -0,0 +1,30 @@
+from datetime import date, timedelta
+
+from django.core.management import call_command, CommandError
+
+from model_bakery import baker
+import pytest
+
+from emails.models import Reply
+
+
+@pytest.mark.django_db
+def test_delete_old_reply_records(capsys) -> None:
+    old_replies = baker.make(Reply, _quantity=3)
+    new_reply = baker.make(Reply)
+    Reply.objects.filter(id__in=[reply.id for reply in old_replies]).update(
+        created_at=date.today() - timedelta(days=100)
+    )
+
+    call_command("delete_old_reply_records", "90", "--chunk-size=2", "--sleep=0")
+
+    assert list(Reply.objects.all()) == [new_reply]
+    out = capsys.readouterr().out
+    assert "Deleting 3 reply records" in out
+    assert "Deleted 2 of 3 reply records" in out
+    assert "Deleted 3 of 3 reply records" in out
+
+
+def test_delete_old_reply_records_invalid_chunk_size() -> None:
+    with pytest.raises(CommandError, match="chunk size"):
+        call_command("delete_old_reply_records", "90", "--chunk-size=0")
@@ -12,7 +12,12 @@ import OpenSSL
 from django.core.management import call_command
 from django.core.management.base import CommandError
 
+from model_bakery import baker
+
+from emails.models import RelayAddress, Reply
+from emails.reply_buffer import add_reply_record
 from emails.tests.views_tests import EMAIL_SNS_BODIES
+from emails.utils import add_stage_time, derive_reply_keys, set_stage_email
 from privaterelay.tests.utils import log_extra
 
 
@@ -243,6 +248,59 @@ def test_one_message(
     )
 
 
+@pytest.mark.django_db
+def test_reply_records_inserted_each_cycle(
+    mock_sns_inbound_logic, mock_sqs_client, caplog, test_settings
+):
+    """Buffered Reply records are inserted at the end of the cycle."""
+    test_settings.REPLY_RECORD_BUFFER_SIZE = 100
+    relay_address = baker.make(RelayAddress)
+
+    def store_reply_record(*args):
+        lookup_key, _ = derive_reply_keys(str(uuid4()).encode())
+        add_reply_record(
+            Reply(relay_address=relay_address, lookup_key=lookup_key, metadata=b"")
+        )
+        assert not Reply.objects.exists()
+
+    mock_sns_inbound_logic.side_effect = store_reply_record
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(2)]
+    mock_sqs_client.return_value = fake_queue(msgs, [])
+    call_command(COMMAND_NAME)
+
+    cycle_log = next(
+        rec for rec in caplog.records if rec.getMessage().startswith("Cycle 0")
+    )
+    assert log_extra(cycle_log)["reply_records"] == 2
+    assert Reply.objects.count() == 2
+
+
+def test_one_message_stage_times(
+    mock_sns_inbound_logic, mock_sqs_client, caplog, test_settings
+):
+    """The stage times of processing a message are logged and emitted."""
+    test_settings.STATSD_ENABLED = True
+
+    def process_email(*args: Any) -> None:
+        set_stage_email("s3", 50_000)
+        add_stage_time("load", 0.25)
+        add_stage_time("ses_send", 0.1234)
+
+    mock_sns_inbound_logic.side_effect = process_email
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    mock_sqs_client.return_value = fake_queue([msg], [])
+    with MetricsMock() as mm:
+        call_command(COMMAND_NAME)
+
+    msg_log = caplog.records[1]
+    assert msg_log.getMessage() == "Message processed"
+    msg_extra = log_extra(msg_log)
+    assert msg_extra["stage_s"] == {"load": 0.25, "ses_send": 0.123}
+    tags = ["transport:s3", "size:under_100kb"]
+    mm.assert_histogram_once("fx.private.relay.email_stage.load", 250, tags)
+    mm.assert_histogram_once("fx.private.relay.email_stage.ses_send", 123, tags)
+
+
 def test_keyboard_interrupt(mock_sqs_client, caplog, test_settings):
     """The command halts on Ctrl-C."""
     test_settings.PROCESS_EMAIL_MAX_SECONDS = None
@@ -0,0 +1,46 @@
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+
+from model_bakery import baker
+import pytest
+
+from emails.address_filter import (
+    clear_loaded_address_filter,
+    get_address_filter,
+)
+from emails.models import RelayAddress
+
+from .models_tests import make_free_test_user
+
+
+@pytest.fixture(autouse=True)
+def address_filter_settings(settings):
+    settings.ADDRESS_FILTER_MAX_AGE = 60 * 60
+    cache.clear()
+    clear_loaded_address_filter()
+    yield settings
+    cache.clear()
+    clear_loaded_address_filter()
+
+
+@pytest.mark.django_db
+def test_rebuild_address_filter(capsys) -> None:
+    relay_address = baker.make(RelayAddress, user=make_free_test_user())
+    call_command("rebuild_address_filter")
+    address_filter = get_address_filter()
+    assert address_filter is not None
+    assert address_filter.may_be_relay_address(
+        relay_address.address, relay_address.domain
+    )
+    assert "Stored address filter built at" in capsys.readouterr().out
+
+
+def test_rebuild_address_filter_disabled(address_filter_settings) -> None:
+    address_filter_settings.ADDRESS_FILTER_MAX_AGE = 0
+    with pytest.raises(CommandError, match="disabled"):
+        call_command("rebuild_address_filter")
+
+
+def test_rebuild_address_filter_bad_error_rate() -> None:
+    with pytest.raises(CommandError, match="error rate"):
+        call_command("rebuild_address_filter", "--error-rate=1.5")
@@ -0,0 +1,31 @@
+from django.core.management import call_command, CommandError
+
+from model_bakery import baker
+import pytest
+
+from emails.models import Reply
+from emails.utils import b64_lookup_key, derive_reply_keys
+
+
+@pytest.mark.django_db
+def test_reencode_reply_records(capsys, settings) -> None:
+    settings.REPLY_RECORD_BINARY_FORMAT = True
+    lookup_key, _ = derive_reply_keys(b"msg-id-123")
+    jwe_reply = baker.make(Reply, lookup=b64_lookup_key(lookup_key))
+    binary_lookup_key, _ = derive_reply_keys(b"msg-id-456")
+    binary_reply = baker.make(Reply, lookup_key=binary_lookup_key)
+
+    call_command("reencode_reply_records", "--batch-size=1")
+
+    jwe_reply.refresh_from_db()
+    assert jwe_reply.lookup is None
+    assert jwe_reply.raw_lookup_key == lookup_key
+    binary_reply.refresh_from_db()
+    assert binary_reply.raw_lookup_key == binary_lookup_key
+    assert "lookup keys of 1 reply records" in capsys.readouterr().out
+
+
+def test_reencode_reply_records_disabled(settings) -> None:
+    settings.REPLY_RECORD_BINARY_FORMAT = False
+    with pytest.raises(CommandError, match="disabled"):
+        call_command("reencode_reply_records")
@@ -7,6 +7,7 @@ from uuid import uuid4
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
 from django.test import override_settings, TestCase
 
 from allauth.socialaccount.models import SocialAccount
@@ -21,6 +22,7 @@ from ..models import (
     CannotMakeSubdomainException,
     DeletedAddress,
     DomainAddress,
+    FxaSnapshot,
     get_domains_from_settings,
     get_domain_numerical,
     has_bad_words,
@@ -372,6 +374,16 @@ class ProfileCheckBouncePause(ProfileBounceTestCase):
         assert bounce_paused is True
         assert bounce_type == "soft"
 
+    def test_hard_bounce_over_and_soft_bounce_pending_shows_soft(self) -> None:
+        """An expired hard bounce does not hide a pending soft bounce."""
+        self.profile.last_hard_bounce = datetime.now(timezone.utc) - timedelta(
+            days=settings.HARD_BOUNCE_ALLOWED_DAYS + 1
+        )
+        self.set_soft_bounce()
+        bounce_paused, bounce_type = self.profile.check_bounce_pause()
+        assert bounce_paused is True
+        assert bounce_type == "soft"
+
     def test_hard_and_soft_bounce_pending_shows_hard(self) -> None:
         self.set_hard_bounce()
         self.set_soft_bounce()
@@ -379,31 +391,33 @@ class ProfileCheckBouncePause(ProfileBounceTestCase):
         assert bounce_paused is True
         assert bounce_type == "hard"
 
-    def test_hard_bounce_over_resets_timer(self) -> None:
-        self.profile.last_hard_bounce = datetime.now(timezone.utc) - timedelta(
+    def test_hard_bounce_over_is_not_paused_without_writing(self) -> None:
+        last_hard_bounce = datetime.now(timezone.utc) - timedelta(
             days=settings.HARD_BOUNCE_ALLOWED_DAYS + 1
         )
+        self.profile.last_hard_bounce = last_hard_bounce
         self.profile.save()
-        assert self.profile.last_hard_bounce is not None
 
-        bounce_paused, bounce_type = self.profile.check_bounce_pause()
+        with self.assertNumQueries(0):
+            bounce_paused, bounce_type = self.profile.check_bounce_pause()
 
         assert bounce_paused is False
         assert bounce_type == ""
-        assert self.profile.last_hard_bounce is None
+        assert self.profile.last_hard_bounce == last_hard_bounce
 
-    def test_soft_bounce_over_resets_timer(self) -> None:
-        self.profile.last_soft_bounce = datetime.now(timezone.utc) - timedelta(
+    def test_soft_bounce_over_is_not_paused_without_writing(self) -> None:
+        last_soft_bounce = datetime.now(timezone.utc) - timedelta(
             days=settings.SOFT_BOUNCE_ALLOWED_DAYS + 1
         )
+        self.profile.last_soft_bounce = last_soft_bounce
         self.profile.save()
-        assert self.profile.last_soft_bounce is not None
 
-        bounce_paused, bounce_type = self.profile.check_bounce_pause()
+        with self.assertNumQueries(0):
+            bounce_paused, bounce_type = self.profile.check_bounce_pause()
 
         assert bounce_paused is False
         assert bounce_type == ""
-        assert self.profile.last_soft_bounce is None
+        assert self.profile.last_soft_bounce == last_soft_bounce
 
 
 class ProfileNextEmailTryDateTest(ProfileBounceTestCase):
@@ -614,6 +628,20 @@ class ProfileSaveTest(ProfileTestCase):
         assert relay_address.generated_for == ""
         assert relay_address.used_on == ""
 
+    def test_save_server_storage_already_false_skips_address_update(self) -> None:
+        self.profile.server_storage = False
+        self.profile.save()
+        with self.assertNumQueries(1):  # The UPDATE of the profile
+            self.profile.save()
+
+    def test_save_server_storage_false_excluded_from_update_fields(self) -> None:
+        relay_address = self.add_relay_address()
+        self.profile.server_storage = False
+        self.profile.save(update_fields=["onboarding_state"])
+
+        relay_address.refresh_from_db()
+        assert relay_address.description == self.TEST_DESCRIPTION
+
     def add_four_relay_addresses(self, user: User | None = None) -> list[RelayAddress]:
         if user is None:
             user = self.profile.user
@@ -763,6 +791,107 @@ class ProfileLanguageTest(ProfileTestCase):
         assert self.profile.language == "de"
 
 
+class ProfileFxaSnapshotTest(ProfileTestCase):
+    """Tests for the Profile snapshot of the Mozilla account"""
+
+    def test_social_account_save_updates_snapshot(self) -> None:
+        social_account = self.get_or_create_social_account()
+        social_account.extra_data["locale"] = "de,en-US;q=0.9,en;q=0.8"
+        social_account.extra_data["subscriptions"].append(unlimited_subscription())
+        social_account.save()
+
+        fxa_snapshot = FxaSnapshot.objects.get(profile=self.profile)
+        assert fxa_snapshot.fxa_uid == social_account.uid
+        assert fxa_snapshot.has_premium_subscription is True
+        assert fxa_snapshot.fxa_language == "de"
+
+    def test_properties_read_snapshot_without_queries(self) -> None:
+        self.upgrade_to_premium()
+        profile = Profile.objects.select_related("user", "fxa_snapshot").get(
+            id=self.profile.id
+        )
+        with self.assertNumQueries(0):
+            assert profile.has_premium is True
+            assert profile.language == "en"
+
+    def test_not_backfilled_profile_uses_social_account(self) -> None:
+        self.upgrade_to_premium()
+        FxaSnapshot.objects.filter(profile=self.profile).delete()
+        profile = Profile.objects.get(id=self.profile.id)
+        assert profile.has_premium is True
+
+    def test_stale_profile_save_keeps_snapshot(self) -> None:
+        stale_profile = Profile.objects.get(id=self.profile.id)
+        self.upgrade_to_premium()
+        stale_profile.onboarding_state = 1
+        stale_profile.save()
+
+        profile = Profile.objects.get(id=self.profile.id)
+        assert profile.onboarding_state == 1
+        assert profile.has_premium is True
+
+    def test_stale_profile_save_updates_every_field(self) -> None:
+        stale_profile = Profile.objects.get(id=self.profile.id)
+        with self.assertNumQueries(1) as queries:
+            stale_profile.save()
+        assert '"onboarding_state"' in queries.captured_queries[0]["sql"]
+
+    def test_deleted_profile_save_inserts_it(self) -> None:
+        profile = Profile.objects.get(id=self.profile.id)
+        Profile.objects.filter(id=profile.id).delete()
+        profile.save()
+        assert Profile.objects.filter(id=profile.id).exists()
+
+    def test_social_account_delete_clears_snapshot(self) -> None:
+        self.upgrade_to_premium()
+        self.get_or_create_social_account().delete()
+        profile = Profile.objects.get(id=self.profile.id)
+        assert profile.fxa_snapshot.fxa_uid == ""
+        assert profile.has_premium is False
+
+
+class ProfileHasChangedTest(ProfileTestCase):
+    """Tests for Profile.has_changed()"""
+
+    def setUp(self) -> None:
+        # The tracker removal metrics need a Mozilla account
+        self.profile = make_free_test_user().profile
+
+    def test_loaded_profile_detects_change_without_query(self) -> None:
+        profile = Profile.objects.get(id=self.profile.id)
+        with self.assertNumQueries(0):
+            assert not profile.has_changed("remove_level_one_email_trackers")
+            profile.remove_level_one_email_trackers = True
+            assert profile.has_changed("remove_level_one_email_trackers")
+
+    def test_saved_value_is_unchanged(self) -> None:
+        self.profile.remove_level_one_email_trackers = True
+        self.profile.save()
+        with self.assertNumQueries(0):
+            assert not self.profile.has_changed("remove_level_one_email_trackers")
+
+    def test_refreshed_value_is_unchanged(self) -> None:
+        Profile.objects.filter(id=self.profile.id).update(
+            remove_level_one_email_trackers=True
+        )
+        self.profile.refresh_from_db()
+        assert not self.profile.has_changed("remove_level_one_email_trackers")
+
+    def test_deferred_field_is_read_from_database(self) -> None:
+        profile = Profile.objects.only("id").get(id=self.profile.id)
+        profile.remove_level_one_email_trackers = True
+        with self.assertNumQueries(1):
+            assert profile.has_changed("remove_level_one_email_trackers")
+
+    def test_new_profile_has_changed(self) -> None:
+        profile = Profile(user=baker.prepare(User))
+        assert profile.has_changed("remove_level_one_email_trackers")
+
+    def test_untracked_field_raises(self) -> None:
+        with self.assertRaisesMessage(ValueError, "onboarding_state"):
+            self.profile.has_changed("onboarding_state")
+
+
 class ProfileFxaLocaleInPremiumCountryTest(ProfileTestCase):
     """Tests for Profile.fxa_locale_in_premium_country"""
 
@@ -970,6 +1099,16 @@ class DomainAddressTest(TestCase):
         ).count()
         assert domain_address_count == 10
 
+    def test_make_domain_address_duplicate_does_not_count_address(self) -> None:
+        DomainAddress.make_domain_address(self.user_profile, "foobar")
+        with (
+            patch.object(Profile, "update_abuse_metric") as mock_update,
+            pytest.raises(IntegrityError),
+            transaction.atomic(),
+        ):
+            DomainAddress.make_domain_address(self.user_profile, "foobar")
+        mock_update.assert_not_called()
+
     def test_make_domain_address_makes_requested_address_via_email(self):
         domain_address = DomainAddress.make_domain_address(
             self.user_profile, "foobar", True
@@ -0,0 +1,136 @@
+from unittest.mock import patch
+
+from django.core.cache import cache
+
+from model_bakery import baker
+import pytest
+
+from emails.models import RelayAddress, Reply
+from emails.reply_buffer import (
+    add_reply_record,
+    buffer_reply_records,
+    flush_reply_records,
+    get_pending_reply_records,
+)
+from emails.utils import derive_reply_keys
+from emails.views import _get_reply_record_from_headers
+
+from .models_tests import make_free_test_user
+
+
+@pytest.fixture(autouse=True)
+def reply_buffer_settings(settings):
+    settings.REPLY_RECORD_BUFFER_SIZE = 3
+    settings.REPLY_RECORD_BUFFER_TIMEOUT = 60
+    cache.clear()
+    yield settings
+    cache.clear()
+
+
+@pytest.fixture
+def relay_address() -> RelayAddress:
+    return baker.make(RelayAddress, user=make_free_test_user())
+
+
+def make_reply(relay_address: RelayAddress, message_id: bytes) -> Reply:
+    lookup_key, _ = derive_reply_keys(message_id)
+    return Reply(relay_address=relay_address, lookup_key=lookup_key, metadata=b"")
+
+
+@pytest.mark.django_db
+def test_add_reply_record_inserts_without_buffer(relay_address) -> None:
+    add_reply_record(make_reply(relay_address, b"message-id"))
+    assert Reply.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_add_reply_record_buffers_until_flush(relay_address) -> None:
+    lookup_key, _ = derive_reply_keys(b"message-id")
+    with buffer_reply_records():
+        add_reply_record(make_reply(relay_address, b"message-id"))
+        assert not Reply.objects.exists()
+        pending = get_pending_reply_records([lookup_key])
+        assert pending[lookup_key].relay_address == relay_address
+        assert flush_reply_records() == 1
+        assert Reply.objects.get().raw_lookup_key == lookup_key
+        assert flush_reply_records() == 0
+
+
+@pytest.mark.django_db
+def test_add_reply_record_flushes_full_buffer(relay_address) -> None:
+    with buffer_reply_records():
+        for num in range(3):
+            add_reply_record(make_reply(relay_address, f"id-{num}".encode()))
+        assert Reply.objects.count() == 3
+
+
+@pytest.mark.django_db
+def test_buffer_reply_records_flushes_on_exit(relay_address) -> None:
+    with pytest.raises(KeyboardInterrupt):
+        with buffer_reply_records():
+            add_reply_record(make_reply(relay_address, b"message-id"))
+            raise KeyboardInterrupt
+    assert Reply.objects.count() == 1
+    add_reply_record(make_reply(relay_address, b"message-id-2"))
+    assert Reply.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_buffer_reply_records_disabled(settings, relay_address) -> None:
+    settings.REPLY_RECORD_BUFFER_SIZE = 0
+    lookup_key, _ = derive_reply_keys(b"message-id")
+    with buffer_reply_records():
+        add_reply_record(make_reply(relay_address, b"message-id"))
+        assert Reply.objects.count() == 1
+    assert get_pending_reply_records([lookup_key]) == {}
+
+
+@pytest.mark.django_db
+def test_flush_reply_records_inserts_one_at_a_time_on_error(relay_address) -> None:
+    with buffer_reply_records():
+        add_reply_record(make_reply(relay_address, b"message-id"))
+        add_reply_record(make_reply(relay_address, b"message-id-2"))
+        with patch.object(
+            Reply.objects, "bulk_create", side_effect=Exception("bad record")
+        ):
+            assert flush_reply_records() == 2
+    assert Reply.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_flush_reply_records_drops_failing_record(relay_address, caplog) -> None:
+    bad_record = make_reply(relay_address, b"bad-message-id")
+    original_save = Reply.save
+
+    def save(reply_record, *args, **kwargs):
+        if reply_record is bad_record:
+            raise Exception("mask was deleted")
+        original_save(reply_record, *args, **kwargs)
+
+    with (
+        patch.object(Reply.objects, "bulk_create", side_effect=Exception("bad")),
+        patch.object(Reply, "save", autospec=True, side_effect=save),
+    ):
+        with buffer_reply_records():
+            add_reply_record(bad_record)
+            add_reply_record(make_reply(relay_address, b"message-id"))
+            assert flush_reply_records() == 1
+            for num in range(4):
+                add_reply_record(make_reply(relay_address, f"id-{num}".encode()))
+    assert Reply.objects.count() == 5
+    assert flush_reply_records() == 0
+    dropped = [
+        rec for rec in caplog.records if rec.msg == "reply_buffer_record_dropped"
+    ]
+    assert len(dropped) == 1
+
+
+@pytest.mark.django_db
+def test_get_reply_record_from_headers_finds_buffered_record(relay_address) -> None:
+    _, encryption_key = derive_reply_keys(b"msg-id-123")
+    headers = [{"name": "In-Reply-To", "value": "<msg-id-123@email.com>"}]
+    with buffer_reply_records():
+        add_reply_record(make_reply(relay_address, b"msg-id-123"))
+        reply_record, found_key = _get_reply_record_from_headers(headers)
+    assert reply_record.address == relay_address
+    assert found_key == encryption_key
@@ -55,6 +55,13 @@ class MeasureFeatureUsageSignalTest(TestCase):
             },
         )
 
+    def test_unchanged_profile_is_saved_without_query(self) -> None:
+        profile = Profile.objects.get(id=self.profile.id)
+        profile.onboarding_state = 1
+        with self.assertNumQueries(1):  # The UPDATE
+            profile.save()
+        self.mocked_incr.assert_not_called()
+
     def test_remove_level_one_email_trackers_unchanged(self) -> None:
         self.profile.remove_level_one_email_trackers = False
         self.profile.save()
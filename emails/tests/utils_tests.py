@@ -1,17 +1,35 @@
 from base64 import b64encode
+from email import message_from_bytes, policy
+from email.message import EmailMessage
 from typing import Literal
 from urllib.parse import quote_plus
 from django.test import TestCase, override_settings
 from unittest.mock import patch
+from markus.testing import MetricsMock
 import json
+import random
 import pytest
 
-from emails.models import get_domains_from_settings
+from model_bakery import baker
+
+from emails.models import get_domains_from_settings, RelayAddress, Reply
 from emails.utils import (
+    _store_reply_record,
+    add_stage_time,
+    decrypt_reply_metadata,
+    derive_reply_keys,
+    email_message_as_bytes,
+    encrypt_reply_metadata,
+    encrypt_reply_metadata_binary,
     generate_from_header,
     get_email_domain_from_settings,
+    linkify_and_linebreaks,
     parse_email_header,
+    record_stage_timings,
     remove_trackers,
+    set_stage_email,
+    time_stage,
+    urlize_and_linebreaks,
     InvalidFromHeader,
 )
 from .models_tests import make_free_test_user, make_premium_test_user  # noqa: F401
@@ -37,12 +55,172 @@ class GetEmailDomainFromSettingsTest(TestCase):
         }
 
 
+def test_email_message_as_bytes_matches_as_string() -> None:
+    """email_message_as_bytes returns the same content as as_string, as bytes."""
+    email = EmailMessage()
+    email["Subject"] = "Ünïcödé subject"
+    email["From"] = "sender@example.com"
+    email.set_content("👍 Thanks I got it!")
+    email.add_alternative("<p>👍 Thanks I got it!</p>", subtype="html")
+
+    email_bytes = email_message_as_bytes(email)
+    assert email_bytes == email.as_string().encode("utf-8")
+    assert b"Content-Transfer-Encoding: base64" in email_bytes
+
+
+def test_email_message_as_bytes_converts_line_endings() -> None:
+    """email_message_as_bytes converts line endings like as_string."""
+    incoming = (
+        b"Subject: Line endings\r\n"
+        b"Content-Type: text/plain; charset=us-ascii\r\n"
+        b"\r\n"
+        b"CRLF line\r\nLF line\nCR line\rlast line"
+    )
+    email = message_from_bytes(incoming, policy=policy.default)
+    assert isinstance(email, EmailMessage)
+
+    email_bytes = email_message_as_bytes(email)
+    assert email_bytes == email.as_string().encode("utf-8")
+    assert email_bytes.endswith(b"\n\nCRLF line\nLF line\nCR line\nlast line")
+
+
+# Text that Django's urlize handles in different ways
+_LINKIFY_CONFORMANCE_CASES = {
+    "empty": "",
+    "plain": "Just some text, with no links.\nA second line.",
+    "escaped": "5 > 3 & 2 < 4, \"quoted\" and 'single quoted'",
+    "https": "Go to https://example.com/path?a=1&b=2#frag now",
+    "http_upper": "HTTP://EXAMPLE.COM/UPPER",
+    "www": "Visit www.example.org or WWW.EXAMPLE.NET/path.",
+    "bare_domain": "Try example.com, example.co.uk, or example.io/path",
+    "trailing_punctuation": "See https://example.com/a. Or https://example.com/b!",
+    "wrapped": "(https://example.com/wrapped) [www.example.com] (x.com/(y))",
+    "unbalanced_parens": "https://example.com/path)) and (www.example.com",
+    "entities": "https://example.com/?a=1&amp;b=2&lt; &amp;",
+    "quotes": "href=\"https://example.com/quoted\" 'www.example.com'",
+    "angle_brackets": "<https://example.com/angle> <user@example.com>",
+    "email": "Email user@example.com, or first.last+tag@sub.example.co.uk.",
+    "email_invalid": "@example.com user@ user@@example.com user@.com a@b a@b.c",
+    "email_with_colon": "mailto:user@example.com user:pass@example.com",
+    "email_idn": "user@bücher.example user@exa\u2028mple.com",
+    "email_bad_idn": "user@" + "a" * 64 + ".com",
+    "unicode": "Ünïcödé text and https://例え.テスト/パス and 👍 www.example.com/👍",
+    "ipv6": "http://[2001:db8::1]/path and https://[::1]:8080",
+    "schemes": "ftp://example.com file:///etc/passwd javascript:alert(1)",
+    "line_endings": "CRLF https://example.com\r\nCR\rLF\n\nend",
+    "whitespace": "tab\thttps://example.com\x0bvertical\x0cform feed\u00a0nbsp",
+    "long_url": "https://example.com/" + "a" * 500,
+    "dots_and_colons": "... ::: .com .net @ :// www. e.g. i.e. 10:30 v1.2.3",
+}
+
+
+@pytest.mark.parametrize(
+    "text",
+    _LINKIFY_CONFORMANCE_CASES.values(),
+    ids=_LINKIFY_CONFORMANCE_CASES.keys(),
+)
+def test_linkify_and_linebreaks_matches_django(text: str) -> None:
+    assert linkify_and_linebreaks(text) == urlize_and_linebreaks(text)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_linkify_and_linebreaks_matches_django_random_text(seed: int) -> None:
+    """Random text built from link-like fragments gives the same output."""
+    fragments = (
+        "https://",
+        "http://",
+        "www.",
+        "example",
+        ".com",
+        ".org",
+        ".",
+        "@",
+        ":",
+        "/",
+        "&amp;",
+        "&",
+        "<",
+        ">",
+        '"',
+        "'",
+        "(",
+        ")",
+        "[",
+        "]",
+        ",",
+        "!",
+        " ",
+        "\n",
+        "\r\n",
+        "word",
+        "ü",
+    )
+    rng = random.Random(seed)
+    text = "".join(rng.choice(fragments) for _ in range(2000))
+    assert linkify_and_linebreaks(text) == urlize_and_linebreaks(text)
+
+
 def _encode_as_base64_utf8_str(value: str) -> str:
     """Encode a string in UTF-8 binary (base64), like an email header"""
     b64 = b64encode(value.encode()).decode()
     return f"=?utf-8?b?{b64}?="
 
 
+def test_time_stage_without_recording() -> None:
+    """time_stage and add_stage_time do nothing outside of record_stage_timings."""
+    with time_stage("parse"):
+        pass
+    add_stage_time("load", 1.0)
+    set_stage_email("s3", 100)
+
+
+def test_record_stage_timings() -> None:
+    with record_stage_timings() as timings:
+        with time_stage("parse"):
+            pass
+        with pytest.raises(ValueError):
+            with time_stage("parse"):
+                raise ValueError()
+        add_stage_time("load", 0.5)
+    assert set(timings.seconds.keys()) == {"parse", "load"}
+    assert timings.seconds["load"] == 0.5
+    assert timings.transport == "none"
+    assert timings.size == "unknown"
+    with time_stage("wrap"):
+        pass
+    assert "wrap" not in timings.seconds
+
+
+@pytest.mark.parametrize(
+    "size,bucket",
+    (
+        (0, "under_10kb"),
+        (9_999, "under_10kb"),
+        (10_000, "under_100kb"),
+        (999_999, "under_1mb"),
+        (9_999_999, "under_10mb"),
+        (10_000_000, "over_10mb"),
+    ),
+)
+def test_stage_timings_set_email(size: int, bucket: str) -> None:
+    with record_stage_timings() as timings:
+        set_stage_email("sns", size)
+    assert timings.transport == "sns"
+    assert timings.size == bucket
+
+
+@override_settings(STATSD_ENABLED=True)
+def test_record_stage_timings_emits_histograms() -> None:
+    with MetricsMock() as mm:
+        with record_stage_timings():
+            add_stage_time("load", 0.0504)
+            add_stage_time("load", 0.05)
+            add_stage_time("db", 0.002)
+    tags = ["transport:none", "size:unknown"]
+    mm.assert_histogram_once("fx.private.relay.email_stage.load", 100, tags)
+    mm.assert_histogram_once("fx.private.relay.email_stage.db", 2, tags)
+
+
 # Test cases for test_generate_from_header
 # key: The pytest test ID
 # value: a dictionary with the test params:
@@ -371,6 +549,28 @@ class RemoveTrackers(TestCase):
         assert general_removed == 1
         assert general_count == 1
 
+    def test_tracker_warning_link_matches_full_payload(self):
+        from_address = '"Zoë" <spammer+tag@email.com>'
+        datetime_now = 1682472064000
+        link = "https://open.tracker.com/foo/bär.html?a=1&b=\\x&c=%20"
+        content = f'<a href="{link}">A link</a>'
+        changed_content, tracker_details = remove_trackers(
+            content, from_address, datetime_now
+        )
+
+        anchor = quote_plus(
+            json.dumps(
+                {
+                    "sender": from_address,
+                    "received_at": datetime_now,
+                    "original_link": link,
+                },
+                separators=(",", ":"),
+            )
+        )
+        assert changed_content == f'<a href="{self.url}{anchor}">A link</a>'
+        assert tracker_details["tracker_removed"] == 1
+
     def test_simple_strict_tracker_found(self):
         content = (
             '<a href="https://strict.tracker.com/foo/bar.html">A link</a>\n'
@@ -385,3 +585,48 @@ class RemoveTrackers(TestCase):
         assert changed_content == content
         assert general_removed == 0
         assert general_count == 0
+
+
+def test_reply_metadata_binary_format_round_trip() -> None:
+    _, encryption_key = derive_reply_keys(b"message-id")
+    payload = {"message-id": "<message-id@example.com>", "from": "a@example.com"}
+    encrypted = encrypt_reply_metadata_binary(encryption_key, payload)
+    assert encrypted[:1] == b"\x01"
+    assert len(encrypted) < len(encrypt_reply_metadata(encryption_key, payload))
+    assert json.loads(decrypt_reply_metadata(encryption_key, encrypted)) == payload
+    assert (
+        json.loads(decrypt_reply_metadata(encryption_key, memoryview(encrypted)))
+        == payload
+    )
+
+
+def test_reply_metadata_jwe_format_is_still_read() -> None:
+    _, encryption_key = derive_reply_keys(b"message-id")
+    payload = {"from": "a@example.com"}
+    encrypted = encrypt_reply_metadata(encryption_key, payload)
+    assert json.loads(decrypt_reply_metadata(encryption_key, encrypted)) == payload
+
+
+def test_reply_metadata_binary_format_unknown_version_raises() -> None:
+    _, encryption_key = derive_reply_keys(b"message-id")
+    encrypted = encrypt_reply_metadata_binary(encryption_key, {})
+    with pytest.raises(ValueError, match="version"):
+        decrypt_reply_metadata(encryption_key, b"\x02" + encrypted[1:])
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("binary_format", (True, False))
+def test_store_reply_record(settings, binary_format: bool) -> None:
+    settings.REPLY_RECORD_BINARY_FORMAT = binary_format
+    relay_address = baker.make(RelayAddress, user=make_free_test_user())
+    mail = {"headers": [{"name": "From", "value": "sender@example.com"}]}
+    _store_reply_record(mail, "<message-id@example.com>", relay_address)
+
+    reply = Reply.objects.get()
+    assert reply.relay_address == relay_address
+    assert (reply.lookup is None) == binary_format
+    assert (reply.metadata is not None) == binary_format
+    lookup_key, encryption_key = derive_reply_keys(b"message-id")
+    assert reply.raw_lookup_key == lookup_key
+    metadata = json.loads(decrypt_reply_metadata(encryption_key, reply.stored_metadata))
+    assert metadata == {"from": "sender@example.com"}
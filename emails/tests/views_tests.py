@@ -12,7 +12,10 @@ import os
 import re
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.management import call_command
+from django.db import IntegrityError
 from django.http import HttpResponse
 from django.test import override_settings, Client, SimpleTestCase, TestCase
 
@@ -24,29 +27,43 @@ from model_bakery import baker
 import pytest
 
 from privaterelay.ftl_bundles import main
+from emails.address_filter import clear_loaded_address_filter
 from emails.models import (
     DeletedAddress,
     DomainAddress,
+    FxaSnapshot,
     Profile,
     RelayAddress,
     Reply,
     address_hash,
     get_domains_from_settings,
 )
-from emails.types import AWS_SNSMessageJSON
+from emails.types import AWS_SNSMessageJSON, OutgoingHeaders
 from emails.utils import (
     b64_lookup_key,
     decrypt_reply_metadata,
     derive_reply_keys,
+    email_message_as_bytes,
     encrypt_reply_metadata,
+    encrypt_reply_metadata_binary,
+    get_cached_address,
     get_message_id_bytes,
+    record_stage_timings,
     InvalidFromHeader,
 )
 from emails.views import (
     ReplyHeadersNotFound,
     _build_reply_requires_premium_email,
+    _convert_html_content,
+    _convert_to_forwarded_email,
+    _create_domain_address,
     _get_address,
-    _get_keys_from_headers,
+    _get_body_encoding,
+    _get_reply_keys_from_headers,
+    _get_reply_record_from_headers,
+    _handle_bounce,
+    _handle_complaint,
+    _parse_email_headers,
     _record_receipt_verdicts,
     _set_forwarded_first_reply,
     _sns_message,
@@ -308,7 +325,9 @@ class SNSNotificationTest(TestCase):
         source = self.mock_send_raw_email.call_args[1]["Source"]
         destinations = self.mock_send_raw_email.call_args[1]["Destinations"]
         assert len(destinations) == 1
-        raw_message = self.mock_send_raw_email.call_args[1]["RawMessage"]["Data"]
+        raw_data = self.mock_send_raw_email.call_args[1]["RawMessage"]["Data"]
+        assert isinstance(raw_data, bytes)
+        raw_message = raw_data.decode("utf-8")
         headers: dict[str, str] = {}
         last_key = None
         for line in raw_message.splitlines():
@@ -515,6 +534,7 @@ class SNSNotificationTest(TestCase):
         mock_get_content,
         text: str = "this is a text reply",
         expected_fixture_name: str = "s3_stored_replies",
+        binary_format: bool = False,
     ) -> str:
         """The headers of a reply refer to the Relay mask."""
 
@@ -533,13 +553,19 @@ class SNSNotificationTest(TestCase):
             "message-id": str(uuid4()),
             "from": "sender@external.example.com",
         }
-        encrypted_metadata = encrypt_reply_metadata(encryption_key, metadata)
         relay_address = baker.make(RelayAddress, user=user, address="a1b2c3d4")
-        Reply.objects.create(
-            lookup=b64_lookup_key(lookup_key),
-            encrypted_metadata=encrypted_metadata,
-            relay_address=relay_address,
-        )
+        if binary_format:
+            Reply.objects.create(
+                lookup_key=lookup_key,
+                metadata=encrypt_reply_metadata_binary(encryption_key, metadata),
+                relay_address=relay_address,
+            )
+        else:
+            Reply.objects.create(
+                lookup=b64_lookup_key(lookup_key),
+                encrypted_metadata=encrypt_reply_metadata(encryption_key, metadata),
+                relay_address=relay_address,
+            )
 
         # Mock loading a simple reply email message from S3
         mock_get_content.return_value = create_email_from_notification(
@@ -573,6 +599,43 @@ class SNSNotificationTest(TestCase):
         assert (datetime.now(tz=timezone.utc) - last_used_at).seconds < 2.0
         return email
 
+    def test_reply_stage_timings(self) -> None:
+        """The stages of sending a reply are timed."""
+        with record_stage_timings() as timings:
+            self.test_reply()
+        assert set(timings.seconds.keys()) == {
+            "address",
+            "reply_lookup",
+            "load",
+            "parse",
+            "serialize",
+            "ses_send",
+            "db",
+        }
+        assert timings.transport == "s3"
+        assert timings.size == "under_10kb"
+
+    def test_reply_binary_format(self) -> None:
+        """A reply to a Reply record in the binary format is sent."""
+        self.test_reply(binary_format=True)
+
+    @override_settings(REPLY_RECORD_BINARY_FORMAT=True)
+    def test_reply_reencodes_reply_record(self) -> None:
+        """A Reply record in the JWE format is stored in the binary format."""
+        self.test_reply()
+        reply = Reply.objects.get()
+        assert reply.lookup is None
+        assert reply.encrypted_metadata is None
+        assert reply.lookup_key is not None
+        lookup_key, encryption_key = derive_reply_keys(
+            get_message_id_bytes("CA+J4FJFw0TXCr63y9dGcauvCGaZ7pXxspzOjEDhRpg5Zh4ziWg")
+        )
+        assert reply.raw_lookup_key == lookup_key
+        metadata = json.loads(
+            decrypt_reply_metadata(encryption_key, reply.stored_metadata)
+        )
+        assert metadata["from"] == "sender@external.example.com"
+
     def test_reply_with_emoji_in_text(self) -> None:
         """An email with emoji text content is sent with UTF-8 encoding."""
         email = self.test_reply(
@@ -766,6 +829,26 @@ class BounceHandlingTest(TestCase):
         self.user.refresh_from_db()
         assert self.user.profile.auto_block_spam
 
+    def test_bounce_with_many_recipients_uses_constant_queries(self):
+        other_user = baker.make(User, email="other@test.com")
+        bounce = {
+            "bounceType": "Permanent",
+            "bounceSubType": "General",
+            "bouncedRecipients": [
+                {"emailAddress": "relayuser@test.com"},
+                {"emailAddress": "Other User <other@test.com>"},
+                {"emailAddress": "missing@test.com"},
+            ],
+        }
+        with self.assertNumQueries(2):
+            response = _handle_bounce({"bounce": bounce})
+        assert response.status_code == 404
+
+        self.user.profile.refresh_from_db()
+        other_user.profile.refresh_from_db()
+        assert self.user.profile.last_hard_bounce is not None
+        assert other_user.profile.last_hard_bounce is not None
+
 
 class ComplaintHandlingTest(TestCase):
     """Test Complaint notifications and events."""
@@ -833,6 +916,30 @@ class ComplaintHandlingTest(TestCase):
         assert record2.subtype is None
         assert record2.feedback == "abuse"
 
+    def test_complaint_with_many_recipients_uses_constant_queries(self):
+        other_user = baker.make(User, email="other@test.com")
+        complaint = {
+            "complainedRecipients": [
+                {"emailAddress": self.user.email},
+                {"emailAddress": other_user.email, "extra": "data"},
+                {"emailAddress": "missing@test.com"},
+            ],
+            "complaintFeedbackType": "abuse",
+        }
+        message_json = {"complaint": complaint}
+        with self.assertNumQueries(2):
+            response = _handle_complaint(message_json)
+        assert response.status_code == 404
+        assert complaint["complainedRecipients"][0] == {"emailAddress": self.user.email}
+
+        self.user.profile.refresh_from_db()
+        other_user.profile.refresh_from_db()
+        assert self.user.profile.auto_block_spam is True
+        assert other_user.profile.auto_block_spam is True
+        records = [rec for rec in self.caplog.records if rec.msg.startswith("compl")]
+        assert [rec.user_match for rec in records[:3]] == ["found", "found", "missing"]
+        assert records[1].complaint_extra == {"extra": "data"}
+
 
 class SNSNotificationRemoveEmailsInS3Test(TestCase):
     def setUp(self) -> None:
@@ -964,7 +1071,7 @@ class SNSNotificationRemoveEmailsInS3Test(TestCase):
         assert response.content == b"noreply address is not supported."
 
     @override_settings(STATSD_ENABLED=True)
-    @patch("emails.views._get_keys_from_headers")
+    @patch("emails.views._get_reply_record_from_headers")
     def test_noreply_headers_reply_email_in_s3_deleted(
         self, mocked_get_keys: Mock
     ) -> None:
@@ -1001,7 +1108,7 @@ class SNSNotificationRemoveEmailsInS3Test(TestCase):
         assert response.status_code == 400
 
     @override_settings(STATSD_ENABLED=True)
-    @patch("emails.views._get_reply_record_from_lookup_key")
+    @patch("emails.views._get_reply_record_from_headers")
     def test_no_reply_record_reply_email_in_s3_deleted(
         self, mocked_get_record: Mock
     ) -> None:
@@ -1018,13 +1125,11 @@ class SNSNotificationRemoveEmailsInS3Test(TestCase):
         assert response.status_code == 404
 
     @override_settings(STATSD_ENABLED=True)
-    @patch("emails.views._get_keys_from_headers")
-    @patch("emails.views._get_reply_record_from_lookup_key")
+    @patch("emails.views._get_reply_record_from_headers")
     def test_no_reply_record_reply_email_not_in_s3_deleted_ignored(
-        self, mocked_get_record: Mock, mocked_get_keys: Mock
+        self, mocked_get_record: Mock
     ) -> None:
         """If no DB match for In-Reply-To header, return 404."""
-        mocked_get_keys.return_value = ("lookup", "encryption")
         mocked_get_record.side_effect = Reply.DoesNotExist()
 
         with MetricsMock() as mm:
@@ -1112,13 +1217,14 @@ class SNSNotificationValidUserEmailsInS3Test(TestCase):
         assert response.content == b"Address is temporarily disabled."
 
     @patch("emails.views._reply_allowed")
-    @patch("emails.views._get_reply_record_from_lookup_key")
+    @patch("emails.views._get_reply_record_from_headers")
     def test_reply_not_allowed_email_in_s3_deleted(
         self, mocked_reply_record: Mock, mocked_reply_allowed: Mock
     ) -> None:
         # external user sending a reply to Relay user
         # where the replies were being exchanged but now the user
         # no longer has the premium subscription
+        mocked_reply_record.return_value = (Mock(spec_set=Reply), b"encryption")
         mocked_reply_allowed.return_value = False
 
         response = _sns_notification(EMAIL_SNS_BODIES["s3_stored"])
@@ -1256,6 +1362,8 @@ class SnsMessageTest(TestCase):
 @override_settings(SITE_ORIGIN="https://test.com", STATSD_ENABLED=True)
 class GetAddressTest(TestCase):
     def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
         self.user = make_premium_test_user()
         self.user.profile.subdomain = "subdomain"
         self.user.profile.save()
@@ -1352,6 +1460,155 @@ class GetAddressTest(TestCase):
         assert address.address == "unknown"
         assert DomainAddress.objects.filter(user=self.user).count() == 2
 
+    def test_deleted_relay_address_is_cached(self):
+        with pytest.raises(RelayAddress.DoesNotExist):
+            _get_address("deleted456@test.com")
+        DeletedAddress.objects.all().delete()
+        with pytest.raises(RelayAddress.DoesNotExist), MetricsMock() as mm:
+            _get_address("deleted456@test.com")
+        mm.assert_incr_once("fx.private.relay.email_for_deleted_address")
+        mm.assert_incr_once(
+            "fx.private.relay.address_cache", tags=["result:hit", "state:deleted"]
+        )
+
+    def test_unknown_relay_address_cache_cleared_on_create(self):
+        with pytest.raises(RelayAddress.DoesNotExist), MetricsMock() as mm:
+            _get_address("unknown@test.com")
+        mm.assert_incr_once("fx.private.relay.address_cache", tags=["result:miss"])
+        with pytest.raises(RelayAddress.DoesNotExist), MetricsMock() as mm:
+            _get_address("unknown@test.com")
+        mm.assert_incr_once("fx.private.relay.email_for_unknown_address")
+        mm.assert_incr_once(
+            "fx.private.relay.address_cache", tags=["result:hit", "state:unknown"]
+        )
+
+        relay_address = baker.make(RelayAddress, user=self.user, address="unknown")
+        assert _get_address("unknown@test.com") == relay_address
+
+    def test_existing_relay_address_does_not_use_cache(self):
+        with MetricsMock() as mm, self.assertNumQueries(1):
+            assert _get_address("relay123@test.com") == self.relay_address
+        assert not mm.filter_records("incr", "fx.private.relay.address_cache")
+
+    def test_address_loads_fxa_snapshot(self):
+        assert FxaSnapshot.objects.filter(profile=self.user.profile).exists()
+        for email_address in ("relay123@test.com", "domain@subdomain.test.com"):
+            with self.assertNumQueries(1):
+                profile = _get_address(email_address).user.profile
+                assert profile.has_premium
+                assert profile.language == "en"
+
+    def test_relay_address_cache_cleared_after_commit(self):
+        with pytest.raises(RelayAddress.DoesNotExist):
+            _get_address("unknown@test.com")
+        with self.captureOnCommitCallbacks() as callbacks:
+            baker.make(RelayAddress, user=self.user, address="unknown")
+        assert get_cached_address("unknown", "test.com") is not None
+        callbacks[0]()
+        assert get_cached_address("unknown", "test.com") is None
+
+    def test_unknown_subdomain_cache_cleared_on_claim(self):
+        with pytest.raises(Profile.DoesNotExist):
+            _get_address("domain@unknown.test.com")
+        with pytest.raises(Profile.DoesNotExist), MetricsMock() as mm:
+            _get_address("other@unknown.test.com")
+        mm.assert_incr_once("fx.private.relay.email_for_dne_subdomain")
+        mm.assert_incr_once(
+            "fx.private.relay.address_cache",
+            tags=["result:hit", "state:no_subdomain"],
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.profile.subdomain = "unknown"
+            self.user.profile.save()
+        assert _get_address("domain@unknown.test.com") == self.domain_address
+
+    def test_existing_domain_address_is_cached(self):
+        assert _get_address("domain@subdomain.test.com") == self.domain_address
+        with MetricsMock() as mm:
+            address = _get_address("domain@subdomain.test.com")
+        assert address == self.domain_address
+        mm.assert_incr_once(
+            "fx.private.relay.address_cache", tags=["result:hit", "state:domain"]
+        )
+
+    def test_existing_domain_address_is_not_locked(self):
+        with patch("emails.views._create_domain_address") as mock_create:
+            with self.assertNumQueries(1):  # Read address
+                address = _get_address("domain@subdomain.test.com")
+        assert address == self.domain_address
+        mock_create.assert_not_called()
+
+    def test_concurrently_created_domain_address_is_returned(self):
+        with patch(
+            "emails.views.DomainAddress.make_domain_address",
+            side_effect=IntegrityError("duplicate key"),
+        ):
+            address = _create_domain_address("domain", "subdomain")
+        assert address == self.domain_address
+        assert address.user.profile.subdomain == "subdomain"
+
+    def test_deleted_domain_address_is_recreated(self):
+        assert _get_address("domain@subdomain.test.com") == self.domain_address
+        self.domain_address.delete()
+        address = _get_address("domain@subdomain.test.com")
+        assert address.id != self.domain_address.id
+        assert address.address == "domain"
+
+    @override_settings(ADDRESS_FILTER_MAX_AGE=60 * 60)
+    def test_address_filter_rejects_unknown_relay_address(self):
+        clear_loaded_address_filter()
+        self.addCleanup(clear_loaded_address_filter)
+        call_command("rebuild_address_filter")
+        # One query for the RelayAddresses created since the filter was built
+        with self.assertNumQueries(1), MetricsMock() as mm:
+            with pytest.raises(RelayAddress.DoesNotExist):
+                _get_address("unknown@test.com")
+            with pytest.raises(RelayAddress.DoesNotExist):
+                _get_address("deleted456@test.com")
+        mm.assert_incr_once("fx.private.relay.email_for_unknown_address")
+        mm.assert_incr_once("fx.private.relay.email_for_deleted_address")
+        assert (
+            len(mm.filter_records("incr", "fx.private.relay.address_filter_rejected"))
+            == 2
+        )
+        assert _get_address("relay123@test.com") == self.relay_address
+
+    @override_settings(ADDRESS_FILTER_MAX_AGE=60 * 60)
+    def test_address_filter_allows_new_relay_address(self):
+        clear_loaded_address_filter()
+        self.addCleanup(clear_loaded_address_filter)
+        call_command("rebuild_address_filter")
+        with self.captureOnCommitCallbacks(execute=True):
+            relay_address = baker.make(RelayAddress, user=self.user, address="new789")
+        assert get_cached_address("new789", "test.com") == {
+            "state": "relay",
+            "id": relay_address.id,
+        }
+        assert _get_address("new789@test.com") == relay_address
+
+    @override_settings(ADDRESS_FILTER_MAX_AGE=60 * 60)
+    def test_address_filter_allows_new_relay_address_evicted_from_cache(self):
+        clear_loaded_address_filter()
+        self.addCleanup(clear_loaded_address_filter)
+        call_command("rebuild_address_filter")
+        with patch("emails.address_filter.monotonic", return_value=1000.0):
+            with pytest.raises(RelayAddress.DoesNotExist):
+                _get_address("new789@test.com")
+        with self.captureOnCommitCallbacks(execute=True):
+            relay_address = baker.make(RelayAddress, user=self.user, address="new789")
+        cache.clear()
+        with patch("emails.address_filter.monotonic", return_value=1001.0):
+            assert _get_address("new789@test.com") == relay_address
+
+    @override_settings(ADDRESS_CACHE_TIMEOUT=0)
+    def test_address_cache_disabled(self):
+        with pytest.raises(RelayAddress.DoesNotExist):
+            _get_address("unknown@test.com")
+        with MetricsMock() as mm, pytest.raises(RelayAddress.DoesNotExist):
+            _get_address("unknown@test.com")
+        mm.assert_incr_once("fx.private.relay.address_cache", tags=["result:miss"])
+
 
 TEST_AWS_SNS_TOPIC = "arn:aws:sns:us-east-1:111222333:relay"
 TEST_AWS_SNS_TOPIC2 = TEST_AWS_SNS_TOPIC + "-alt"
@@ -1735,49 +1992,84 @@ def test_build_reply_requires_premium_email_after_forward():
     )
 
 
-def test_get_keys_from_headers_no_reply_headers():
+def test_get_reply_keys_from_headers_no_reply_headers():
     """If no reply headers, raise ReplyHeadersNotFound."""
     msg_id = "<msg-id-123@email.com>"
     headers = [{"name": "Message-Id", "value": msg_id}]
     with pytest.raises(ReplyHeadersNotFound):
         with MetricsMock() as mm:
-            _get_keys_from_headers(headers)
+            _get_reply_keys_from_headers(headers)
         mm.assert_incr_once("fx.private.relay.email_complaint")
 
 
-def test_get_keys_from_headers_in_reply_to():
+def test_get_reply_keys_from_headers_in_reply_to():
     """If In-Reply-To header, get keys from it."""
     msg_id = "<msg-id-123@email.com>"
     msg_id_bytes = get_message_id_bytes(msg_id)
+    headers = [{"name": "In-Reply-To", "value": msg_id}]
+    assert _get_reply_keys_from_headers(headers) == [derive_reply_keys(msg_id_bytes)]
+
+
+def test_get_reply_keys_from_headers_references():
+    """If no In-Reply-To header, get keys from References header, in order."""
+    msg_ids = ["<msg-id-123@email.com>", "<msg-id-456@email.com>"]
+    headers = [{"name": "References", "value": " ".join(msg_ids)}]
+    assert _get_reply_keys_from_headers(headers) == [
+        derive_reply_keys(get_message_id_bytes(msg_id)) for msg_id in msg_ids
+    ]
+
+
+@pytest.mark.django_db
+def test_get_reply_record_from_headers_in_reply_to():
+    """If In-Reply-To header, get the Reply record for it."""
+    msg_id = "<msg-id-123@email.com>"
+    msg_id_bytes = get_message_id_bytes(msg_id)
     lookup_key, encryption_key = derive_reply_keys(msg_id_bytes)
+    reply = baker.make(Reply, lookup=b64_lookup_key(lookup_key))
     headers = [{"name": "In-Reply-To", "value": msg_id}]
-    (lookup_key_from_header, encryption_key_from_header) = _get_keys_from_headers(
-        headers
-    )
-    assert lookup_key == lookup_key_from_header
-    assert encryption_key == encryption_key_from_header
+    assert _get_reply_record_from_headers(headers) == (reply, encryption_key)
 
 
 @pytest.mark.django_db
-def test_get_keys_from_headers_references_reply():
+def test_get_reply_record_from_headers_references_reply(django_assert_num_queries):
     """
-    If no In-Reply-To header, get keys from References header.
+    If no In-Reply-To header, get the first Reply record from the References header
+    with one query.
     """
     msg_id = "<msg-id-456@email.com"
     msg_id_bytes = get_message_id_bytes(msg_id)
     lookup_key, encryption_key = derive_reply_keys(msg_id_bytes)
-    baker.make(Reply, lookup=b64_lookup_key(lookup_key))
-    msg_ids = f"<msg-id-123@email.com> {msg_id} <msg-id-789@email.com>"
+    reply = baker.make(Reply, lookup=b64_lookup_key(lookup_key))
+    later_lookup_key, _ = derive_reply_keys(get_message_id_bytes("<msg-id-789@a.b>"))
+    baker.make(Reply, lookup=b64_lookup_key(later_lookup_key))
+    msg_ids = f"<msg-id-123@email.com> {msg_id} <msg-id-789@a.b>"
     headers = [{"name": "References", "value": msg_ids}]
-    (lookup_key_from_header, encryption_key_from_header) = _get_keys_from_headers(
-        headers
-    )
-    assert lookup_key == lookup_key_from_header
+    with django_assert_num_queries(1):
+        reply_record, encryption_key_from_header = _get_reply_record_from_headers(
+            headers
+        )
+    assert reply_record == reply
     assert encryption_key == encryption_key_from_header
 
 
 @pytest.mark.django_db
-def test_get_keys_from_headers_references_reply_dne():
+def test_get_reply_record_from_headers_binary_format(django_assert_num_queries):
+    """Reply records in the binary and JWE formats are found with one query."""
+    binary_lookup_key, encryption_key = derive_reply_keys(b"msg-id-123")
+    binary_reply = baker.make(Reply, lookup_key=binary_lookup_key)
+    jwe_lookup_key, _ = derive_reply_keys(b"msg-id-456")
+    baker.make(Reply, lookup=b64_lookup_key(jwe_lookup_key))
+    msg_ids = "<msg-id-123@email.com> <msg-id-456@email.com>"
+    headers = [{"name": "References", "value": msg_ids}]
+    with django_assert_num_queries(1):
+        assert _get_reply_record_from_headers(headers) == (
+            binary_reply,
+            encryption_key,
+        )
+
+
+@pytest.mark.django_db
+def test_get_reply_record_from_headers_references_reply_dne():
     """
     If no In-Reply-To header,
     and no Reply record for any values in the References header,
@@ -1786,4 +2078,182 @@ def test_get_keys_from_headers_references_reply_dne():
     msg_ids = "<msg-id-123@email.com> <msg-id-456@email.com> <msg-id-789@email.com>"
     headers = [{"name": "References", "value": msg_ids}]
     with pytest.raises(Reply.DoesNotExist):
-        _get_keys_from_headers(headers)
+        _get_reply_record_from_headers(headers)
+
+
+HTML_WITH_TRACKERS = (
+    "<html><body>\n"
+    '<a href="https://open.tracker.com/foo/bar.html">A link</a>\n'
+    "\n"
+    '<img src="https://open.tracker.com/foo/bar.jpg">\n'
+    "</body></html>"
+)
+
+
+@override_settings(
+    HTML_CONVERSION_LITE_SIZE=len(HTML_WITH_TRACKERS),
+    HTML_CONVERSION_MAX_SIZE=len(HTML_WITH_TRACKERS) * 2,
+    STATSD_ENABLED=True,
+)
+@patch("emails.utils.strict_trackers", return_value=["strict.tracker.com"])
+@patch("emails.utils.general_trackers", return_value=["open.tracker.com"])
+@pytest.mark.parametrize(
+    "padding,expected_tier",
+    ((0, "full"), (1, "lite"), (len(HTML_WITH_TRACKERS) + 1, "text_only")),
+)
+def test_convert_html_content_size_tiers(
+    mock_general_trackers: Mock,
+    mock_strict_trackers: Mock,
+    padding: int,
+    expected_tier: str,
+) -> None:
+    html_content = HTML_WITH_TRACKERS + " " * padding
+    with MetricsMock() as mm:
+        new_content, removed_count = _convert_html_content(
+            html_content,
+            "mask@relay.example.com",
+            "sender@example.com",
+            "en",
+            False,
+            True,
+            True,
+        )
+    mm.assert_incr_once(
+        "fx.private.relay.email_html_conversion_tier",
+        tags=[f"tier:{expected_tier}"],
+    )
+
+    if expected_tier == "full":
+        # Trackers in links and images are removed, empty lines are removed
+        assert removed_count == 2
+        assert "https://open.tracker.com/foo/bar.html" not in new_content
+        assert "\n\n" not in new_content
+    elif expected_tier == "lite":
+        # Only trackers in images are removed, original HTML is unchanged
+        assert removed_count == 1
+        assert "https://open.tracker.com/foo/bar.html" in new_content
+        assert "https://open.tracker.com/foo/bar.jpg" not in new_content
+        assert '<a href="https://open.tracker.com/foo/bar.html">A link</a>\n\n' in (
+            new_content
+        )
+    else:
+        assert removed_count == 0
+        assert "open.tracker.com" not in new_content
+        assert "mask@relay.example.com" in new_content
+        assert "too large to forward" in new_content
+    if expected_tier != "text_only":
+        assert "contains-tracker-warning" in new_content
+        assert "mask<span>@</span>relay" in new_content
+        assert "<!-- relay-original-html -->" not in new_content
+
+
+@override_settings(HTML_CONVERSION_MAX_SIZE=100)
+def test_convert_to_forwarded_email_large_text_has_no_html() -> None:
+    email = EmailMessage()
+    email["Subject"] = "A large text email"
+    email["From"] = "sender@example.com"
+    email["To"] = "mask@relay.example.com"
+    email.set_content("A long line of text.\n" * 10)
+    headers: OutgoingHeaders = {
+        "Subject": "A large text email",
+        "From": "sender@example.com",
+        "To": "user@example.com",
+        "Reply-To": "replies@relay.example.com",
+    }
+
+    forwarded, _, has_html, has_text = _convert_to_forwarded_email(
+        incoming_email_bytes=email.as_bytes(),
+        headers=headers,
+        to_address="mask@relay.example.com",
+        from_address="sender@example.com",
+        language="en",
+        has_premium=False,
+        sample_trackers=False,
+        remove_level_one_trackers=False,
+    )
+    assert has_text
+    assert not has_html
+    assert forwarded.get_body("html") is None
+    assert forwarded.get_content_type() == "text/plain"
+
+
+def test_parse_email_headers_keeps_body_unparsed() -> None:
+    email_bytes = EMAIL_INCOMING["inline_image"].encode()
+    email = _parse_email_headers(email_bytes.replace(b"\n", b"\r\n"))
+    assert not email.is_multipart()
+    assert (
+        email["Subject"]
+        == message_from_string(EMAIL_INCOMING["inline_image"], policy=policy.default)[
+            "Subject"
+        ]
+    )
+    # Headers may be refolded, but the body is unchanged
+    _, body = email_bytes.split(b"\n\n", 1)
+    assert email_message_as_bytes(email).endswith(b"\n\n" + body)
+
+
+def test_parse_email_headers_parses_8bit_email() -> None:
+    original = EmailMessage()
+    original["Subject"] = "An 8-bit email"
+    original.set_content("👍 Thanks I got it!", cte="8bit")
+    original.add_alternative("<p>👍 Thanks I got it!</p>", subtype="html", cte="8bit")
+    email_bytes = original.as_bytes()
+    assert not email_bytes.isascii()
+    email = _parse_email_headers(email_bytes)
+    assert email.is_multipart()
+
+
+@pytest.mark.parametrize(
+    "content,original_charset,expected",
+    (
+        ("Short ASCII lines.\n" * 5, "us-ascii", ("us-ascii", "7bit")),
+        ("A long ASCII line." * 10, "utf-8", ("utf-8", "quoted-printable")),
+        (
+            "Voil\xe0, un caf\xe9.\n" * 5,
+            "iso-8859-1",
+            ("iso-8859-1", "quoted-printable"),
+        ),
+        ("Привет, мир!\n" * 5, "utf-8", ("utf-8", "base64")),
+        ("👍 Thanks I got it!\n", "iso-8859-1", ("utf-8", "quoted-printable")),
+        ("Unknown charset\n", "x-not-a-charset", ("utf-8", "7bit")),
+    ),
+    ids=("ascii", "long_lines", "latin_1", "cyrillic", "new_charset", "bad_charset"),
+)
+def test_get_body_encoding(
+    content: str, original_charset: str, expected: tuple[str, str]
+) -> None:
+    original = EmailMessage()
+    original["Content-Type"] = f"text/plain; charset={original_charset}"
+    assert _get_body_encoding(content, original) == expected
+
+
+def test_convert_to_forwarded_email_keeps_compact_encoding() -> None:
+    email = EmailMessage()
+    email["Subject"] = "An 8-bit email"
+    email["From"] = "sender@example.com"
+    email["To"] = "mask@relay.example.com"
+    email.set_content(
+        "👍 Thanks I got it!\n" + "A line of plain text.\n" * 20, cte="8bit"
+    )
+    headers: OutgoingHeaders = {
+        "Subject": "An 8-bit email",
+        "From": "sender@example.com",
+        "To": "user@example.com",
+        "Reply-To": "replies@relay.example.com",
+    }
+
+    forwarded, _, _, has_text = _convert_to_forwarded_email(
+        incoming_email_bytes=email.as_bytes(),
+        headers=headers,
+        to_address="mask@relay.example.com",
+        from_address="sender@example.com",
+        language="en",
+        has_premium=False,
+        sample_trackers=False,
+        remove_level_one_trackers=False,
+    )
+    assert has_text
+    text_body = forwarded.get_body("plain")
+    assert text_body is not None
+    assert text_body["Content-Transfer-Encoding"] == "quoted-printable"
+    assert text_body.get_content_charset() == "utf-8"
@@ -1,29 +1,40 @@
 import base64
 import contextlib
+from contextvars import ContextVar
 from email.errors import InvalidHeaderDefect
+from email.generator import BytesGenerator
 from email.headerregistry import Address, AddressHeader
 from email.message import EmailMessage
 from email.utils import formataddr, parseaddr
 from functools import cache
-from typing import cast, Any, Callable, TypeVar
+from hashlib import sha256
+import html
+from io import BytesIO
+from typing import cast, Any, Callable, Iterator, Literal, TypedDict, TypeVar
 import json
+import os
 import pathlib
 import re
+from time import perf_counter
 from django.template.loader import render_to_string
-from django.utils.text import Truncator
+from django.utils.html import urlize as html_urlize
+from django.utils.text import normalize_newlines, Truncator
 import requests
 
 from botocore.exceptions import ClientError
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.hkdf import HKDFExpand
 from mypy_boto3_ses.type_defs import ContentTypeDef, SendRawEmailResponseTypeDef
 import jwcrypto.jwe
 import jwcrypto.jwk
 import markus
+from markus.utils import generate_tag
 import logging
 from urllib.parse import quote_plus, urlparse
 
 from django.apps import apps
+from django.core.cache import cache as django_cache
 from django.conf import settings
 from django.contrib.auth.models import Group, User
 from django.template.defaultfilters import linebreaksbr, urlize
@@ -40,6 +51,7 @@ from .models import (
     Reply,
     get_domains_from_settings,
 )
+from .reply_buffer import add_reply_record
 from .types import AWS_MailJSON
 
 
@@ -140,6 +152,101 @@ def gauge_if_enabled(name, value, tags=None):
         metrics.gauge(name, value, tags)
 
 
+class StageTimings:
+    """
+    The time spent in each stage of processing an email.
+
+    The times are added by time_stage() and add_stage_time() while this is the
+    active StageTimings, set by record_stage_timings().
+    """
+
+    # Upper size limits (exclusive) for the size tag
+    SIZE_BUCKETS = (
+        (10_000, "under_10kb"),
+        (100_000, "under_100kb"),
+        (1_000_000, "under_1mb"),
+        (10_000_000, "under_10mb"),
+    )
+
+    def __init__(self) -> None:
+        self.seconds: dict[str, float] = {}
+        self.transport = "none"
+        self.size = "unknown"
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def set_email(self, transport: str, size: int) -> None:
+        """Set the email transport and size, used to tag the metrics."""
+        self.transport = transport
+        for limit, name in self.SIZE_BUCKETS:
+            if size < limit:
+                self.size = name
+                break
+        else:
+            self.size = "over_10mb"
+
+    def log_data(self) -> dict[str, float]:
+        """Return the stage times in seconds, with millisecond precision."""
+        return {stage: round(seconds, 3) for stage, seconds in self.seconds.items()}
+
+    def emit_metrics(self) -> None:
+        """Emit a histogram of milliseconds for each stage."""
+        tags = [
+            generate_tag("transport", self.transport),
+            generate_tag("size", self.size),
+        ]
+        for stage, seconds in self.seconds.items():
+            histogram_if_enabled(
+                f"email_stage.{stage}", round(seconds * 1000), tags=tags
+            )
+
+
+_stage_timings: ContextVar[StageTimings | None] = ContextVar(
+    "stage_timings", default=None
+)
+
+
+@contextlib.contextmanager
+def record_stage_timings() -> Iterator[StageTimings]:
+    """Record the stage times while processing an email, then emit metrics."""
+    timings = StageTimings()
+    token = _stage_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _stage_timings.reset(token)
+        timings.emit_metrics()
+
+
+@contextlib.contextmanager
+def time_stage(stage: str) -> Iterator[None]:
+    """Add the time spent in the block to a stage, if recording stage times."""
+    timings = _stage_timings.get()
+    if timings is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(stage, perf_counter() - start)
+
+
+def add_stage_time(stage: str, seconds: float) -> None:
+    """Add an already measured time to a stage, if recording stage times."""
+    timings = _stage_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+def set_stage_email(transport: str, size: int) -> None:
+    """Set the email transport and size for the stage metrics, if recording."""
+    timings = _stage_timings.get()
+    if timings is not None:
+        timings.set_email(transport, size)
+
+
 def get_email_domain_from_settings():
     email_network_locality = urlparse(settings.SITE_ORIGIN).netloc
     # on dev server we need to add "mail" prefix
@@ -149,6 +256,70 @@ def get_email_domain_from_settings():
     return email_network_locality
 
 
+# The states of a cached mask resolution:
+# * "relay" - a RelayAddress created after the address filter was built
+# * "domain" - the DomainAddress with the id
+# * "deleted" - a deleted RelayAddress
+# * "unknown" - a RelayAddress that was never created
+# * "no_subdomain" - a subdomain that no user has claimed
+AddressCacheState = Literal["relay", "domain", "deleted", "unknown", "no_subdomain"]
+
+
+class AddressCacheRecord(TypedDict):
+    state: AddressCacheState
+    id: int | None
+
+
+def _address_cache_key(local_portion: str, domain_portion: str) -> str:
+    # Cache keys must be short and printable, email addresses may not be
+    address = f"{local_portion}@{domain_portion}".encode()
+    return f"emails.address:{sha256(address).hexdigest()}"
+
+
+def get_cached_address(
+    local_portion: str, domain_portion: str
+) -> AddressCacheRecord | None:
+    """
+    Get the cached resolution of an email address to a mask.
+
+    A record for the whole domain, set with an empty local_portion, is returned
+    instead of the record for the address.
+
+    Emits a counter metric "address_cache" with the tag "result:hit" or
+    "result:miss", and "state" for hits.
+    """
+    address_key = _address_cache_key(local_portion, domain_portion)
+    domain_key = _address_cache_key("", domain_portion)
+    records: dict[str, AddressCacheRecord] = django_cache.get_many(
+        [address_key, domain_key]
+    )
+    record = records.get(domain_key, records.get(address_key))
+    if record is None:
+        incr_if_enabled("address_cache", 1, tags=[generate_tag("result", "miss")])
+    else:
+        tags = [generate_tag("result", "hit"), generate_tag("state", record["state"])]
+        incr_if_enabled("address_cache", 1, tags=tags)
+    return record
+
+
+def set_cached_address(
+    local_portion: str,
+    domain_portion: str,
+    record: AddressCacheRecord,
+    timeout: int | None = None,
+) -> None:
+    """Cache the resolution of an email address, default ADDRESS_CACHE_TIMEOUT."""
+    django_cache.set(
+        _address_cache_key(local_portion, domain_portion),
+        record,
+        settings.ADDRESS_CACHE_TIMEOUT if timeout is None else timeout,
+    )
+
+
+def delete_cached_address(local_portion: str, domain_portion: str) -> None:
+    django_cache.delete(_address_cache_key(local_portion, domain_portion))
+
+
 def parse_email_header(header_value: str) -> list[tuple[str, str]]:
     """
     Extract the (display name, email address) pairs from a header value.
@@ -217,6 +388,44 @@ def get_welcome_email(user: User, format: str) -> str:
     )
 
 
+class _BytesGenerator(BytesGenerator):
+    """
+    A BytesGenerator that writes each body in a single call.
+
+    The base Generator splits a body with a regex and writes it one line at a time,
+    and BytesGenerator encodes each line to bytes separately. For large bodies,
+    that is most of the serialization time.
+    """
+
+    def _write_lines(self, lines: str) -> None:
+        if not lines:
+            return
+        # Convert line endings to the policy's linesep, like NLCRE.split()
+        if "\r" in lines:
+            lines = lines.replace("\r\n", "\n").replace("\r", "\n")
+        linesep = self._NL  # type: ignore[attr-defined]
+        if linesep != "\n":
+            lines = lines.replace("\n", linesep)
+        self.write(lines)
+
+
+def email_message_as_bytes(message: EmailMessage) -> bytes:
+    """
+    Serialize an email to bytes, for sending with SES.
+
+    This skips the str copy of the email that message.as_string() builds, and that
+    botocore then has to encode to bytes again. The output is the same as
+    message.as_string(), since 8bit parts are still converted to a 7bit-safe
+    Content-Transfer-Encoding.
+    """
+    buffer = BytesIO()
+    generator = _BytesGenerator(
+        buffer, mangle_from_=False, policy=message.policy.clone(cte_type="7bit")
+    )
+    generator.flatten(message)
+    return buffer.getvalue()
+
+
 @time_if_enabled("ses_send_raw_email")
 def ses_send_raw_email(
     source_address: str,
@@ -228,13 +437,16 @@ def ses_send_raw_email(
     ses_client = emails_config.ses_client
     assert ses_client
     assert settings.AWS_SES_CONFIGSET
+    with time_stage("serialize"):
+        data = email_message_as_bytes(message)
     try:
-        ses_response = ses_client.send_raw_email(
-            Source=source_address,
-            Destinations=[destination_address],
-            RawMessage={"Data": message.as_string()},
-            ConfigurationSetName=settings.AWS_SES_CONFIGSET,
-        )
+        with time_stage("ses_send"):
+            ses_response = ses_client.send_raw_email(
+                Source=source_address,
+                Destinations=[destination_address],
+                RawMessage={"Data": data},
+                ConfigurationSetName=settings.AWS_SES_CONFIGSET,
+            )
         incr_if_enabled("ses_send_raw_email", 1)
         return ses_response
     except ClientError as e:
@@ -252,24 +464,83 @@ def _store_reply_record(
             reply_metadata[header["name"].lower()] = header["value"]
     message_id_bytes = get_message_id_bytes(message_id)
     (lookup_key, encryption_key) = derive_reply_keys(message_id_bytes)
-    lookup = b64_lookup_key(lookup_key)
-    encrypted_metadata = encrypt_reply_metadata(encryption_key, reply_metadata)
-    reply_create_args: dict[str, Any] = {
-        "lookup": lookup,
-        "encrypted_metadata": encrypted_metadata,
-    }
+    reply_create_args: dict[str, Any]
+    if settings.REPLY_RECORD_BINARY_FORMAT:
+        reply_create_args = {
+            "lookup_key": lookup_key,
+            "metadata": encrypt_reply_metadata_binary(encryption_key, reply_metadata),
+        }
+    else:
+        reply_create_args = {
+            "lookup": b64_lookup_key(lookup_key),
+            "encrypted_metadata": encrypt_reply_metadata(
+                encryption_key, reply_metadata
+            ),
+        }
     if type(address) == DomainAddress:
         reply_create_args["domain_address"] = address
     elif type(address) == RelayAddress:
         reply_create_args["relay_address"] = address
-    Reply.objects.create(**reply_create_args)
+    add_reply_record(Reply(**reply_create_args))
     return mail
 
 
+def reencode_reply_record(
+    reply_record: Reply, encryption_key: bytes, metadata: dict[str, str]
+) -> None:
+    """
+    Store a Reply record in the binary format, if enabled.
+
+    The metadata of older Reply records can only be encrypted again when a reply
+    provides the encryption key.
+    """
+    if not settings.REPLY_RECORD_BINARY_FORMAT or reply_record.metadata is not None:
+        return
+    reply_record.lookup_key = reply_record.raw_lookup_key
+    reply_record.metadata = encrypt_reply_metadata_binary(encryption_key, metadata)
+    reply_record.lookup = None
+    reply_record.encrypted_metadata = None
+    Reply.objects.filter(id=reply_record.id).update(
+        lookup_key=reply_record.lookup_key,
+        metadata=reply_record.metadata,
+        lookup=None,
+        encrypted_metadata=None,
+    )
+
+
 def urlize_and_linebreaks(text, autoescape=True):
     return linebreaksbr(urlize(text, autoescape=autoescape), autoescape=autoescape)
 
 
+# A word that Django's urlize could turn into a link. Words are split on the same
+# characters as urlize, and must contain an email or URL marker. It only matches at
+# the start of a word, so the scan is linear.
+_LINKIFY_WORD_RE = re.compile(
+    r"""(?<![^\s<>"'])[^\s<>"']*?"""
+    r"""(?:@|://|www\.|\.(?:com|edu|gov|int|net|org))[^\s<>"']*""",
+    re.IGNORECASE,
+)
+
+
+def linkify_and_linebreaks(text: str) -> str:
+    """
+    Convert plain text to HTML, with links and <br> tags for line breaks.
+
+    The output is the same as urlize_and_linebreaks(text). Django's urlize checks
+    every word of the text in Python, which is slow for large emails. This finds
+    the few words that could be links in one regex scan, passes those words to
+    urlize, and escapes the rest of the text in large chunks.
+    """
+    parts = []
+    position = 0
+    for match in _LINKIFY_WORD_RE.finditer(text):
+        parts.append(html.escape(text[position : match.start()]))
+        parts.append(html_urlize(match.group(), nofollow=True, autoescape=True))
+        position = match.end()
+    parts.append(html.escape(text[position:]))
+    return normalize_newlines("".join(parts)).replace("\n", "<br>")
+
+
 def get_reply_to_address(premium: bool = True) -> str:
     """Return the address that relays replies."""
     if premium:
@@ -368,8 +639,34 @@ def encrypt_reply_metadata(key: bytes, payload: dict[str, str]) -> str:
     return cast(str, e.serialize(compact=True))
 
 
+# Version byte of the binary Reply metadata, followed by the nonce and ciphertext
+REPLY_METADATA_VERSION = b"\x01"
+_REPLY_METADATA_NONCE_SIZE = 12
+
+
+def encrypt_reply_metadata_binary(key: bytes, payload: dict[str, str]) -> bytes:
+    """Encrypt the given payload into the binary format, using the given key."""
+    nonce = os.urandom(_REPLY_METADATA_NONCE_SIZE)
+    ciphertext = AESGCM(key).encrypt(
+        nonce, json.dumps(payload).encode(), REPLY_METADATA_VERSION
+    )
+    return REPLY_METADATA_VERSION + nonce + ciphertext
+
+
 def decrypt_reply_metadata(key, jwe):
-    """Decrypt the given JWE into a json payload, using the given key."""
+    """
+    Decrypt the given binary metadata or JWE into a json payload, using the given
+    key.
+    """
+    if isinstance(jwe, (bytes, memoryview)):
+        encrypted = bytes(jwe)
+        version = encrypted[:1]
+        if version != REPLY_METADATA_VERSION:
+            raise ValueError(f"Unknown reply metadata version {version!r}")
+        nonce = encrypted[1 : 1 + _REPLY_METADATA_NONCE_SIZE]
+        ciphertext = encrypted[1 + _REPLY_METADATA_NONCE_SIZE :]
+        return AESGCM(key).decrypt(nonce, ciphertext, version)
+
     # This is a bit dumb, we have to base64-encode the key in order to load it :-/
     k = jwcrypto.jwk.JWK(
         kty="oct", k=base64.urlsafe_b64encode(key).rstrip(b"=").decode("ascii")
@@ -459,13 +756,23 @@ def convert_domains_to_regex_patterns(domain_pattern):
     return r"""(["'])(\S*://(\S*\.)*""" + re.escape(domain_pattern) + r"\S*)\1"
 
 
+@cache
+def _get_tracker_regex(tracker: str) -> re.Pattern[str]:
+    """
+    Compile the regex for a tracker domain once per process.
+
+    The tracker lists are larger than the re module's internal cache, so
+    re.subn(pattern, ...) would recompile the patterns for every email.
+    """
+    return re.compile(convert_domains_to_regex_patterns(tracker))
+
+
 def count_tracker(html_content, trackers):
     tracker_total = 0
     details = {}
     # html_content needs to be str for count()
     for tracker in trackers:
-        pattern = convert_domains_to_regex_patterns(tracker)
-        html_content, count = re.subn(pattern, "", html_content)
+        html_content, count = _get_tracker_regex(tracker).subn("", html_content)
         if count:
             tracker_total += count
             details[tracker] = count
@@ -484,38 +791,68 @@ def count_all_trackers(html_content):
     )
 
 
-def remove_trackers(html_content, from_address, datetime_now, level="general"):
+_IMG_TAG_RE = re.compile(r"<img\b[^>]*>", re.IGNORECASE)
+
+
+def remove_trackers(
+    html_content, from_address, datetime_now, level="general", images_only=False
+):
+    """
+    Replace tracker links with links to the tracker warning page.
+
+    If images_only is True, only <img> tags are searched for trackers. This is
+    cheaper for very large emails, but misses tracking links.
+    """
     trackers = general_trackers() if level == "general" else strict_trackers()
     tracker_removed = 0
-    changed_content = html_content
 
-    for tracker in trackers:
-        pattern = convert_domains_to_regex_patterns(tracker)
-
-        def convert_to_tracker_warning_link(matchobj):
-            quote, original_link, _ = matchobj.groups()
-            tracker_link_details = {
-                "sender": from_address,
-                "received_at": datetime_now,
-                "original_link": original_link,
-            }
-            anchor = quote_plus(json.dumps(tracker_link_details, separators=(",", ":")))
-            url = f"{settings.SITE_ORIGIN}/contains-tracker-warning/#{anchor}"
-            return f"{quote}{url}{quote}"
-
-        changed_content, matched = re.subn(
-            pattern, convert_to_tracker_warning_link, changed_content
+    # The anchor is the quoted JSON of the sender, received_at, and
+    # original_link. Only the original link changes per match, so the rest is
+    # encoded once per email.
+    tracker_link_prefix = json.dumps(
+        {"sender": from_address, "received_at": datetime_now},
+        separators=(",", ":"),
+    )[:-1]
+    url_prefix = f"{settings.SITE_ORIGIN}/contains-tracker-warning/#" + quote_plus(
+        f'{tracker_link_prefix},"original_link":'
+    )
+    url_suffix = quote_plus("}")
+
+    def convert_to_tracker_warning_link(matchobj):
+        quote, original_link, _ = matchobj.groups()
+        anchor = quote_plus(json.dumps(original_link))
+        return f"{quote}{url_prefix}{anchor}{url_suffix}{quote}"
+
+    def replace_trackers(content):
+        nonlocal tracker_removed
+        for tracker in trackers:
+            content, matched = _get_tracker_regex(tracker).subn(
+                convert_to_tracker_warning_link, content
+            )
+            tracker_removed += matched
+        return content
+
+    if images_only:
+        changed_content = _IMG_TAG_RE.sub(
+            lambda matchobj: replace_trackers(matchobj.group(0)), html_content
         )
-        tracker_removed += matched
+        searched_content = "\n".join(_IMG_TAG_RE.findall(html_content))
+    else:
+        changed_content = replace_trackers(html_content)
+        searched_content = html_content
 
-    level_one_detail = count_tracker(html_content, general_trackers())
-    level_two_detail = count_tracker(html_content, strict_trackers())
+    level_one_detail = count_tracker(searched_content, general_trackers())
+    level_two_detail = count_tracker(searched_content, strict_trackers())
 
     tracker_details = {
         "tracker_removed": tracker_removed,
         "level_one": level_one_detail,
     }
-    logger_details = {"level": level, "level_two": level_two_detail}
+    logger_details = {
+        "level": level,
+        "level_two": level_two_detail,
+        "images_only": images_only,
+    }
     logger_details.update(tracker_details)
     info_logger.info(
         "email_tracker_summary",
@@ -1,8 +1,9 @@
-from copy import deepcopy
+from collections import defaultdict
 from datetime import datetime, timezone
 from email import message_from_bytes, policy
 from email.iterators import _structure
 from email.message import EmailMessage
+from email.parser import BytesHeaderParser
 from email.utils import parseaddr
 import html
 from io import StringIO
@@ -12,22 +13,22 @@ import logging
 import re
 import shlex
 from textwrap import dedent
-from typing import Any, Literal, Optional
+from typing import Any, Iterable, Literal, Optional
 from urllib.parse import urlencode
 
 from botocore.exceptions import ClientError
 from codetiming import Timer
 from decouple import strtobool
+import django_ftl
 from django.shortcuts import render
 from sentry_sdk import capture_message
 from markus.utils import generate_tag
-from waffle import sample_is_active
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import transaction
-from django.db.models import prefetch_related_objects
+from django.db import IntegrityError, transaction
+from django.db.models import Q, prefetch_related_objects
 from django.http import HttpRequest, HttpResponse
 from django.template.loader import render_to_string
 from django.utils.html import escape
@@ -52,27 +53,38 @@ from .types import (
 from .utils import (
     _get_bucket_and_key_from_s3_json,
     _store_reply_record,
+    add_stage_time,
+    AddressCacheRecord,
+    AddressCacheState,
     b64_lookup_key,
     count_all_trackers,
     decrypt_reply_metadata,
     derive_reply_keys,
     generate_from_header,
+    get_cached_address,
     get_message_content_from_s3,
     get_message_id_bytes,
     get_reply_to_address,
     histogram_if_enabled,
     incr_if_enabled,
+    reencode_reply_record,
     remove_message_from_s3,
     remove_trackers,
     ses_send_raw_email,
-    urlize_and_linebreaks,
+    set_cached_address,
+    set_stage_email,
+    time_stage,
+    linkify_and_linebreaks,
     InvalidFromHeader,
     parse_email_header,
 )
+from .address_filter import get_address_filter, is_recent_relay_address
+from .counters import increment_mask_counters
+from .reply_buffer import get_pending_reply_records
 from .sns import verify_from_sns, SUPPORTED_SNS_TYPES
 
 from privaterelay.ftl_bundles import main as ftl_bundle
-from privaterelay.utils import flag_is_active_in_task
+from privaterelay.utils import flag_is_active_in_task, sample_is_active_in_task
 
 logger = logging.getLogger("events")
 info_logger = logging.getLogger("eventsinfo")
@@ -144,6 +156,13 @@ def first_forwarded_email_test(request: HttpRequest) -> HttpResponse:
     return render(request, "emails/first_forwarded_email.html", email_context)
 
 
+# Stands in for the original HTML when rendering a lite wrapped email
+_ORIGINAL_HTML_PLACEHOLDER = "<!-- relay-original-html -->"
+
+# How much work is done to convert the HTML content of a forwarded email
+HtmlConversionTier = Literal["full", "lite", "text_only"]
+
+
 def wrap_html_email(
     original_html: str,
     language: str,
@@ -151,10 +170,16 @@ def wrap_html_email(
     display_email: str,
     num_level_one_email_trackers_removed: int | None = None,
     tracker_report_link: str | None = None,
+    lite: bool = False,
 ) -> str:
-    """Add Relay banners, surveys, etc. to an HTML email"""
+    """
+    Add Relay banners, surveys, etc. to an HTML email
+
+    If lite is True, the original HTML is inserted after rendering, so that a large
+    email is not copied by the template engine or searched for empty lines.
+    """
     email_context = {
-        "original_html": original_html,
+        "original_html": _ORIGINAL_HTML_PLACEHOLDER if lite else original_html,
         "language": language,
         "has_premium": has_premium,
         "display_email": display_email,
@@ -165,7 +190,12 @@ def wrap_html_email(
     content = render_to_string("emails/wrapped_email.html", email_context)
     # Remove empty lines
     content_lines = [line for line in content.splitlines() if line.strip()]
-    return "\n".join(content_lines) + "\n"
+    wrapped_html = "\n".join(content_lines) + "\n"
+    if lite:
+        wrapped_html = wrapped_html.replace(
+            _ORIGINAL_HTML_PLACEHOLDER, original_html, 1
+        )
+    return wrapped_html
 
 
 def wrapped_email_test(request: HttpRequest) -> HttpResponse:
@@ -517,9 +547,10 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
         # FIXME: this ambiguous return of either
         # RelayAddress or DomainAddress types makes the Rustacean in me throw
         # up a bit.
-        address = _get_address(to_address)
-        prefetch_related_objects([address.user], "socialaccount_set", "profile")
-        user_profile = address.user.profile
+        with time_stage("address"):
+            address = _get_address(to_address)
+            prefetch_related_objects([address.user], "profile__fxa_snapshot")
+            user_profile = address.user.profile
     except (
         ObjectDoesNotExist,
         CannotMakeAddressException,
@@ -557,8 +588,8 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
 
     # check if this is a reply from an external sender to a Relay user
     try:
-        (lookup_key, _) = _get_keys_from_headers(mail["headers"])
-        reply_record = _get_reply_record_from_lookup_key(lookup_key)
+        with time_stage("reply_lookup"):
+            reply_record, _ = _get_reply_record_from_headers(mail["headers"])
         address = reply_record.address
         message_id = _get_message_id_from_headers(mail["headers"])
         # make sure the relay user is premium
@@ -578,8 +609,7 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
     # if address is set to block, early return
     if not address.enabled:
         incr_if_enabled("email_for_disabled_address", 1)
-        address.num_blocked += 1
-        address.save(update_fields=["num_blocked"])
+        increment_mask_counters(address, num_blocked=1)
         _record_receipt_verdicts(receipt, "disabled_alias")
         # TODO: Add metrics
         return HttpResponse("Address is temporarily disabled.")
@@ -595,8 +625,7 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
         and _check_email_from_list(mail["headers"])
     ):
         incr_if_enabled("list_email_for_address_blocking_lists", 1)
-        address.num_blocked += 1
-        address.save(update_fields=["num_blocked"])
+        increment_mask_counters(address, num_blocked=1)
         return HttpResponse("Address is not accepting list emails.")
 
     # Collect new headers
@@ -640,9 +669,11 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
         logger.error("s3_client_error_get_email", extra=e.response["Error"])
         # we are returning a 503 so that SNS can retry the email processing
         return HttpResponse("Cannot fetch the message content from S3", status=503)
+    add_stage_time("load", load_time_s)
+    set_stage_email(transport, len(incoming_email_bytes))
 
     # Convert to new email
-    sample_trackers = bool(sample_is_active("tracker_sample"))
+    sample_trackers = sample_is_active_in_task("tracker_sample")
     tracker_removal_flag = flag_is_active_in_task("tracker_removal", address.user)
     remove_level_one_trackers = bool(
         tracker_removal_flag and user_profile.remove_level_one_email_trackers
@@ -679,25 +710,21 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
         return HttpResponse("SES client error on Raw Email", status=503)
 
     message_id = ses_response["MessageId"]
-    _store_reply_record(mail, message_id, address)
+    with time_stage("db"):
+        _store_reply_record(mail, message_id, address)
 
-    user_profile.update_abuse_metric(
-        email_forwarded=True, forwarded_email_size=len(incoming_email_bytes)
-    )
-    address.num_forwarded += 1
-    address.last_used_at = datetime.now(timezone.utc)
-    if level_one_trackers_removed:
-        address.num_level_one_trackers_blocked = (
-            address.num_level_one_trackers_blocked or 0
-        ) + level_one_trackers_removed
-    address.save(
-        update_fields=[
-            "num_forwarded",
-            "last_used_at",
-            "block_list_emails",
-            "num_level_one_trackers_blocked",
-        ]
-    )
+        user_profile.update_abuse_metric(
+            email_forwarded=True, forwarded_email_size=len(incoming_email_bytes)
+        )
+        increment_mask_counters(
+            address,
+            num_forwarded=1,
+            num_level_one_trackers_blocked=level_one_trackers_removed or 0,
+            used=True,
+        )
+        if address.block_list_emails and not user_profile.has_premium:
+            # Saving turns off blocking list emails for former premium users
+            address.save(update_fields=["block_list_emails"])
     return HttpResponse("Sent email to final recipient.", status=200)
 
 
@@ -733,33 +760,62 @@ def _get_message_id_from_headers(headers):
     return message_id
 
 
-def _get_keys_from_headers(headers):
-    in_reply_to = None
+def _get_reply_keys_from_headers(headers) -> list[tuple[bytes, bytes]]:
+    """
+    Derive the lookup and encryption keys of the Reply records that an email may
+    reply to, from the In-Reply-To header or the References header.
+
+    The keys are in the order of the message ids in the header.
+    """
     for header in headers:
         if header["name"].lower() == "in-reply-to":
-            in_reply_to = header["value"]
-            message_id_bytes = get_message_id_bytes(in_reply_to)
-            return derive_reply_keys(message_id_bytes)
-
-        if header["name"].lower() == "references":
-            message_ids = header["value"]
-            for message_id in message_ids.split(" "):
-                message_id_bytes = get_message_id_bytes(message_id)
-                lookup_key, encryption_key = derive_reply_keys(message_id_bytes)
-                try:
-                    # FIXME: calling code is likely to duplicate this query
-                    _get_reply_record_from_lookup_key(lookup_key)
-                    return lookup_key, encryption_key
-                except Reply.DoesNotExist:
-                    pass
-            raise Reply.DoesNotExist
+            message_ids = [header["value"]]
+        elif header["name"].lower() == "references":
+            message_ids = header["value"].split()
+        else:
+            continue
+        return [
+            derive_reply_keys(get_message_id_bytes(message_id))
+            for message_id in message_ids
+        ]
     incr_if_enabled("mail_to_replies_without_reply_headers", 1)
     raise ReplyHeadersNotFound
 
 
-def _get_reply_record_from_lookup_key(lookup_key):
-    lookup = b64_lookup_key(lookup_key)
-    return Reply.objects.get(lookup=lookup)
+def _get_reply_record_from_headers(headers) -> tuple[Reply, bytes]:
+    """
+    Get the Reply record that an email replies to, and its encryption key.
+
+    The Reply records for all the message ids in the reply headers are
+    looked up with one query, and the first in header order is returned. The
+    address, user, and profile are loaded with the record.
+
+    Raises ReplyHeadersNotFound if there are no reply headers, and
+    Reply.DoesNotExist if no message id has a Reply record.
+    """
+    encryption_keys: dict[bytes, bytes] = {}
+    for lookup_key, encryption_key in _get_reply_keys_from_headers(headers):
+        encryption_keys.setdefault(lookup_key, encryption_key)
+    # Reply records are in the binary format, or have a base64 lookup key
+    reply_records: dict[bytes, Reply] = {}
+    for reply_record in (
+        Reply.objects.filter(
+            Q(lookup_key__in=list(encryption_keys))
+            | Q(lookup__in=[b64_lookup_key(key) for key in encryption_keys])
+        )
+        .select_related(
+            "relay_address__user__profile__fxa_snapshot",
+            "domain_address__user__profile__fxa_snapshot",
+        )
+        .order_by("id")
+    ):
+        reply_records.setdefault(reply_record.raw_lookup_key, reply_record)
+    if missing := [key for key in encryption_keys if key not in reply_records]:
+        reply_records.update(get_pending_reply_records(missing))
+    for lookup_key, encryption_key in encryption_keys.items():
+        if lookup_key in reply_records:
+            return reply_records[lookup_key], encryption_key
+    raise Reply.DoesNotExist("Reply matching query does not exist.")
 
 
 def _strip_localpart_tag(address):
@@ -809,7 +865,8 @@ def _convert_to_forwarded_email(
     - has_html - True if the email has an HTML representation
     - has_text - True if the email has a plain text representation
     """
-    email = message_from_bytes(incoming_email_bytes, policy=policy.default)
+    with time_stage("parse"):
+        email = message_from_bytes(incoming_email_bytes, policy=policy.default)
     # python/typeshed issue 2418
     # The Python 3.2 default was Message, 3.6 uses policy.message_factory, and
     # policy.default.message_factory is EmailMessage
@@ -826,7 +883,8 @@ def _convert_to_forwarded_email(
         assert isinstance(text_body, EmailMessage)
         text_content = text_body.get_content()
         new_text_content = _convert_text_content(text_content, to_address)
-        text_body.set_content(new_text_content)
+        charset, cte = _get_body_encoding(new_text_content, text_body)
+        text_body.set_content(new_text_content, charset=charset, cte=cte)
 
     # Find and replace HTML content
     html_body = email.get_body("html")
@@ -845,10 +903,15 @@ def _convert_to_forwarded_email(
             sample_trackers,
             remove_level_one_trackers,
         )
-        html_body.set_content(new_content, subtype="html")
-    elif text_content:
+        charset, cte = _get_body_encoding(new_content, html_body)
+        html_body.set_content(new_content, subtype="html", charset=charset, cte=cte)
+    elif (
+        text_content
+        and (tier := _get_html_conversion_tier(text_content)) != "text_only"
+    ):
         # Try to use the text content to generate HTML content
-        html_content = urlize_and_linebreaks(text_content)
+        with time_stage("linkify"):
+            html_content = linkify_and_linebreaks(text_content)
         new_content, level_one_trackers_removed = _convert_html_content(
             html_content,
             to_address,
@@ -857,10 +920,14 @@ def _convert_to_forwarded_email(
             has_premium,
             sample_trackers,
             remove_level_one_trackers,
+            tier=tier,
         )
         assert isinstance(text_body, EmailMessage)
+        charset, cte = _get_body_encoding(new_content, text_body)
         try:
-            text_body.add_alternative(new_content, subtype="html")
+            text_body.add_alternative(
+                new_content, subtype="html", charset=charset, cte=cte
+            )
         except TypeError as e:
             out = StringIO()
             _structure(email, fp=out)
@@ -872,6 +939,73 @@ def _convert_to_forwarded_email(
     return (email, level_one_trackers_removed, has_html, has_text)
 
 
+def _parse_email_headers(email_bytes: bytes) -> EmailMessage:
+    """
+    Parse the headers of an email, and keep the body as unparsed text.
+
+    This is enough to replace the headers and send the email, without the cost of
+    parsing and regenerating the MIME parts. The body line endings are normalized
+    to match the generated headers.
+
+    If the email has 8-bit content, it is fully parsed, so that the parts can be
+    converted to 7-bit safe encodings when sent.
+    """
+    if not email_bytes.isascii():
+        email = message_from_bytes(email_bytes, policy=policy.default)
+        assert isinstance(email, EmailMessage)
+        return email
+
+    email = BytesHeaderParser(policy=policy.default).parsebytes(email_bytes)
+    assert isinstance(email, EmailMessage)
+    body = email.get_payload()
+    assert isinstance(body, str)
+    if "\r" in body:
+        email.set_payload(body.replace("\r\n", "\n").replace("\r", "\n"))
+    return email
+
+
+# Bytes that quoted-printable encodes as three bytes, like "=3D"
+_QP_ESCAPED_BYTES = bytes(
+    byte
+    for byte in range(256)
+    if byte > 126 or byte == ord("=") or (byte < 32 and byte not in b"\t\r\n")
+)
+
+
+def _get_body_encoding(content: str, original: EmailMessage) -> tuple[str, str]:
+    """
+    Get the charset and Content-Transfer-Encoding for new body content.
+
+    The charset of the original part is kept if it can encode the content,
+    otherwise UTF-8 is used. The encoding is the most compact 7-bit safe encoding
+    for the whole content. EmailMessage.set_content() picks an encoding by looking
+    at the first 10 lines, and may pick 8bit, which is sent as base64 for UTF-8.
+
+    Return is a tuple of the charset and the Content-Transfer-Encoding.
+    """
+    charset = original.get_content_charset() or "utf-8"
+    try:
+        data = content.encode(charset)
+    except (LookupError, UnicodeEncodeError):
+        charset = "utf-8"
+        data = content.encode(charset)
+
+    max_line_length = original.policy.max_line_length or 78
+    if data.isascii() and all(
+        len(line) <= max_line_length for line in data.splitlines()
+    ):
+        return charset, "7bit"
+
+    # Estimate the encoded sizes, including the line breaks
+    escaped_count = len(data) - len(data.translate(None, _QP_ESCAPED_BYTES))
+    qp_size = len(data) + 2 * escaped_count
+    qp_size += 2 * (qp_size // (max_line_length - 3))
+    base64_size = (len(data) + 2) // 3 * 4
+    base64_size += base64_size // max_line_length
+    cte = "quoted-printable" if qp_size <= base64_size else "base64"
+    return charset, cte
+
+
 def _replace_headers(email: EmailMessage, headers: OutgoingHeaders) -> None:
     """Replace the headers in email with new headers."""
     # Look for headers to drop
@@ -906,7 +1040,25 @@ def _convert_html_content(
     sample_trackers: bool,
     remove_level_one_trackers: bool,
     now: datetime | None = None,
+    tier: HtmlConversionTier | None = None,
 ) -> tuple[str, int]:
+    """
+    Convert the HTML content of an email to the forwarded HTML content.
+
+    The work done depends on the size tier of the content:
+    - full: Sample and remove trackers, and wrap in the Relay template
+    - lite: Remove trackers in <img> tags only, and wrap without copying the content
+    - text_only: Replace the content with a short notice
+
+    Return is a tuple:
+    - The new HTML content
+    - The number of level one trackers removed
+    """
+    if tier is None:
+        tier = _get_html_conversion_tier(html_content)
+    if tier == "text_only":
+        return _build_html_too_large_notice(to_address, language), 0
+
     # frontend expects a timestamp in milliseconds
     now = now or datetime.now(timezone.utc)
     datetime_now_ms = int(now.timestamp() * 1000)
@@ -916,15 +1068,17 @@ def _convert_html_content(
     display_email = re.sub("([@.:])", r"<span>\1</span>", to_address)
 
     # sample tracker numbers
-    if sample_trackers:
-        count_all_trackers(html_content)
+    if sample_trackers and tier == "full":
+        with time_stage("trackers"):
+            count_all_trackers(html_content)
 
     tracker_report_link = ""
     removed_count = 0
     if remove_level_one_trackers:
-        html_content, tracker_details = remove_trackers(
-            html_content, from_address, datetime_now_ms
-        )
+        with time_stage("trackers"):
+            html_content, tracker_details = remove_trackers(
+                html_content, from_address, datetime_now_ms, images_only=tier == "lite"
+            )
         removed_count = tracker_details["tracker_removed"]
         tracker_report_details = {
             "sender": from_address,
@@ -935,17 +1089,38 @@ def _convert_html_content(
             tracker_report_details
         )
 
-    wrapped_html = wrap_html_email(
-        original_html=html_content,
-        language=language,
-        has_premium=has_premium,
-        display_email=display_email,
-        tracker_report_link=tracker_report_link,
-        num_level_one_email_trackers_removed=removed_count,
-    )
+    with time_stage("wrap"):
+        wrapped_html = wrap_html_email(
+            original_html=html_content,
+            language=language,
+            has_premium=has_premium,
+            display_email=display_email,
+            tracker_report_link=tracker_report_link,
+            num_level_one_email_trackers_removed=removed_count,
+            lite=tier == "lite",
+        )
     return wrapped_html, removed_count
 
 
+def _get_html_conversion_tier(content: str) -> HtmlConversionTier:
+    """Pick the HTML conversion tier by the size of the content."""
+    tier: HtmlConversionTier = "full"
+    if len(content) > settings.HTML_CONVERSION_MAX_SIZE:
+        tier = "text_only"
+    elif len(content) > settings.HTML_CONVERSION_LITE_SIZE:
+        tier = "lite"
+    incr_if_enabled("email_html_conversion_tier", tags=[generate_tag("tier", tier)])
+    return tier
+
+
+def _build_html_too_large_notice(to_address: str, language: str) -> str:
+    with django_ftl.override(language):
+        notice = ftl_bundle.format(
+            "relay-email-html-too-large", {"email_address": to_address}
+        )
+    return f"<p>{html.escape(notice)}</p>\n"
+
+
 def _convert_text_content(text_content: str, to_address: str) -> str:
     relay_header_text = (
         "This email was sent to your alias "
@@ -1063,8 +1238,8 @@ def _handle_reply(
 
     Returns (may be incomplete):
     * 200 if the reply was sent
-    * 400 if the In-Reply-To and References headers are missing, none of the References
-      headers are a reply record, or the SES client raises an error
+    * 400 if the In-Reply-To and References headers are missing, or the SES client
+      raises an error
     * 403 if the Relay user is not allowed to reply
     * 404 if the S3-stored email is not found, or there is no matching Reply record in
       the database
@@ -1076,13 +1251,13 @@ def _handle_reply(
     """
     mail = message_json["mail"]
     try:
-        (lookup_key, encryption_key) = _get_keys_from_headers(mail["headers"])
+        with time_stage("reply_lookup"):
+            reply_record, encryption_key = _get_reply_record_from_headers(
+                mail["headers"]
+            )
     except ReplyHeadersNotFound:
         incr_if_enabled("reply_email_header_error", 1, tags=["detail:no-header"])
         return HttpResponse("No In-Reply-To header", status=400)
-
-    try:
-        reply_record = _get_reply_record_from_lookup_key(lookup_key)
     except Reply.DoesNotExist:
         incr_if_enabled("reply_email_header_error", 1, tags=["detail:no-reply-record"])
         return HttpResponse("Unknown or stale In-Reply-To header", status=404)
@@ -1090,7 +1265,7 @@ def _handle_reply(
     address = reply_record.address
     message_id = _get_message_id_from_headers(mail["headers"])
     decrypted_metadata = json.loads(
-        decrypt_reply_metadata(encryption_key, reply_record.encrypted_metadata)
+        decrypt_reply_metadata(encryption_key, reply_record.stored_metadata)
     )
     if not _reply_allowed(
         from_address, to_address, reply_record, message_id, decrypted_metadata
@@ -1118,9 +1293,11 @@ def _handle_reply(
         logger.error("s3_client_error_get_email", extra=e.response["Error"])
         # we are returning a 500 so that SNS can retry the email processing
         return HttpResponse("Cannot fetch the message content from S3", status=503)
+    add_stage_time("load", load_time_s)
+    set_stage_email(transport, len(email_bytes))
 
-    email = message_from_bytes(email_bytes, policy=policy.default)
-    assert isinstance(email, EmailMessage)
+    with time_stage("parse"):
+        email = _parse_email_headers(email_bytes)
 
     # Convert to a reply email
     # TODO: Issue #1747 - Remove wrapper / prefix in replies
@@ -1136,9 +1313,11 @@ def _handle_reply(
         logger.error("ses_client_error", extra=e.response["Error"])
         return HttpResponse("SES client error", status=400)
 
-    reply_record.increment_num_replied()
-    profile = address.user.profile
-    profile.update_abuse_metric(replied=True)
+    with time_stage("db"):
+        reencode_reply_record(reply_record, encryption_key, decrypted_metadata)
+        reply_record.increment_num_replied()
+        profile = address.user.profile
+        profile.update_abuse_metric(replied=True)
     return HttpResponse("Sent email to final recipient.", status=200)
 
 
@@ -1158,30 +1337,65 @@ def _get_domain_address(local_portion: str, domain_portion: str) -> DomainAddres
     if address_domain != get_domains_from_settings()["MOZMAIL_DOMAIN"]:
         incr_if_enabled("email_for_not_supported_domain", 1)
         raise ObjectDoesNotExist("Address does not exist")
-    try:
-        with transaction.atomic():
-            locked_profile = Profile.objects.select_for_update().get(
-                subdomain=address_subdomain
+
+    cache_record = get_cached_address(local_portion, domain_portion)
+    if cache_record and cache_record["state"] == "no_subdomain":
+        incr_if_enabled("email_for_dne_subdomain", 1)
+        raise Profile.DoesNotExist("Profile matching query does not exist.")
+
+    # Existing DomainAddresses are read without locking the user's Profile
+    domain_numerical = get_domain_numerical(address_domain)
+    domain_addresses = DomainAddress.objects.select_related(
+        "user__profile__fxa_snapshot"
+    ).filter(address=local_portion, user__profile__subdomain=address_subdomain)
+    if cache_record and cache_record["state"] == "domain":
+        domain_address = domain_addresses.filter(id=cache_record["id"]).first()
+    else:
+        domain_address = domain_addresses.filter(domain=domain_numerical).first()
+
+    if domain_address is None:
+        try:
+            domain_address = _create_domain_address(local_portion, address_subdomain)
+        except Profile.DoesNotExist as e:
+            incr_if_enabled("email_for_dne_subdomain", 1)
+            set_cached_address(
+                "", domain_portion, {"state": "no_subdomain", "id": None}
             )
-            domain_numerical = get_domain_numerical(address_domain)
-            # filter DomainAddress because it may not exist
-            # which will throw an error with get()
-            domain_address = DomainAddress.objects.filter(
-                user=locked_profile.user, address=local_portion, domain=domain_numerical
-            ).first()
-            if domain_address is None:
-                # TODO: Consider flows when a user generating alias on a fly
-                # was unable to receive an email due to user no longer being a
-                # premium user as seen in exception thrown on make_domain_address
-                domain_address = DomainAddress.make_domain_address(
+            raise e
+    if not (cache_record and cache_record["id"] == domain_address.id):
+        set_cached_address(
+            local_portion, domain_portion, {"state": "domain", "id": domain_address.id}
+        )
+    return domain_address
+
+
+def _create_domain_address(local_portion: str, address_subdomain: str) -> DomainAddress:
+    """
+    Create a DomainAddress on the fly, or get one created by another request.
+
+    The user's Profile is locked, so that it can not change while the address
+    is created.
+    """
+    with transaction.atomic():
+        locked_profile = (
+            Profile.objects.select_for_update()
+            .select_related("user")
+            .get(subdomain=address_subdomain)
+        )
+        try:
+            # TODO: Consider flows when a user generating alias on a fly
+            # was unable to receive an email due to user no longer being a
+            # premium user as seen in exception thrown on make_domain_address
+            with transaction.atomic():
+                domain_address: DomainAddress = DomainAddress.make_domain_address(
                     locked_profile, local_portion, True
                 )
-            domain_address.last_used_at = datetime.now(timezone.utc)
-            domain_address.save()
             return domain_address
-    except Profile.DoesNotExist as e:
-        incr_if_enabled("email_for_dne_subdomain", 1)
-        raise e
+        except IntegrityError:
+            # Created since the lookup, by the API or by another email
+            return DomainAddress.objects.select_related(
+                "user__profile__fxa_snapshot"
+            ).get(user=locked_profile.user, address=local_portion)
 
 
 def _get_address(address: str) -> RelayAddress | DomainAddress:
@@ -1191,6 +1405,12 @@ def _get_address(address: str) -> RelayAddress | DomainAddress:
     If an unknown email address is for a valid subdomain, a new DomainAddress
     will be created.
 
+    The user, profile, and Mozilla account snapshot are loaded with the address.
+    Existing RelayAddresses are read from the database. Deleted and unknown RelayAddresses, unclaimed
+    subdomains, and the ids of DomainAddresses are cached, see
+    get_cached_address. Unknown RelayAddresses are rejected by the address
+    filter, if enabled, without reading the database, see emails.address_filter.
+
     On failure, raises exception based on Django's ObjectDoesNotExist:
     * RelayAddress.DoesNotExist - looks like RelayAddress, deleted or does not exist
     * Profile.DoesNotExist - looks like DomainAddress, no subdomain match
@@ -1207,28 +1427,78 @@ def _get_address(address: str) -> RelayAddress | DomainAddress:
     if domain not in email_domains:
         return _get_domain_address(local_address, domain)
 
-    # the domain is the site's 'top' relay domain, so look up the RelayAddress
+    # the domain is the site's 'top' relay domain, so look up the RelayAddress.
+    # Existing addresses are read from the database without using the cache.
+    domain_numerical = get_domain_numerical(domain)
+    cache_record: AddressCacheRecord | None = None
+    cache_checked = False
+    address_filter = get_address_filter()
+    if address_filter and not address_filter.may_be_relay_address(
+        local_address, domain_numerical
+    ):
+        # The address was not a RelayAddress when the filter was built. Allow
+        # it if it was created since then.
+        cache_record = get_cached_address(local_address, domain)
+        cache_checked = True
+        if not (
+            cache_record and cache_record["state"] == "relay"
+        ) and not is_recent_relay_address(
+            address_filter, local_address, domain_numerical
+        ):
+            # The deleted filter may have false positives
+            if (
+                cache_record and cache_record["state"] == "deleted"
+            ) or address_filter.may_be_deleted_address(
+                address_hash(local_address, domain=domain)
+            ):
+                incr_if_enabled("email_for_deleted_address", 1)
+            else:
+                incr_if_enabled("email_for_unknown_address", 1)
+            incr_if_enabled("address_filter_rejected", 1)
+            raise RelayAddress.DoesNotExist(
+                "RelayAddress matching query does not exist."
+            )
     try:
-        domain_numerical = get_domain_numerical(domain)
-        relay_address = RelayAddress.objects.get(
-            address=local_address, domain=domain_numerical
-        )
+        relay_address = RelayAddress.objects.select_related(
+            "user__profile__fxa_snapshot"
+        ).get(address=local_address, domain=domain_numerical)
         return relay_address
     except RelayAddress.DoesNotExist as e:
+        if not cache_checked:
+            cache_record = get_cached_address(local_address, domain)
+        if cache_record and cache_record["state"] in ("deleted", "unknown"):
+            incr_if_enabled(f"email_for_{cache_record['state']}_address", 1)
+            raise e
+        state: AddressCacheState = "unknown"
         try:
             DeletedAddress.objects.get(
                 address_hash=address_hash(local_address, domain=domain)
             )
             incr_if_enabled("email_for_deleted_address", 1)
+            state = "deleted"
             # TODO: create a hard bounce receipt rule in SES
         except DeletedAddress.DoesNotExist:
             incr_if_enabled("email_for_unknown_address", 1)
         except DeletedAddress.MultipleObjectsReturned:
             # not sure why this happens on stage but let's handle it
             incr_if_enabled("email_for_deleted_address_multiple", 1)
+            state = "deleted"
+        set_cached_address(local_address, domain, {"state": state, "id": None})
         raise e
 
 
+def _get_user_ids_by_email(addresses: Iterable[str]) -> dict[str, list[int]]:
+    """Get the ids of the users with the email addresses, with one query."""
+    user_ids_by_email: dict[str, list[int]] = defaultdict(list)
+    addresses = set(addresses)
+    if addresses:
+        for user_id, email in User.objects.filter(email__in=addresses).values_list(
+            "id", "email"
+        ):
+            user_ids_by_email[email].append(user_id)
+    return user_ids_by_email
+
+
 def _handle_bounce(message_json: AWS_SNSMessageJSON) -> HttpResponse:
     """
     Handle an AWS SES bounce notification.
@@ -1263,6 +1533,7 @@ def _handle_bounce(message_json: AWS_SNSMessageJSON) -> HttpResponse:
 
     now = datetime.now(timezone.utc)
     bounce_data = []
+    recipient_data: list[tuple[str, dict[str, Any]]] = []
     for recipient in bounced_recipients:
         recipient_address = recipient.pop("emailAddress", None)
         data = {
@@ -1284,34 +1555,43 @@ def _handle_bounce(message_json: AWS_SNSMessageJSON) -> HttpResponse:
         recipient_address = parseaddr(recipient_address)[1]
         recipient_domain = recipient_address.split("@")[1]
         data["domain"] = recipient_domain
+        recipient_data.append((recipient_address, data))
 
-        try:
-            user = User.objects.get(email=recipient_address)
-            profile = user.profile
-            data["user_match"] = "found"
-        except User.DoesNotExist:
+    user_ids_by_email = _get_user_ids_by_email(address for address, _ in recipient_data)
+    profile_updates: dict[str, dict[str, Any]] = {
+        "auto_block_spam": {"auto_block_spam": True},
+        "hard_bounce": {"last_hard_bounce": now},
+        "soft_bounce": {"last_soft_bounce": now},
+    }
+    user_ids_by_action: dict[str, set[int]] = defaultdict(set)
+    for recipient_address, data in recipient_data:
+        user_ids = user_ids_by_email.get(recipient_address)
+        if not user_ids:
             # TODO: handle bounce for a user who no longer exists
             # add to SES account-wide suppression list?
             data["user_match"] = "missing"
             continue
+        data["user_match"] = "found"
 
         action = None
         if "spam" in data["bounce_diagnostic"].lower():
             # if an email bounced as spam, set to auto block spam for this user
             # and DON'T set them into bounce pause state
             action = "auto_block_spam"
-            profile.auto_block_spam = True
         elif bounce_type == "Permanent":
             # TODO: handle sub-types: 'General', 'NoEmail', etc.
             action = "hard_bounce"
-            profile.last_hard_bounce = now
         elif bounce_type == "Transient":
             # TODO: handle sub-types: 'MessageTooLarge', 'AttachmentRejected', etc.
             action = "soft_bounce"
-            profile.last_soft_bounce = now
         if action:
             data["relay_action"] = action
-            profile.save()
+            user_ids_by_action[action].update(user_ids)
+
+    for action, action_user_ids in user_ids_by_action.items():
+        Profile.objects.filter(user_id__in=action_user_ids).update(
+            **profile_updates[action]
+        )
 
     if not bounce_data:
         # Data when there are no identified recipients
@@ -1376,15 +1656,16 @@ def _handle_complaint(message_json: AWS_SNSMessageJSON) -> HttpResponse:
     * subtype: 'onaccounsuppressionlist', or 'none'
     * feedback: feedback from ISP or 'none'
     """
-    complaint = deepcopy(message_json.get("complaint", {}))
-    complained_recipients = complaint.pop("complainedRecipients", [])
-    subtype = complaint.pop("complaintSubType", None)
-    user_agent = complaint.pop("userAgent", None)
-    feedback = complaint.pop("complaintFeedbackType", None)
+    complaint = message_json.get("complaint", {})
+    complained_recipients = complaint.get("complainedRecipients", [])
+    subtype = complaint.get("complaintSubType", None)
+    user_agent = complaint.get("userAgent", None)
+    feedback = complaint.get("complaintFeedbackType", None)
 
     complaint_data = []
+    recipient_data: list[tuple[str, dict[str, Any]]] = []
     for recipient in complained_recipients:
-        recipient_address = recipient.pop("emailAddress", None)
+        recipient_address = recipient.get("emailAddress", None)
         data = {
             "complaint_subtype": subtype,
             "complaint_user_agent": user_agent,
@@ -1392,8 +1673,9 @@ def _handle_complaint(message_json: AWS_SNSMessageJSON) -> HttpResponse:
             "user_match": "no_address",
             "relay_action": "no_action",
         }
-        if recipient:
-            data["complaint_extra"] = recipient.copy()
+        extra = {key: val for key, val in recipient.items() if key != "emailAddress"}
+        if extra:
+            data["complaint_extra"] = extra
         complaint_data.append(data)
 
         if recipient_address is None:
@@ -1402,18 +1684,21 @@ def _handle_complaint(message_json: AWS_SNSMessageJSON) -> HttpResponse:
         recipient_address = parseaddr(recipient_address)[1]
         recipient_domain = recipient_address.split("@")[1]
         data["domain"] = recipient_domain
+        recipient_data.append((recipient_address, data))
 
-        try:
-            user = User.objects.get(email=recipient_address)
-            profile = user.profile
-            data["user_match"] = "found"
-        except User.DoesNotExist:
+    user_ids_by_email = _get_user_ids_by_email(address for address, _ in recipient_data)
+    complainer_ids: set[int] = set()
+    for recipient_address, data in recipient_data:
+        user_ids = user_ids_by_email.get(recipient_address)
+        if not user_ids:
             data["user_match"] = "missing"
             continue
-
+        data["user_match"] = "found"
         data["relay_action"] = "auto_block_spam"
-        profile.auto_block_spam = True
-        profile.save()
+        complainer_ids.update(user_ids)
+
+    if complainer_ids:
+        Profile.objects.filter(user_id__in=complainer_ids).update(auto_block_spam=True)
 
     if not complaint_data:
         # Data when there are no identified recipients
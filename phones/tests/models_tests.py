@@ -744,6 +744,22 @@ def test_save_store_phone_log_false_deletes_data():
         inbound_contact.refresh_from_db()
 
 
+def test_save_store_phone_log_already_false_keeps_new_data(
+    django_assert_num_queries,
+):
+    user = make_phone_test_user()
+    profile = Profile.objects.get(user=user)
+    profile.store_phone_log = False
+    profile.save()
+    baker.make(RealPhone, user=user, verified=True)
+    relay_number = baker.make(RelayNumber, user=user)
+    inbound_contact = baker.make(InboundContact, relay_number=relay_number)
+
+    with django_assert_num_queries(1):  # The UPDATE of the profile
+        profile.save()
+    inbound_contact.refresh_from_db()
+
+
 def test_get_last_text_sender_returning_None():
     user = make_phone_test_user()
     baker.make(RealPhone, user=user, verified=True)
@@ -0,0 +1,143 @@
+"""
+In-process snapshot of the waffle flags and samples, for task code.
+
+flag_is_active_in_task() and sample_is_active_in_task() check flags and samples
+for every email and SMS. With FLAG_SNAPSHOT_TTL, each process loads all flags
+and samples into memory, with the ids of the users of each flag, directly or
+through its groups. Checks use the snapshot without I/O for FLAG_SNAPSHOT_TTL
+seconds, and then compare the version in the waffle cache, reloading the
+snapshot if it changed.
+
+Saving or deleting a flag or sample, or changing the users or groups of a flag,
+clears the snapshot of the process and changes the version, see
+privaterelay.signals. Users added to the group of a flag are found when the
+snapshot is reloaded.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+from decimal import Decimal
+from typing import Mapping
+from time import monotonic
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.auth.models import AbstractBaseUser, User
+from django.db import transaction
+
+from waffle import get_waffle_flag_model, get_waffle_sample_model
+from waffle.models import AbstractBaseFlag
+from waffle.utils import get_cache as get_waffle_cache
+
+FLAG_SNAPSHOT_VERSION_KEY = "privaterelay.flag_snapshot_version"
+
+
+class FlagSnapshot:
+    """The waffle flags and samples, and the ids of the users of each flag."""
+
+    def __init__(
+        self,
+        version: str,
+        flags: Mapping[str, AbstractBaseFlag],
+        flag_user_ids: dict[str, set[int]],
+        sample_percents: dict[str, Decimal],
+    ) -> None:
+        self.version = version
+        self.flags = flags
+        self.flag_user_ids = flag_user_ids
+        self.sample_percents = sample_percents
+
+    def is_active_for_user(
+        self, flag: AbstractBaseFlag, user: AbstractBaseUser
+    ) -> bool | None:
+        """Mirror flag.is_active_for_user(user), using the user ids."""
+        if flag.authenticated and user.is_authenticated:
+            return True
+        if flag.staff and getattr(user, "is_staff", False):
+            return True
+        if flag.superusers and getattr(user, "is_superuser", False):
+            return True
+        if user.pk in self.flag_user_ids.get(flag.name, ()):
+            return True
+        return None
+
+
+def load_flag_snapshot(version: str) -> FlagSnapshot:
+    """Load the FlagSnapshot from the database."""
+    flag_model = get_waffle_flag_model()
+    flags = {flag.name: flag for flag in flag_model.objects.all()}
+    flag_names = {flag.pk: flag.name for flag in flags.values()}
+
+    flag_user_ids: dict[str, set[int]] = defaultdict(set)
+    group_flag_names: dict[int, list[str]] = defaultdict(list)
+    if hasattr(flag_model, "users"):
+        for flag_id, user_id in flag_model.users.through.objects.values_list(
+            "flag_id", "user_id"
+        ):
+            flag_user_ids[flag_names[flag_id]].add(user_id)
+    if hasattr(flag_model, "groups"):
+        for flag_id, group_id in flag_model.groups.through.objects.values_list(
+            "flag_id", "group_id"
+        ):
+            group_flag_names[group_id].append(flag_names[flag_id])
+    if group_flag_names:
+        for group_id, user_id in User.groups.through._default_manager.filter(
+            group_id__in=group_flag_names
+        ).values_list("group_id", "user_id"):
+            for flag_name in group_flag_names[group_id]:
+                flag_user_ids[flag_name].add(user_id)
+
+    sample_percents = {
+        sample.name: sample.percent
+        for sample in get_waffle_sample_model().objects.all()
+    }
+    return FlagSnapshot(version, flags, dict(flag_user_ids), sample_percents)
+
+
+_loaded_snapshot: FlagSnapshot | None = None
+_checked_at: float | None = None
+
+
+def get_flag_snapshot() -> FlagSnapshot | None:
+    """
+    Get the FlagSnapshot loaded by this process, or None if disabled.
+
+    The version is checked every FLAG_SNAPSHOT_TTL seconds, and the snapshot is
+    reloaded if the version changed.
+    """
+    global _loaded_snapshot, _checked_at
+    ttl = getattr(settings, "FLAG_SNAPSHOT_TTL", 0)
+    if not ttl:
+        return None
+
+    now = monotonic()
+    if _loaded_snapshot is not None and _checked_at is not None:
+        if now - _checked_at < ttl:
+            return _loaded_snapshot
+
+    cache = get_waffle_cache()
+    version = cache.get(FLAG_SNAPSHOT_VERSION_KEY)
+    if version is None:
+        version = uuid4().hex
+        if not cache.add(FLAG_SNAPSHOT_VERSION_KEY, version, None):
+            version = cache.get(FLAG_SNAPSHOT_VERSION_KEY, version)
+    if _loaded_snapshot is None or _loaded_snapshot.version != version:
+        _loaded_snapshot = load_flag_snapshot(version)
+    _checked_at = now
+    return _loaded_snapshot
+
+
+def clear_loaded_flag_snapshot() -> None:
+    """Forget the loaded FlagSnapshot, so it is reloaded on next use."""
+    global _loaded_snapshot, _checked_at
+    _loaded_snapshot = None
+    _checked_at = None
+
+
+def invalidate_flag_snapshot() -> None:
+    """Reload the FlagSnapshot in this process, and in others after commit."""
+    clear_loaded_flag_snapshot()
+    transaction.on_commit(
+        lambda: get_waffle_cache().set(FLAG_SNAPSHOT_VERSION_KEY, uuid4().hex, None)
+    )
@@ -10,7 +10,11 @@ from django.core.management.base import BaseCommand, DjangoHelpFormatter
 
 from codetiming import Timer
 
-from emails.cleaners import ServerStorageCleaner, MissingProfileCleaner
+from emails.cleaners import (
+    FxaSnapshotCleaner,
+    MissingProfileCleaner,
+    ServerStorageCleaner,
+)
 
 
 if TYPE_CHECKING:  # pragma: no cover
@@ -32,6 +36,7 @@ class Command(BaseCommand):
     task_list: list[type[DataIssueTask]] = [
         ServerStorageCleaner,
         MissingProfileCleaner,
+        FxaSnapshotCleaner,
     ]
     tasks: dict[str, DataIssueTask]
 
@@ -4,3 +4,10 @@
 
 # This is the Django equivalent of frontend/pendingTranslations.ftl
 
+
+## Forwarded emails
+
+# Replaces the HTML content of a forwarded email that is too large to forward
+# Variables:
+#   $email_address (string) - The Relay email mask that received the email
+relay-email-html-too-large = This email was sent to your mask { $email_address }. The HTML content was too large to forward. If your email app has a plain text view, use it to read this email.
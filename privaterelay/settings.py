@@ -386,6 +386,33 @@ MAX_FORWARDED_PER_DAY = config("MAX_FORWARDED_PER_DAY", 1000, cast=int)
 MAX_FORWARDED_EMAIL_SIZE_PER_DAY = config(
     "MAX_FORWARDED_EMAIL_SIZE_PER_DAY", 1_000_000_000, cast=int
 )
+# Larger HTML emails get cheaper tracker removal and wrapping, in characters
+HTML_CONVERSION_LITE_SIZE = config("HTML_CONVERSION_LITE_SIZE", 1_000_000, cast=int)
+# Larger HTML emails are replaced with a notice, in characters
+HTML_CONVERSION_MAX_SIZE = config("HTML_CONVERSION_MAX_SIZE", 10_000_000, cast=int)
+# Seconds to cache the user id of a Mozilla account for the API, 0 to disable
+FXA_USER_CACHE_TIMEOUT = config("FXA_USER_CACHE_TIMEOUT", 60, cast=int)
+# Seconds the waffle flags and samples in memory are used by task code before
+# checking for changes, 0 to disable
+FLAG_SNAPSHOT_TTL = config("FLAG_SNAPSHOT_TTL", 0, cast=int)
+# Seconds to cache the resolution of email addresses to masks, 0 to disable
+ADDRESS_CACHE_TIMEOUT = config("ADDRESS_CACHE_TIMEOUT", 60 * 60, cast=int)
+# Seconds a rebuilt RelayAddress filter is used, 0 to disable. This should be
+# longer than the schedule of the rebuild_address_filter command.
+ADDRESS_FILTER_MAX_AGE = config("ADDRESS_FILTER_MAX_AGE", 0, cast=int)
+# Seconds between reloads of the RelayAddress filter in each process
+ADDRESS_FILTER_RELOAD_INTERVAL = config(
+    "ADDRESS_FILTER_RELOAD_INTERVAL", 5 * 60, cast=int
+)
+# Store new Reply records in the binary format. Enable after every process can
+# read it, and then run the reencode_reply_records command.
+REPLY_RECORD_BINARY_FORMAT = config("REPLY_RECORD_BINARY_FORMAT", False, cast=bool)
+# Reply records inserted at once by the process_emails_from_sqs worker, 0 to
+# insert each one when the email is forwarded
+REPLY_RECORD_BUFFER_SIZE = config("REPLY_RECORD_BUFFER_SIZE", 0, cast=int)
+# Seconds the Reply records waiting in a buffer are cached for replies. This
+# should be longer than a cycle of process_emails_from_sqs.
+REPLY_RECORD_BUFFER_TIMEOUT = config("REPLY_RECORD_BUFFER_TIMEOUT", 10 * 60, cast=int)
 PREMIUM_FEATURE_PAUSED_DAYS = config("ACCOUNT_PREMIUM_FEATURE_PAUSED_DAYS", 1, cast=int)
 
 SOFT_BOUNCE_ALLOWED_DAYS = config("SOFT_BOUNCE_ALLOWED_DAYS", 1, cast=int)
@@ -422,6 +449,15 @@ elif RELAY_CHANNEL == "local":
         }
     }
 
+# Add mask counters to Redis, and flush them with the flush_mask_counters command
+MASK_COUNTERS_WRITE_BEHIND = bool(REDIS_URL) and config(
+    "MASK_COUNTERS_WRITE_BEHIND", False, cast=bool
+)
+# Count abuse metrics in Redis, and save them with the persist_abuse_metrics command
+ABUSE_METRICS_WRITE_BEHIND = bool(REDIS_URL) and config(
+    "ABUSE_METRICS_WRITE_BEHIND", False, cast=bool
+)
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 # only needed when admin UI is enabled
@@ -1,9 +1,18 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 
 from allauth.account.signals import user_signed_up, user_logged_in
+from waffle import get_waffle_flag_model, get_waffle_sample_model
 
 from emails.utils import incr_if_enabled
 
+from .flag_snapshot import invalidate_flag_snapshot
+
+_flag_model = get_waffle_flag_model()
+_sample_model = get_waffle_sample_model()
+
 
 @receiver(user_signed_up)
 def record_user_signed_up(request, user, **kwargs):
@@ -25,3 +34,33 @@ def record_user_logged_in(request, user, **kwargs):
         event = "user_signed_up"
     if response:
         response.set_cookie(f"server_ga_event:{event}", event, max_age=5)
+
+
+@receiver(post_save, sender=_flag_model)
+@receiver(post_delete, sender=_flag_model)
+@receiver(post_save, sender=_sample_model)
+@receiver(post_delete, sender=_sample_model)
+def invalidate_flag_snapshot_on_change(sender, **kwargs):
+    invalidate_flag_snapshot()
+
+
+@receiver(m2m_changed, sender=_flag_model.users.through)
+@receiver(m2m_changed, sender=_flag_model.groups.through)
+def invalidate_flag_snapshot_on_flag_members_change(sender, action, **kwargs):
+    if action.startswith("post_"):
+        invalidate_flag_snapshot()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_flag_snapshot_on_group_members_change(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if not action.startswith("post_") or not settings.FLAG_SNAPSHOT_TTL:
+        return
+    # Users added to groups at sign up rarely change the members of a flag
+    group_ids = {instance.pk} if reverse else pk_set
+    if (
+        group_ids is None
+        or _flag_model.groups.through.objects.filter(group_id__in=group_ids).exists()
+    ):
+        invalidate_flag_snapshot()
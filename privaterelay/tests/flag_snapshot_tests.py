@@ -0,0 +1,122 @@
+from typing import Iterator
+from unittest.mock import patch
+
+from django.contrib.auth.models import Group, User
+
+from pytest_django.fixtures import SettingsWrapper
+from waffle.models import Flag, Sample
+from waffle.utils import get_cache as get_waffle_cache
+import pytest
+
+from ..flag_snapshot import (
+    FLAG_SNAPSHOT_VERSION_KEY,
+    clear_loaded_flag_snapshot,
+    get_flag_snapshot,
+    load_flag_snapshot,
+)
+from ..utils import flag_is_active_in_task, sample_is_active_in_task
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture(autouse=True)
+def flag_snapshot_settings(settings: SettingsWrapper) -> Iterator[SettingsWrapper]:
+    settings.FLAG_SNAPSHOT_TTL = 60
+    get_waffle_cache().clear()
+    clear_loaded_flag_snapshot()
+    yield settings
+    get_waffle_cache().clear()
+    clear_loaded_flag_snapshot()
+
+
+def test_get_flag_snapshot_disabled(settings: SettingsWrapper) -> None:
+    settings.FLAG_SNAPSHOT_TTL = 0
+    assert get_flag_snapshot() is None
+
+
+def test_load_flag_snapshot_user_ids() -> None:
+    user = User.objects.create(username="direct")
+    group_user = User.objects.create(username="in_group")
+    group = Group.objects.create(name="flag_group")
+    group.user_set.add(group_user)
+    flag = Flag.objects.create(name="test_flag")
+    flag.users.add(user)
+    flag.groups.add(group)
+    Flag.objects.create(name="other_flag")
+
+    snapshot = load_flag_snapshot("version")
+    assert snapshot.version == "version"
+    assert set(snapshot.flags) == {"test_flag", "other_flag"}
+    assert snapshot.flag_user_ids == {"test_flag": {user.id, group_user.id}}
+
+
+def test_flag_is_active_in_task_without_queries(django_assert_num_queries) -> None:
+    user = User.objects.create(username="flag_user")
+    Flag.objects.create(name="test_flag").users.add(user)
+    assert flag_is_active_in_task("test_flag", user)
+    with django_assert_num_queries(0):
+        assert flag_is_active_in_task("test_flag", user)
+        assert not flag_is_active_in_task("test_flag", None)
+
+
+def test_sample_is_active_in_task_uses_snapshot(django_assert_num_queries) -> None:
+    Sample.objects.create(name="test_sample", percent=50)
+    with patch("privaterelay.utils.random.uniform", return_value=49.0):
+        assert sample_is_active_in_task("test_sample")
+    with (
+        django_assert_num_queries(0),
+        patch("privaterelay.utils.random.uniform", return_value=50.1),
+    ):
+        assert not sample_is_active_in_task("test_sample")
+
+
+def test_saving_flag_clears_loaded_snapshot() -> None:
+    flag = Flag.objects.create(name="test_flag", everyone=False)
+    assert not flag_is_active_in_task("test_flag", None)
+    flag.everyone = True
+    flag.save()
+    assert flag_is_active_in_task("test_flag", None)
+
+
+def test_saving_flag_changes_version_on_commit(
+    django_capture_on_commit_callbacks,
+) -> None:
+    snapshot = get_flag_snapshot()
+    assert snapshot is not None
+    with django_capture_on_commit_callbacks(execute=True):
+        Flag.objects.create(name="test_flag")
+    assert get_waffle_cache().get(FLAG_SNAPSHOT_VERSION_KEY) != snapshot.version
+
+
+def test_snapshot_reloaded_after_ttl_when_version_changed() -> None:
+    with patch("privaterelay.flag_snapshot.monotonic", return_value=1000.0):
+        snapshot = get_flag_snapshot()
+    assert snapshot is not None
+    # Another process changed a flag
+    get_waffle_cache().set(FLAG_SNAPSHOT_VERSION_KEY, "new-version", None)
+    with patch("privaterelay.flag_snapshot.monotonic", return_value=1059.0):
+        assert get_flag_snapshot() is snapshot
+    with patch("privaterelay.flag_snapshot.monotonic", return_value=1060.0):
+        reloaded = get_flag_snapshot()
+    assert reloaded is not None
+    assert reloaded.version == "new-version"
+
+
+def test_snapshot_kept_after_ttl_when_version_unchanged(
+    django_assert_num_queries,
+) -> None:
+    with patch("privaterelay.flag_snapshot.monotonic", return_value=1000.0):
+        snapshot = get_flag_snapshot()
+    with (
+        django_assert_num_queries(0),
+        patch("privaterelay.flag_snapshot.monotonic", return_value=1060.0),
+    ):
+        assert get_flag_snapshot() is snapshot
+
+
+def test_adding_user_to_unrelated_group_keeps_snapshot() -> None:
+    user = User.objects.create(username="flag_user")
+    group = Group.objects.create(name="unrelated")
+    snapshot = get_flag_snapshot()
+    user.groups.add(group)
+    assert get_flag_snapshot() is snapshot
@@ -14,7 +14,7 @@ from emails.tests.cleaners_tests import setup_profile_mismatch_test_data
 
 COMMAND_NAME = "cleanup_data"
 MOCK_BASE = f"private_relay.management.commands.{COMMAND_NAME}"
-CLEANERS = {"server-storage", "missing-profile"}
+CLEANERS = {"server-storage", "missing-profile", "fxa-snapshot"}
 KNOWN_CLEANER = "server-storage"
 
 
@@ -14,6 +14,7 @@ from waffle.testutils import override_flag
 from waffle.utils import get_cache as get_waffle_cache
 import pytest
 
+from ..flag_snapshot import clear_loaded_flag_snapshot
 from ..plans import get_premium_country_language_mapping
 from ..utils import (
     AcceptLanguageError,
@@ -417,12 +418,22 @@ def waffle_settings(settings: SettingsWrapper) -> SettingsWrapper:
     return settings
 
 
+@pytest.fixture(params=["without_snapshot", "with_snapshot"])
+def flag_snapshot(request: SubRequest, settings: SettingsWrapper) -> Iterator[None]:
+    """Check flags with and without the in-process FlagSnapshot."""
+    settings.FLAG_SNAPSHOT_TTL = 60 if request.param == "with_snapshot" else 0
+    clear_loaded_flag_snapshot()
+    yield
+    clear_loaded_flag_snapshot()
+
+
 @pytest.fixture(params=["with_user", "without_user"])
 def flag_user(
     request: SubRequest,
     django_user_model: type[AbstractBaseUser],
     waffle_cache: BaseCache,
     waffle_settings: SettingsWrapper,
+    flag_snapshot: None,
 ) -> User | None:
     """Return a Django user, and load fixtures for waffle tests."""
     if request.param == "with_user":
@@ -8,6 +8,7 @@ from uuid import uuid4
 from unittest.mock import Mock, patch
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import Client, TestCase
 from django.utils import timezone
 
@@ -23,6 +24,7 @@ import jwt
 import pytest
 import responses
 
+from api.authentication import get_user_cache_key
 from emails.models import (
     DeletedAddress,
     DomainAddress,
@@ -68,6 +70,17 @@ class UpdateExtraDataAndEmailTest(TestCase):
         assert sa.extra_data == new_extra_data
         assert ea.email == new_email
 
+    def test_update_all_data_clears_cached_user(self):
+        user = baker.make(User)
+        sa = baker.make(SocialAccount, user=user, provider="fxa")
+        cache.set(get_user_cache_key(sa.uid), user.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = _update_all_data(sa, {}, "newemail@example.com")
+
+        assert response.status_code == 202
+        assert cache.get(get_user_cache_key(sa.uid)) is None
+
     @patch("privaterelay.views.incr_if_enabled")
     def test_update_newly_premium(self, incr_mocked):
         user = baker.make(User)
@@ -489,7 +502,10 @@ def test_fxa_rp_events_subscription_change(
 
 
 def test_fxa_rp_events_delete_user(
-    client: Client, setup_fxa_rp_events: FxaRpEventsSetupData, caplog
+    client: Client,
+    setup_fxa_rp_events: FxaRpEventsSetupData,
+    caplog,
+    django_capture_on_commit_callbacks,
 ) -> None:
     """A delete-user event deletes the user."""
     setup_fxa_rp_events.mock_responses.reset()  # No profile fetch for delete-user
@@ -514,7 +530,13 @@ def test_fxa_rp_events_delete_user(
         address_hash=address_hash(da.address)
     ).exists()
 
-    with MetricsMock() as mm:
+    user_cache_key = get_user_cache_key(setup_fxa_rp_events.fxa_acct.uid)
+    cache.set(user_cache_key, setup_fxa_rp_events.user.id)
+
+    with (
+        MetricsMock() as mm,
+        django_capture_on_commit_callbacks(execute=True),
+    ):
         response = client.get("/fxa-rp-events", HTTP_AUTHORIZATION=auth_header)
     assert mm.get_records() == []
     assert caplog.record_tuples == [
@@ -523,6 +545,7 @@ def test_fxa_rp_events_delete_user(
     ]
     assert response.status_code == 200
     assert not User.objects.filter(id=setup_fxa_rp_events.user.id).exists()
+    assert cache.get(user_cache_key) is None
     assert not RelayAddress.objects.filter(id=ra.id).exists()
     assert not DomainAddress.objects.filter(id=da.id).exists()
     ra_address_hash = address_hash(ra.address)
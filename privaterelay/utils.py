@@ -10,13 +10,14 @@ from django.contrib.auth.models import AbstractBaseUser
 from django.http import Http404, HttpRequest
 from django.utils.translation.trans_real import parse_accept_lang_header
 
-from waffle import get_waffle_flag_model
-from waffle.models import logger as waffle_logger
+from waffle import get_waffle_flag_model, sample_is_active
+from waffle.models import AbstractBaseFlag, logger as waffle_logger
 from waffle.utils import (
     get_cache as get_waffle_cache,
     get_setting as get_waffle_setting,
 )
 
+from .flag_snapshot import get_flag_snapshot
 from .plans import PlanCountryLangMapping, CountryStr
 
 info_logger = logging.getLogger("eventsinfo")
@@ -409,8 +410,17 @@ def flag_is_active_in_task(flag_name: str, user: AbstractBaseUser | None) -> boo
 
     When using this function, use the @override_flag decorator in tests, rather
     than manually creating flags in the database.
+
+    With FLAG_SNAPSHOT_TTL, flags are read from the in-process FlagSnapshot.
     """
-    flag = get_waffle_flag_model().get(flag_name)
+    snapshot = get_flag_snapshot()
+    if snapshot is not None and flag_name not in snapshot.flags:
+        snapshot = None  # Use the slow path for missing flags
+    flag: AbstractBaseFlag
+    if snapshot is None:
+        flag = get_waffle_flag_model().get(flag_name)
+    else:
+        flag = snapshot.flags[flag_name]
     if not flag.pk:
         log_level = get_waffle_setting("LOG_MISSING_FLAGS")
         if log_level:
@@ -436,7 +446,11 @@ def flag_is_active_in_task(flag_name: str, user: AbstractBaseUser | None) -> boo
     # Removed - check for language-specific override
 
     if user is not None:
-        active_for_user = flag.is_active_for_user(user)
+        active_for_user: bool | None
+        if snapshot is None:
+            active_for_user = flag.is_active_for_user(user)
+        else:
+            active_for_user = snapshot.is_active_for_user(flag, user)
         if active_for_user is not None:
             return bool(active_for_user)
 
@@ -450,3 +464,15 @@ def flag_is_active_in_task(flag_name: str, user: AbstractBaseUser | None) -> boo
             return True
 
     return False
+
+
+def sample_is_active_in_task(sample_name: str) -> bool:
+    """
+    Test if a sample is active in a task (not in a web request).
+
+    With FLAG_SNAPSHOT_TTL, samples are read from the in-process FlagSnapshot.
+    """
+    snapshot = get_flag_snapshot()
+    if snapshot is None or sample_name not in snapshot.sample_percents:
+        return bool(sample_is_active(sample_name))
+    return Decimal(str(random.uniform(0, 100))) <= snapshot.sample_percents[sample_name]
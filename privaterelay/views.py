@@ -26,6 +26,7 @@ import sentry_sdk
 
 # from silk.profiling.profiler import silk_profile
 
+from api.authentication import clear_cached_user
 from emails.models import (
     CannotMakeSubdomainException,
     DomainAddress,
@@ -357,6 +358,8 @@ def _update_all_data(
                 incr_if_enabled("user_has_dropped_phone", 1)
             social_account.user.email = new_email
             social_account.user.save()
+            uid = social_account.uid
+            transaction.on_commit(lambda: clear_cached_user(uid))
             email_address_record = social_account.user.emailaddress_set.first()
             if email_address_record:
                 email_address_record.email = new_email
@@ -380,6 +383,8 @@ def _handle_fxa_delete(
         domain_address.delete()
 
     social_account.user.delete()
+    uid = social_account.uid
+    transaction.on_commit(lambda: clear_cached_user(uid))
     info_logger.info(
         "fxa_rp_event",
         extra={